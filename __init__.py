@@ -1,6 +1,11 @@
+import asyncio
+
 from fastapi import APIRouter
+from loguru import logger
 
 from .crud import db
+from .pool import invoice_pool
+from .tasks import keep_catalog_warm, wait_for_paid_invoices
 from .views import offlineshop_generic_router
 from .views_api import offlineshop_api_router
 from .views_lnurl import offlineshop_lnurl_router
@@ -17,4 +22,32 @@ offlineshop_ext.include_router(offlineshop_generic_router)
 offlineshop_ext.include_router(offlineshop_api_router)
 offlineshop_ext.include_router(offlineshop_lnurl_router)
 
-__all__ = ["offlineshop_ext", "offlineshop_static_files", "db"]
+scheduled_tasks: list[asyncio.Task] = []
+
+
+def offlineshop_stop():
+    for task in scheduled_tasks:
+        try:
+            task.cancel()
+        except Exception as ex:
+            logger.warning(ex)
+
+
+def offlineshop_start():
+    from lnbits.tasks import create_permanent_unique_task
+
+    task = create_permanent_unique_task("ext_offlineshop", wait_for_paid_invoices)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_offlineshop_pool", invoice_pool.run)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_offlineshop_catalog", keep_catalog_warm)
+    scheduled_tasks.append(task)
+
+
+__all__ = [
+    "db",
+    "offlineshop_ext",
+    "offlineshop_start",
+    "offlineshop_static_files",
+    "offlineshop_stop",
+]
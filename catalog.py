@@ -0,0 +1,122 @@
+from typing import Optional
+
+from .models import Item, Shop
+
+
+class Catalog:
+    """
+    All shops and enabled items, bulk loaded when the extension starts so the
+    first scans after a restart don't all go to the database. Items live in
+    the slots of a list with an index by id, freed slots are reused.
+
+    Until `load` is called the catalog stays empty and ignores updates.
+    `version` counts the changes applied since, for consistency checks.
+    """
+
+    def __init__(self) -> None:
+        self._slots: list[Optional[Item]] = []
+        self._free: list[int] = []
+        self._index: dict[str, int] = {}
+        self._shops: dict[str, Shop] = {}
+        self._shop_items: dict[str, set[str]] = {}
+        self.loaded = False
+        self.version = 0
+        self.warmup_seconds = 0.0
+
+    def load(self, shops: list[Shop], items: list[Item], seconds: float) -> None:
+        self.clear()
+        self.loaded = True
+        self.warmup_seconds = seconds
+        for shop in shops:
+            self.put_shop(shop)
+        for item in items:
+            self.put_item(item)
+
+    def clear(self) -> None:
+        self._slots.clear()
+        self._free.clear()
+        self._index.clear()
+        self._shops.clear()
+        self._shop_items.clear()
+        self.loaded = False
+        self.version += 1
+
+    def get_item(self, item_id: str) -> Optional[Item]:
+        slot = self._index.get(item_id)
+        return self._slots[slot] if slot is not None else None
+
+    def get_shop(self, shop_id: str) -> Optional[Shop]:
+        return self._shops.get(shop_id)
+
+    def put_item(self, item: Item) -> None:
+        if not self.loaded:
+            return
+        if not item.enabled:
+            self.remove_item(item.id)
+            return
+        slot = self._index.get(item.id)
+        if slot is None:
+            slot = self._free.pop() if self._free else len(self._slots)
+            if slot == len(self._slots):
+                self._slots.append(None)
+            self._index[item.id] = slot
+        self._slots[slot] = item
+        self._shop_items.setdefault(item.shop, set()).add(item.id)
+        self.version += 1
+
+    def remove_item(self, item_id: str) -> None:
+        slot = self._index.pop(item_id, None)
+        if slot is None:
+            return
+        item = self._slots[slot]
+        assert item
+        self._shop_items.get(item.shop, set()).discard(item_id)
+        self._slots[slot] = None
+        self._free.append(slot)
+        self.version += 1
+
+    def put_shop(self, shop: Shop) -> None:
+        if not self.loaded:
+            return
+        self._shops[shop.id] = shop
+        self.version += 1
+
+    def remove_shop(self, shop_id: str) -> None:
+        """
+        Forgets the shop but keeps its items, for when only its version is
+        known to have changed.
+        """
+        if self._shops.pop(shop_id, None):
+            self.version += 1
+
+    def replace_shop(self, shop: Shop, items: list[Item]) -> None:
+        """
+        Swaps in the current state of a shop and all its enabled items.
+        """
+        for item_id in list(self._shop_items.pop(shop.id, ())):
+            self.remove_item(item_id)
+        self.put_shop(shop)
+        for item in items:
+            self.put_item(item)
+
+    def drop_shop(self, shop_id: str) -> None:
+        for item_id in list(self._shop_items.pop(shop_id, ())):
+            self.remove_item(item_id)
+        self.remove_shop(shop_id)
+
+    def shop_versions(self) -> dict[str, int]:
+        return {shop.id: shop.version for shop in self._shops.values()}
+
+    def shop_ids(self) -> set[str]:
+        return set(self._shops) | set(self._shop_items)
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._index),
+            "shops": len(self._shops),
+            "version": self.version,
+            "warmup_seconds": self.warmup_seconds,
+        }
+
+
+catalog = Catalog()
@@ -0,0 +1,77 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from .crud import (
+    create_confirmation_code,
+    get_confirmation_code,
+    increment_shop_counter,
+    reset_shop_counter,
+)
+from .models import Shop, ShopCounter
+
+
+class CounterBackend(ABC):
+    """
+    Hands out the next word of a shop's wordlist for a payment and remembers
+    which word was issued for which payment_hash.
+    """
+
+    @abstractmethod
+    async def get_word(self, shop: Shop, payment_hash: str) -> str: ...
+
+    @abstractmethod
+    async def reset(self, shop: Shop) -> None: ...
+
+
+class MemoryCounterBackend(CounterBackend):
+    """
+    Per-process counter. Only correct with a single worker and starts over on
+    every restart.
+    """
+
+    async def get_word(self, shop: Shop, payment_hash: str) -> str:
+        return ShopCounter.invoke(shop).get_word(payment_hash)
+
+    async def reset(self, shop: Shop) -> None:
+        ShopCounter.reset(shop)
+
+
+class DatabaseCounterBackend(CounterBackend):
+    """
+    Counter stored in `offlineshop.counters` and incremented atomically, so it
+    is shared by all workers and survives restarts.
+    """
+
+    async def get_word(self, shop: Shop, payment_hash: str) -> str:
+        code = await get_confirmation_code(payment_hash)
+        if code:
+            return code
+        counter = await increment_shop_counter(shop.id)
+        word = shop.words[counter % len(shop.words)]
+        return await create_confirmation_code(shop.id, payment_hash, word)
+
+    async def reset(self, shop: Shop) -> None:
+        await reset_shop_counter(shop.id)
+
+
+counter_backends: dict[str, type[CounterBackend]] = {
+    "memory": MemoryCounterBackend,
+    "database": DatabaseCounterBackend,
+}
+
+counter_backend: CounterBackend = counter_backends[
+    os.getenv("OFFLINESHOP_COUNTER_BACKEND", "memory")
+]()
+
+
+async def get_shop_code(
+    shop: Shop, payment_hash: str, paid_at: Optional[float] = None
+) -> str:
+    if shop.method == "wordlist":
+        return await counter_backend.get_word(shop, payment_hash)
+    return shop.get_code(payment_hash, paid_at)
+
+
+async def reset_shop_code(shop: Shop) -> None:
+    await counter_backend.reset(shop)
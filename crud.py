@@ -1,77 +1,844 @@
+import base64
+import json
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import timezone
 from typing import Optional
 
-from lnbits.db import Database
+from lnbits.db import SQLITE, Connection, Database, model_to_dict
 from lnbits.helpers import urlsafe_short_hash
+from lnurl.types import LnurlPayMetadata
+from pydantic import BaseModel
+from sqlalchemy import text
 
-from .models import CreateItem, CreateShop, Item, Shop
-from .wordlists import animals
+from .catalog import catalog
+from .helpers import TTLCache, image_hash
+from .models import (
+    CreateItem,
+    CreateShop,
+    DailySales,
+    Image,
+    Item,
+    ItemSales,
+    ItemSearch,
+    Order,
+    OrderLine,
+    PooledInvoice,
+    Sale,
+    Shop,
+    metadata_cache,
+)
+from .wordlists import normalize_wordlist
 
 db = Database("ext_offlineshop")
 
+# everything but potentially large columns
+item_columns = (
+    "shop, id, name, description, image, image_hash, enabled, price, unit, "
+    "pool_size, version"
+)
+
+# items and shops are read on every LNURL scan but almost never change,
+# so keep them around for a while. writes below invalidate explicitly, but
+# only in this worker, so other workers may serve an edit late by up to
+# `cache_ttl` seconds.
+cache_ttl = 30
+item_cache = TTLCache(maxsize=4096, ttl=cache_ttl)
+shop_cache = TTLCache(maxsize=1024, ttl=cache_ttl)
+# orders never change once created
+order_cache = TTLCache(maxsize=1024, ttl=300)
+
+
+class Transaction:
+    """
+    Statements that commit together. `Connection.execute` of lnbits commits
+    every statement on its own.
+    """
+
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+
+    async def execute(self, query: str, values: Optional[dict] = None):
+        return await self.conn.conn.execute(
+            text(self.conn.rewrite_query(query)),
+            self.conn.rewrite_values(values) if values else {},
+        )
+
+    async def update(
+        self, table_name: str, model: BaseModel, increment: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Writes the fields of the model to its row. The `increment` column is
+        bumped by the database instead, as the model may be outdated, and its
+        new value returned.
+        """
+        values = model_to_dict(model)
+        fields = [f'"{field}" = :{field}' for field in values if field != increment]
+        if increment:
+            values.pop(increment)
+            fields.append(f'"{increment}" = "{increment}" + 1')
+        query = f"UPDATE {table_name} SET {', '.join(fields)} WHERE id = :id"
+        if not increment:
+            await self.conn.conn.execute(text(query), values)
+            return None
+        result = await self.conn.conn.execute(
+            text(f'{query} RETURNING "{increment}"'), values
+        )
+        row = result.mappings().first()
+        return row[increment] if row else None
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[Transaction]:
+    """
+    Commits when the block exits, rolls back if it raises.
+    """
+    async with db.connect() as conn:
+        yield Transaction(conn)
+        await conn.conn.commit()
+
+
+def invalidate_item(item_id: str) -> None:
+    item_cache.invalidate(item_id)
+
+
+def invalidate_shop(shop_id: str) -> None:
+    shop_cache.invalidate(shop_id)
+    # its version changed, the next read puts it back
+    catalog.remove_shop(shop_id)
+
+
+def cache_stats() -> dict:
+    return {"items": item_cache.stats(), "shops": shop_cache.stats()}
+
 
 async def create_shop(data: CreateShop) -> Shop:
-    data.wordlist = data.wordlist or "\n".join(animals)
+    data.wordlist = normalize_wordlist(data.wordlist)
     shop = Shop(id=urlsafe_short_hash(), **data.dict())
-    await db.insert("offlineshop.shops", shop)
-    return shop
+    await db.execute(
+        """
+        INSERT INTO offlineshop.shops
+        (id, wallet, method, wordlist, version, code_key)
+        VALUES (:id, :wallet, :method, :wordlist, :version, :code_key)
+        ON CONFLICT (wallet) DO NOTHING
+        """,
+        shop.dict(),
+    )
+    # a concurrent request may have created the shop for this wallet first
+    existing = await get_shop_by_wallet(data.wallet)
+    assert existing, "Newly created shop missing"
+    return existing
 
 
 async def get_shop(shop_id: str) -> Optional[Shop]:
-    return await db.fetchone(
+    shop = catalog.get_shop(shop_id) or shop_cache.get(shop_id)
+    if shop:
+        return shop
+    shop = await db.fetchone(
         "SELECT * FROM offlineshop.shops WHERE id = :id",
         {"id": shop_id},
         Shop,
     )
+    if shop:
+        shop_cache.set(shop_id, shop)
+        catalog.put_shop(shop)
+    return shop
 
 
-async def get_or_create_shop_by_wallet(wallet: str) -> Optional[Shop]:
-    shop = await db.fetchone(
+async def get_shop_by_wallet(wallet: str) -> Optional[Shop]:
+    return await db.fetchone(
         "SELECT * FROM offlineshop.shops WHERE wallet = :wallet",
         {"wallet": wallet},
         Shop,
     )
+
+
+async def get_or_create_shop_by_wallet(wallet: str) -> Optional[Shop]:
+    shop = await get_shop_by_wallet(wallet)
     return shop or await create_shop(CreateShop(wallet=wallet))
 
 
 async def update_shop(shop: Shop) -> Shop:
-    await db.update("offlineshop.shops", shop)
+    shop.wordlist = normalize_wordlist(shop.wordlist)
+    await db.execute(
+        """
+        UPDATE offlineshop.shops
+        SET method = :method, wordlist = :wordlist, version = version + 1
+        WHERE id = :id
+        """,
+        {"id": shop.id, "method": shop.method, "wordlist": shop.wordlist},
+    )
+    invalidate_shop(shop.id)
     return shop
 
 
+async def bump_shop_version(shop_id: str) -> None:
+    await db.execute(
+        "UPDATE offlineshop.shops SET version = version + 1 WHERE id = :id",
+        {"id": shop_id},
+    )
+    invalidate_shop(shop_id)
+
+
 async def create_item(
     shop: str,
     data: CreateItem,
+    image_hash: Optional[str] = None,
 ) -> Item:
-    item = Item(id=urlsafe_short_hash(), shop=shop, **data.dict())
+    item = Item(
+        id=urlsafe_short_hash(), shop=shop, image_hash=image_hash, **data.dict()
+    )
     await db.insert("offlineshop.items", item)
+    catalog.put_item(item)
+    await bump_shop_version(shop)
     return item
 
 
+async def create_items(
+    shop: str, items: list[tuple[CreateItem, Optional[str]]]
+) -> list[Item]:
+    """
+    Inserts a batch of `(data, image_hash)` items with a single statement.
+    """
+    created = [
+        Item(id=urlsafe_short_hash(), shop=shop, image_hash=image_hash, **data.dict())
+        for data, image_hash in items
+    ]
+    if not created:
+        return []
+    columns = list(Item.__fields__)
+    rows = []
+    values = {}
+    for i, item in enumerate(created):
+        rows.append("(" + ", ".join(f":{column}_{i}" for column in columns) + ")")
+        values.update({f"{k}_{i}": v for k, v in item.dict().items()})
+    await db.execute(
+        f"""
+        INSERT INTO offlineshop.items ({", ".join(columns)})
+        VALUES {", ".join(rows)}
+        """,
+        values,
+    )
+    for item in created:
+        catalog.put_item(item)
+    await bump_shop_version(shop)
+    return created
+
+
 async def update_item(item: Item) -> Item:
-    await db.update("offlineshop.items", item)
+    async with transaction() as tx:
+        previous = await get_item_image_hash(tx, item.id)
+        # the item may come from a cache that missed edits on other workers
+        version = await tx.update("offlineshop.items", item, increment="version")
+        if previous != item.image_hash:
+            await delete_image_if_unused(tx, previous)
+    if version is not None:
+        item.version = version
+    invalidate_item(item.id)
+    catalog.put_item(item)
+    # pooled invoices were made for the old price and description
+    await delete_pooled_invoices(item.id)
+    await bump_shop_version(item.shop)
     return item
 
 
 async def get_item(item_id: str) -> Optional[Item]:
-    return await db.fetchone(
-        "SELECT * FROM offlineshop.items WHERE id = :id LIMIT 1",
+    item = get_cached_item(item_id)
+    if item:
+        return item
+    item = await db.fetchone(
+        f"SELECT {item_columns} FROM offlineshop.items WHERE id = :id LIMIT 1",
         {"id": item_id},
         Item,
     )
+    if item:
+        item_cache.set(item_id, item)
+        catalog.put_item(item)
+    return item
+
+
+def get_cached_item(item_id: str) -> Optional[Item]:
+    """
+    The item if it is in the catalog or cached, without going to the database.
+    """
+    return catalog.get_item(item_id) or item_cache.get(item_id)
+
+
+async def get_items_by_ids(item_ids: list[str]) -> list[Item]:
+    """
+    Fetches many items in one query. The result follows the order of
+    `item_ids` and skips ids that don't exist.
+    """
+    unique_ids = list(dict.fromkeys(item_ids))
+    if not unique_ids:
+        return []
+    values = {f"id_{i}": item_id for i, item_id in enumerate(unique_ids)}
+    placeholders = ", ".join(f":{key}" for key in values)
+    items: list[Item] = await db.fetchall(
+        f"SELECT {item_columns} FROM offlineshop.items WHERE id IN ({placeholders})",
+        values,
+        Item,
+    )
+    items_by_id = {item.id: item for item in items}
+    return [items_by_id[item_id] for item_id in item_ids if item_id in items_by_id]
+
+
+async def get_items(
+    shop: str, limit: Optional[int] = None, cursor: Optional[str] = None
+) -> list[Item]:
+    """
+    Items ordered by id. Pass the last id of a page as `cursor` to get the
+    next one.
+    """
+    where = "shop = :shop AND id > :cursor" if cursor else "shop = :shop"
+    pagination = "LIMIT :limit" if limit else ""
+    return await db.fetchall(
+        f"""
+        SELECT {item_columns} FROM offlineshop.items
+        WHERE {where} ORDER BY id {pagination}
+        """,
+        {"shop": shop, "cursor": cursor, "limit": limit},
+        Item,
+    )
+
 
+async def search_items(shop: str, search: ItemSearch) -> list[Item]:
+    """
+    A page of the shop's items matching `search`, ties in the sort order are
+    broken by id so pages don't overlap.
+    """
+    conditions = ["shop = :shop"]
+    values: dict = {"shop": shop, "limit": search.limit, "offset": search.offset}
+    if search.words:
+        if db.type == SQLITE:
+            conditions.append(
+                """
+                id IN (
+                    SELECT id FROM offlineshop.items_fts
+                    WHERE items_fts MATCH :match
+                )
+                """
+            )
+            values["match"] = " ".join(f'"{word}"*' for word in search.words)
+        else:
+            conditions.append(
+                "to_tsvector('simple', name || ' ' || description) "
+                "@@ to_tsquery('simple', :match)"
+            )
+            values["match"] = " & ".join(f"{word}:*" for word in search.words)
+    if search.enabled is not None:
+        conditions.append("enabled = :enabled")
+        values["enabled"] = search.enabled
+    if search.unit is not None:
+        conditions.append("unit = :unit")
+        values["unit"] = search.unit
+    if search.min_price is not None:
+        conditions.append("price >= :min_price")
+        values["min_price"] = search.min_price
+    if search.max_price is not None:
+        conditions.append("price <= :max_price")
+        values["max_price"] = search.max_price
 
-async def get_items(shop: str) -> list[Item]:
+    direction = "DESC" if search.descending else "ASC"
+    order = f"{search.sort} {direction}"
+    if search.sort != "id":
+        order += f", id {direction}"
     return await db.fetchall(
-        "SELECT * FROM offlineshop.items WHERE shop = :shop",
-        {"shop": shop},
+        f"""
+        SELECT {item_columns} FROM offlineshop.items
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {order} LIMIT :limit OFFSET :offset
+        """,
+        values,
+        Item,
+    )
+
+
+async def load_catalog() -> float:
+    """
+    Bulk loads all shops and enabled items into the catalog, returns how many
+    seconds that took.
+    """
+    start = time.perf_counter()
+    shops: list[Shop] = await db.fetchall("SELECT * FROM offlineshop.shops", {}, Shop)
+    items: list[Item] = await db.fetchall(
+        f"SELECT {item_columns} FROM offlineshop.items WHERE enabled",
+        {},
         Item,
     )
+    seconds = time.perf_counter() - start
+    catalog.load(shops, items, seconds)
+    return seconds
+
+
+async def sync_catalog() -> int:
+    """
+    Reloads the shops whose version changed since they were put in the
+    catalog, by writes of another worker for example. Returns how many.
+    """
+    rows: list[dict] = await db.fetchall("SELECT id, version FROM offlineshop.shops")
+    versions = {row["id"]: row["version"] for row in rows}
+    known = catalog.shop_versions()
+    for shop_id in catalog.shop_ids() - set(versions):
+        catalog.drop_shop(shop_id)
+    changed = [
+        shop_id
+        for shop_id, version in versions.items()
+        if known.get(shop_id) != version
+    ]
+    for shop_id in changed:
+        shop = await db.fetchone(
+            "SELECT * FROM offlineshop.shops WHERE id = :id", {"id": shop_id}, Shop
+        )
+        if not shop:
+            continue
+        items: list[Item] = await db.fetchall(
+            f"""
+            SELECT {item_columns} FROM offlineshop.items
+            WHERE shop = :shop AND enabled
+            """,
+            {"shop": shop_id},
+            Item,
+        )
+        catalog.replace_shop(shop, items)
+    return len(changed)
 
 
 async def delete_item_from_shop(shop: str, item_id: str):
+    async with transaction() as tx:
+        previous = await get_item_image_hash(tx, item_id)
+        result = await tx.execute(
+            """
+            DELETE FROM offlineshop.items WHERE shop = :shop AND id = :id
+            """,
+            {"shop": shop, "id": item_id},
+        )
+        if result.rowcount:
+            await delete_image_if_unused(tx, previous)
+    invalidate_item(item_id)
+    catalog.remove_item(item_id)
+    await delete_pooled_invoices(item_id)
+    await bump_shop_version(shop)
+
+
+async def get_item_metadata(item: Item) -> LnurlPayMetadata:
+    metadata = metadata_cache.get((item.id, item.version))
+    if metadata is None:
+        image = await get_image(item.image_hash) if item.image_hash else None
+        metadata = item.build_lnurlpay_metadata(image.metadata_uri if image else None)
+        metadata_cache.set((item.id, item.version), metadata)
+    return metadata
+
+
+async def create_image(
+    mime: str, content: bytes, thumbnail: Optional[bytes] = None
+) -> str:
+    """
+    Stores the image once per content and returns its hash. The thumbnail,
+    if given, is used in the lnurlpay metadata instead of the original.
+    """
+    content_hash = image_hash(content)
+    await db.execute(
+        """
+        INSERT INTO offlineshop.images (hash, mime, data, thumbnail)
+        VALUES (:hash, :mime, :data, :thumbnail)
+        ON CONFLICT (hash) DO NOTHING
+        """,
+        {
+            "hash": content_hash,
+            "mime": mime,
+            "data": base64.b64encode(content).decode(),
+            "thumbnail": base64.b64encode(thumbnail).decode() if thumbnail else None,
+        },
+    )
+    return content_hash
+
+
+async def get_image(content_hash: str) -> Optional[Image]:
+    return await db.fetchone(
+        "SELECT * FROM offlineshop.images WHERE hash = :hash",
+        {"hash": content_hash},
+        Image,
+    )
+
+
+async def image_exists(content_hash: str) -> bool:
+    row: Optional[dict] = await db.fetchone(
+        "SELECT hash FROM offlineshop.images WHERE hash = :hash",
+        {"hash": content_hash},
+    )
+    return row is not None
+
+
+async def get_item_image_hash(tx: Transaction, item_id: str) -> Optional[str]:
+    result = await tx.execute(
+        "SELECT image_hash FROM offlineshop.items WHERE id = :id", {"id": item_id}
+    )
+    row = result.mappings().first()
+    return row["image_hash"] if row else None
+
+
+async def delete_image_if_unused(tx: Transaction, content_hash: Optional[str]) -> None:
+    """
+    Deletes an image an item stopped using, unless another item still does.
+    Only that one image is touched, blobs stored for items that are still
+    being created are left alone.
+    """
+    if not content_hash:
+        return
+    await tx.execute(
+        """
+        DELETE FROM offlineshop.images WHERE hash = :hash AND NOT EXISTS (
+            SELECT 1 FROM offlineshop.items WHERE image_hash = :hash
+        )
+        """,
+        {"hash": content_hash},
+    )
+
+
+async def increment_shop_counter(shop_id: str) -> int:
+    await db.execute(
+        """
+        INSERT INTO offlineshop.counters (shop, counter) VALUES (:shop, -1)
+        ON CONFLICT (shop) DO NOTHING
+        """,
+        {"shop": shop_id},
+    )
+    async with db.connect() as conn:
+        result = await conn.execute(
+            """
+            UPDATE offlineshop.counters SET counter = counter + 1
+            WHERE shop = :shop RETURNING counter
+            """,
+            {"shop": shop_id},
+        )
+        row = result.mappings().first()
+    return row["counter"]
+
+
+async def reset_shop_counter(shop_id: str) -> None:
+    await db.execute(
+        "UPDATE offlineshop.counters SET counter = -1 WHERE shop = :shop",
+        {"shop": shop_id},
+    )
+
+
+async def get_confirmation_code(payment_hash: str) -> Optional[str]:
+    row: dict = await db.fetchone(
+        "SELECT code FROM offlineshop.codes WHERE payment_hash = :payment_hash",
+        {"payment_hash": payment_hash},
+    )
+    return row["code"] if row else None
+
+
+async def create_confirmation_code(shop_id: str, payment_hash: str, code: str) -> str:
+    """
+    Stores the code for the payment. If another worker got there first its
+    code wins, so the returned value is always the one that was persisted.
+    """
+    await db.execute(
+        f"""
+        DELETE FROM offlineshop.codes
+        WHERE shop = :shop AND time < {db.timestamp_placeholder("cutoff")}
+        """,
+        {"shop": shop_id, "cutoff": int(time.time()) - 60 * 60 * 24},
+    )
+    await db.execute(
+        """
+        INSERT INTO offlineshop.codes (payment_hash, shop, code)
+        VALUES (:payment_hash, :shop, :code)
+        ON CONFLICT (payment_hash) DO NOTHING
+        """,
+        {"payment_hash": payment_hash, "shop": shop_id, "code": code},
+    )
+    return await get_confirmation_code(payment_hash) or code
+
+
+async def create_sale(sale: Sale) -> bool:
+    """
+    Records the sale and adds it to the daily totals. Returns False if it was
+    already recorded, in which case the totals are left alone.
+    """
+    # a sale in the ledger is always in the totals, and the other way around
+    async with transaction() as tx:
+        result = await tx.execute(
+            f"""
+            INSERT INTO offlineshop.sales
+            (payment_hash, shop, item, quantity, amount_msat, price, unit, code, time)
+            VALUES (:payment_hash, :shop, :item, :quantity, :amount_msat, :price,
+                :unit, :code, {db.timestamp_placeholder("time")})
+            ON CONFLICT (payment_hash, item) DO NOTHING
+            RETURNING payment_hash
+            """,
+            {**sale.dict(), "time": int(sale.time.timestamp())},
+        )
+        if not result.mappings().first():
+            return False
+        await tx.execute(
+            """
+            INSERT INTO offlineshop.sales_daily
+            (shop, day, item, unit, sales, amount_msat, price_total)
+            VALUES (:shop, :day, :item, :unit, :quantity, :amount_msat, :price)
+            ON CONFLICT (shop, day, item, unit) DO UPDATE SET
+                sales = sales_daily.sales + :quantity,
+                amount_msat = sales_daily.amount_msat + :amount_msat,
+                price_total = sales_daily.price_total + :price
+            """,
+            {
+                "shop": sale.shop,
+                "day": sale.time.astimezone(timezone.utc).date().isoformat(),
+                "item": sale.item,
+                "unit": sale.unit,
+                "quantity": sale.quantity,
+                "amount_msat": sale.amount_msat,
+                "price": sale.price * sale.quantity,
+            },
+        )
+    return True
+
+
+def sales_filter(item: Optional[str]) -> str:
+    where = "shop = :shop AND day >= :since AND day <= :until"
+    return f"{where} AND item = :item" if item else where
+
+
+async def get_daily_sales(
+    shop: str, since: str, until: str, item: Optional[str] = None
+) -> list[DailySales]:
+    """
+    Daily totals per item between the `since` and `until` days (YYYY-MM-DD, utc).
+    """
+    return await db.fetchall(
+        f"""
+        SELECT item, day, unit, sales, amount_msat, price_total
+        FROM offlineshop.sales_daily WHERE {sales_filter(item)}
+        ORDER BY day, item, unit
+        """,
+        {"shop": shop, "since": since, "until": until, "item": item},
+        DailySales,
+    )
+
+
+async def get_item_sales(
+    shop: str, since: str, until: str, item: Optional[str] = None
+) -> list[ItemSales]:
+    """
+    Totals per item over the days between `since` and `until`.
+    """
+    return await db.fetchall(
+        f"""
+        SELECT item, unit, SUM(sales) AS sales, SUM(amount_msat) AS amount_msat,
+            SUM(price_total) AS price_total
+        FROM offlineshop.sales_daily WHERE {sales_filter(item)}
+        GROUP BY item, unit ORDER BY item, unit
+        """,
+        {"shop": shop, "since": since, "until": until, "item": item},
+        ItemSales,
+    )
+
+
+async def create_order(shop_id: str, lines: list[OrderLine]) -> Order:
+    """
+    Orders are only needed until they are paid, so the ones older than a day
+    are dropped whenever a new one comes in.
+    """
+    await db.execute(
+        f"""
+        DELETE FROM offlineshop.orders
+        WHERE time < {db.timestamp_placeholder("cutoff")}
+        """,
+        {"cutoff": int(time.time()) - 60 * 60 * 24},
+    )
+    order = Order(id=urlsafe_short_hash(), shop=shop_id, items=lines)
     await db.execute(
         """
-        DELETE FROM offlineshop.items WHERE shop = :shop AND id = :id
+        INSERT INTO offlineshop.orders (id, shop, items)
+        VALUES (:id, :shop, :items)
         """,
-        {"shop": shop, "id": item_id},
+        {
+            "id": order.id,
+            "shop": order.shop,
+            "items": json.dumps([line.dict() for line in order.items]),
+        },
+    )
+    return order
+
+
+async def get_order(order_id: str) -> Optional[Order]:
+    order = order_cache.get(order_id)
+    if order is not None:
+        return order
+    row: dict = await db.fetchone(
+        "SELECT id, shop, items FROM offlineshop.orders WHERE id = :id",
+        {"id": order_id},
+    )
+    if not row:
+        return None
+    order = Order(id=row["id"], shop=row["shop"], items=json.loads(row["items"]))
+    order_cache.set(order_id, order)
+    return order
+
+
+async def get_purchase(extra: dict) -> Optional[tuple[Shop, list[tuple[Item, int]]]]:
+    """
+    The shop and the items (with quantities) an invoice was created for, from
+    the invoice's extra data. Items deleted since are left out.
+    """
+    shop_id = None
+    if extra.get("order"):
+        order = await get_order(extra["order"])
+        if not order:
+            return None
+        shop_id = order.shop
+        wanted = [(line.item, line.quantity) for line in order.items]
+    elif extra.get("item"):
+        wanted = [(extra["item"], 1)]
+    else:
+        return None
+
+    lines = []
+    for item_id, quantity in wanted:
+        item = await get_item(item_id)
+        if item:
+            lines.append((item, quantity))
+    if not lines:
+        return None
+    shop = await get_shop(shop_id or lines[0][0].shop)
+    return (shop, lines) if shop else None
+
+
+async def get_pooled_items() -> list[Item]:
+    return await db.fetchall(
+        f"""
+        SELECT {item_columns} FROM offlineshop.items
+        WHERE pool_size > 0 AND unit = 'sats' AND enabled = :enabled
+        """,
+        {"enabled": True},
+        Item,
+    )
+
+
+async def create_pooled_invoice(
+    item: Item, invoice: PooledInvoice, expires_at: int
+) -> None:
+    await db.execute(
+        f"""
+        INSERT INTO offlineshop.invoices
+        (payment_hash, item, version, bolt11, expires_at)
+        VALUES (:payment_hash, :item, :version, :bolt11,
+            {db.timestamp_placeholder("expires_at")})
+        """,
+        {
+            **invoice.dict(),
+            "item": item.id,
+            "version": item.version,
+            "expires_at": expires_at,
+        },
+    )
+
+
+async def count_pooled_invoices(item: Item, valid_until: int) -> int:
+    """
+    Pooled invoices for the current version of the item that are still valid
+    at `valid_until`.
+    """
+    row: dict = await db.fetchone(
+        f"""
+        SELECT COUNT(*) AS count FROM offlineshop.invoices
+        WHERE item = :item AND version = :version
+        AND expires_at > {db.timestamp_placeholder("valid_until")}
+        """,
+        {"item": item.id, "version": item.version, "valid_until": valid_until},
+    )
+    return row["count"]
+
+
+async def pop_pooled_invoice(item: Item, valid_until: int) -> Optional[PooledInvoice]:
+    """
+    Takes the pooled invoice closest to expiring that is still valid at
+    `valid_until`. The delete makes sure no invoice is handed out twice.
+    """
+    async with db.connect() as conn:
+        result = await conn.execute(
+            f"""
+            DELETE FROM offlineshop.invoices WHERE payment_hash = (
+                SELECT payment_hash FROM offlineshop.invoices
+                WHERE item = :item AND version = :version
+                AND expires_at > {db.timestamp_placeholder("valid_until")}
+                ORDER BY expires_at LIMIT 1
+            )
+            RETURNING payment_hash, bolt11
+            """,
+            {"item": item.id, "version": item.version, "valid_until": valid_until},
+        )
+        row = result.mappings().first()
+    return PooledInvoice(**row) if row else None
+
+
+async def delete_pooled_invoices(item_id: str) -> None:
+    await db.execute(
+        "DELETE FROM offlineshop.invoices WHERE item = :item", {"item": item_id}
+    )
+
+
+async def delete_expired_pooled_invoices(valid_until: int) -> None:
+    await db.execute(
+        f"""
+        DELETE FROM offlineshop.invoices
+        WHERE expires_at <= {db.timestamp_placeholder("valid_until")}
+        """,
+        {"valid_until": valid_until},
+    )
+
+
+async def claim_pool_fill(item_id: str, now: int, until: int) -> bool:
+    """
+    Takes the lease on filling the item's invoice pool until `until`, unless
+    another worker holds one that is still running at `now`.
+    """
+    async with db.connect() as conn:
+        result = await conn.execute(
+            """
+            INSERT INTO offlineshop.invoice_fills (item, until)
+            VALUES (:item, :until)
+            ON CONFLICT (item) DO UPDATE SET until = :until
+            WHERE invoice_fills.until <= :now
+            RETURNING item
+            """,
+            {"item": item_id, "now": now, "until": until},
+        )
+        row = result.mappings().first()
+    return row is not None
+
+
+async def release_pool_fill(item_id: str) -> None:
+    await db.execute(
+        "DELETE FROM offlineshop.invoice_fills WHERE item = :item", {"item": item_id}
+    )
+
+
+async def hit_rate_limit(bucket: str, period: int) -> int:
+    """
+    Counts a hit in the window starting at `period`, returns the hits so far.
+    """
+    async with db.connect() as conn:
+        result = await conn.execute(
+            """
+            INSERT INTO offlineshop.rate_limits (bucket, period, hits)
+            VALUES (:bucket, :period, 1)
+            ON CONFLICT (bucket, period) DO UPDATE SET
+                hits = rate_limits.hits + 1
+            RETURNING hits
+            """,
+            {"bucket": bucket, "period": period},
+        )
+        row = result.mappings().first()
+    return row["hits"]
+
+
+async def delete_rate_limits(before: int) -> None:
+    await db.execute(
+        "DELETE FROM offlineshop.rate_limits WHERE period < :before",
+        {"before": before},
     )
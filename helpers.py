@@ -1,17 +1,291 @@
 import base64
+import binascii
+import codecs
+import csv
+import hashlib
 import hmac
+import io
+import json
 import struct
 import time
+from collections import OrderedDict
+from collections.abc import AsyncIterable, AsyncIterator, Hashable, Sequence
+from typing import Any, Optional
+
+import pyqrcode
+from PIL import Image, UnidentifiedImageError
 
 
 def hotp(key, counter, digits=6, digest="sha1"):
     key = base64.b32decode(key.upper() + "=" * ((8 - len(key)) % 8))
     counter = struct.pack(">Q", counter)
     mac = hmac.new(key, counter, digest).digest()
+    return truncate_otp(mac, digits)
+
+
+def totp(key, time_step=30, digits=6, digest="sha1"):
+    return hotp(key, int(time.time() / time_step), digits, digest)
+
+
+def truncate_otp(mac: bytes, digits: int) -> str:
     offset = mac[-1] & 0x0F
     binary = struct.unpack(">L", mac[offset : offset + 4])[0] & 0x7FFFFFFF
     return str(binary)[-digits:].zfill(digits)
 
 
-def totp(key, time_step=30, digits=6, digest="sha1"):
-    return hotp(key, int(time.time() / time_step), digits, digest)
+class TOTP:
+    """
+    TOTP codes for a raw key. The keyed HMAC state is set up once and copied
+    for every code instead of decoding the key and rekeying each time.
+    """
+
+    def __init__(
+        self, key: bytes, time_step: int = 30, digits: int = 6, digest: str = "sha1"
+    ) -> None:
+        self.key = key
+        self.time_step = time_step
+        self.digits = digits
+        self._hmac = hmac.new(key, digestmod=digest)
+
+    def step(self, timestamp: float) -> int:
+        return int(timestamp / self.time_step)
+
+    def code(self, step: int) -> str:
+        mac = self._hmac.copy()
+        mac.update(struct.pack(">Q", step))
+        return truncate_otp(mac.digest(), self.digits)
+
+    def at(self, timestamp: float) -> str:
+        return self.code(self.step(timestamp))
+
+    def verify(self, code: str, timestamp: float, window: int = 1) -> Optional[int]:
+        """
+        Returns how many steps from `timestamp` the code was valid, closest
+        first, or None if it wasn't valid within `window` steps either way.
+        """
+        step = self.step(timestamp)
+        for offset in sorted(range(-window, window + 1), key=abs):
+            if hmac.compare_digest(self.code(step + offset), code):
+                return offset
+        return None
+
+
+def hmac_code(
+    mac: "hmac.HMAC",
+    payment_hash: str,
+    words: Optional[Sequence[str]] = None,
+    digits: int = 6,
+) -> str:
+    """
+    Confirmation code derived from the keyed `mac` and the payment hash alone,
+    one of `words` or else `digits` decimal digits. 64 bits of the mac are
+    reduced, so the modulo bias is negligible.
+    """
+    mac = mac.copy()
+    mac.update(payment_hash.encode())
+    value = int.from_bytes(mac.digest()[:8], "big")
+    if words:
+        return words[value % len(words)]
+    return str(value % 10**digits).zfill(digits)
+
+
+def sign_token(key: bytes, payload: Any) -> str:
+    """
+    Url-safe token carrying `payload` as json, with a truncated HMAC-SHA256.
+    """
+    data = base64.urlsafe_b64encode(
+        json.dumps(payload, separators=(",", ":")).encode()
+    ).rstrip(b"=")
+    mac = hmac.new(key, data, "sha256").digest()[:12]
+    return data.decode() + "." + base64.urlsafe_b64encode(mac).decode()
+
+
+def verify_token(key: bytes, token: str) -> Optional[Any]:
+    """
+    The payload of a token from `sign_token`, or None if it wasn't signed
+    with `key`.
+    """
+    data, _, mac = token.encode().partition(b".")
+    expected = base64.urlsafe_b64encode(hmac.new(key, data, "sha256").digest()[:12])
+    if not hmac.compare_digest(mac, expected):
+        return None
+    return json.loads(base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4)))
+
+
+def parse_data_uri(uri: str) -> Optional[tuple[str, bytes]]:
+    """
+    Splits a `data:<mime>;base64,<data>` uri into its mime type and content.
+    """
+    if not uri.startswith("data:") or ";base64," not in uri:
+        return None
+    mime, data = uri[5:].split(";base64,", 1)
+    try:
+        return mime, base64.b64decode(data, validate=True)
+    except binascii.Error:
+        return None
+
+
+def image_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+# uploads are only stored and served with one of these types, anything
+# else (text/html say) would run as a page on the LNbits origin
+image_mimes = ("image/png", "image/jpeg", "image/gif", "image/webp")
+# lnurlpay metadata only allows png and jpeg images
+thumbnail_mime = "image/jpeg"
+thumbnail_size = 256
+
+
+def make_thumbnail(content: bytes, quality: int = 75) -> bytes:
+    """
+    Downsizes an image to fit `thumbnail_size` pixels and recompresses it as
+    jpeg, for the lnurlpay metadata. Jpegs that already fit are kept as they
+    are. CPU bound, run it in an executor. Raises ValueError if it isn't an
+    image.
+    """
+    try:
+        image: Image.Image = Image.open(io.BytesIO(content))
+        if image.format == "JPEG" and max(image.size) <= thumbnail_size:
+            return content
+        image.thumbnail((thumbnail_size, thumbnail_size))
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as exc:
+        raise ValueError("not an image") from exc
+    if image.mode != "RGB":
+        # transparent areas turn white instead of black
+        background = Image.new("RGB", image.size, "white")
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    thumbnail = io.BytesIO()
+    image.save(thumbnail, "JPEG", quality=quality, optimize=True)
+    return thumbnail.getvalue()
+
+
+def lnurl_qr_svg(lnurl: str, scale: int = 4) -> str:
+    """
+    QR code for wallets to scan. Upper case fits the compact alphanumeric mode,
+    which bech32 lnurls allow.
+    """
+    qr = pyqrcode.create(f"lightning:{lnurl}".upper(), error="L")
+    svg = io.BytesIO()
+    qr.svg(svg, scale=scale, xmldecl=False, omithw=True)
+    return svg.getvalue().decode()
+
+
+def split_amount(total: int, weights: list[int]) -> list[int]:
+    """
+    Splits `total` in proportion to `weights`, the parts add up to `total`.
+    """
+    weight = sum(weights)
+    if weight <= 0:
+        weights = [1] * len(weights)
+        weight = len(weights)
+    parts = [total * w // weight for w in weights]
+    parts[-1] += total - sum(parts)
+    return parts
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """
+    Splits a stream of utf-8 bytes into lines without reading it all.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_csv_rows(lines: AsyncIterable[str]) -> AsyncIterator[list[str]]:
+    """
+    Parses csv rows from lines with `csv.reader`, feeding it one record at a
+    time. A record continues on the next line only while a quoted field is
+    open, following the quoting rules of the default dialect.
+    """
+    record: list[str] = []
+    quoted = False
+    async for line in lines:
+        record.append(line)
+        quoted = csv_quote_open(line, quoted)
+        if quoted:
+            continue
+        if record != [""]:
+            yield next(csv.reader(["\n".join(record)]))
+        record = []
+    if record:
+        yield next(csv.reader(["\n".join(record)]))
+
+
+def csv_quote_open(line: str, quoted: bool = False) -> bool:
+    """
+    Whether a quoted field is still open at the end of the line. A quote only
+    opens a field at its start, `""` inside one is an escaped quote.
+    """
+    field_start = not quoted
+    after_quote = False
+    for char in line:
+        if quoted:
+            if char == '"':
+                quoted = False
+                after_quote = True
+            continue
+        if after_quote and char == '"':
+            # doubled quote, the field goes on
+            quoted = True
+        elif char == '"' and field_start:
+            quoted = True
+        field_start = char == ","
+        after_quote = False
+    return quoted
+
+
+class TTLCache:
+    """
+    Bounded in-process cache. Entries expire after `ttl` seconds and the least
+    recently used entry is evicted once `maxsize` is reached.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,145 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import NamedTuple
+
+from starlette.requests import Request
+
+from .crud import delete_rate_limits, hit_rate_limit
+
+
+class Limit(NamedTuple):
+    # tokens added per second
+    rate: float
+    # tokens a client can use at once
+    burst: int
+
+
+# fetching the LNURL is cheap, creating invoices is not
+scan_limit = Limit(rate=1, burst=30)
+invoice_limit = Limit(rate=0.2, burst=10)
+# scans of all items together, the ids are the client's choice and unknown
+# ones go to the database
+client_scan_limit = Limit(rate=2, burst=120)
+# invoices for all items together
+client_invoice_limit = Limit(rate=0.5, burst=30)
+# confirmation pages, each can be held open while the payment is pending
+confirmation_limit = Limit(rate=0.2, burst=10)
+
+
+class RateLimitBackend(ABC):
+    """
+    Decides whether a request counts against `limit` for the bucket `key`.
+    """
+
+    @abstractmethod
+    async def allow(self, key: str, limit: Limit) -> bool: ...
+
+    def clear(self) -> None:  # noqa: B027
+        """
+        Forgets the counts kept in memory, if any.
+        """
+
+
+class NoRateLimitBackend(RateLimitBackend):
+    async def allow(self, key: str, limit: Limit) -> bool:
+        return True
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    Token buckets per process. Only the `maxsize` most recently used buckets
+    of each kind (the part of the key before the first `:`) are kept, a
+    bucket dropped from those starts over full. Kinds are kept apart so a
+    flood of cheap scans can't push out the invoice buckets.
+    """
+
+    def __init__(self, maxsize: int = 65536) -> None:
+        self.maxsize = maxsize
+        self._buckets: dict[str, OrderedDict[str, tuple[float, float]]] = {}
+
+    async def allow(self, key: str, limit: Limit) -> bool:
+        now = time.monotonic()
+        buckets = self._buckets.setdefault(key.split(":", 1)[0], OrderedDict())
+        tokens, updated = buckets.pop(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+        allowed = tokens >= 1
+        buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(buckets) > self.maxsize:
+            buckets.popitem(last=False)
+        return allowed
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+class DatabaseRateLimitBackend(RateLimitBackend):
+    """
+    Fixed windows counted in `offlineshop.rate_limits`, shared by all workers.
+    A window lasts as long as an empty bucket takes to fill up again.
+    """
+
+    def __init__(self, prune_interval: float = 60) -> None:
+        self.prune_interval = prune_interval
+        self._pruned = 0.0
+
+    async def allow(self, key: str, limit: Limit) -> bool:
+        now = time.time()
+        window = max(1, round(limit.burst / limit.rate))
+        if now - self._pruned > self.prune_interval:
+            self._pruned = now
+            await delete_rate_limits(int(now) - 60 * 60)
+        hits = await hit_rate_limit(key, int(now // window) * window)
+        return hits <= limit.burst
+
+
+rate_limit_backends: dict[str, type[RateLimitBackend]] = {
+    "memory": MemoryRateLimitBackend,
+    "database": DatabaseRateLimitBackend,
+    "none": NoRateLimitBackend,
+}
+
+rate_limit_backend: RateLimitBackend = rate_limit_backends[
+    os.getenv("OFFLINESHOP_RATE_LIMIT_BACKEND", "memory")
+]()
+
+
+def client_key(request: Request) -> str:
+    """
+    The client's address as the server sees it. Behind a reverse proxy that's
+    the proxy, unless uvicorn is told to trust its forwarded headers (see the
+    README), the headers themselves are never read here as any client can
+    send them.
+    """
+    return request.client.host if request.client else "unknown"
+
+
+async def allow_scan(request: Request, target: str) -> bool:
+    """
+    Whether the client may fetch the LNURL of `target` (an item or order).
+    """
+    client = client_key(request)
+    return await rate_limit_backend.allow(
+        f"scans:{client}", client_scan_limit
+    ) and await rate_limit_backend.allow(f"scan:{client}:{target}", scan_limit)
+
+
+async def allow_invoice(request: Request, target: str) -> bool:
+    """
+    Whether the client may have another invoice created for `target`. Limits
+    are per client, so a flood from one doesn't hold up the others.
+    """
+    client = client_key(request)
+    return await rate_limit_backend.allow(
+        f"invoices:{client}", client_invoice_limit
+    ) and await rate_limit_backend.allow(f"invoice:{client}:{target}", invoice_limit)
+
+
+async def allow_confirmation(request: Request) -> bool:
+    """
+    Whether the client may open another confirmation page. Limited per client
+    and not per payment, the hash in the url is the client's choice.
+    """
+    key = f"confirmation:{client_key(request)}"
+    return await rate_limit_backend.allow(key, confirmation_limit)
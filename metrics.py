@@ -0,0 +1,180 @@
+import bisect
+import os
+import time
+from collections.abc import Callable, Coroutine
+from contextlib import contextmanager, nullcontext
+from typing import Any, Optional
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+metrics_enabled = os.getenv("OFFLINESHOP_METRICS", "").lower() in ("1", "true")
+
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("count", "counts", "sum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters and histograms in the prometheus text format. Labels are passed
+    as tuples of `(name, value)` pairs.
+    """
+
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.help: dict[str, str] = {
+            "offlineshop_requests_total": "Requests by endpoint and status.",
+            "offlineshop_request_seconds": "Request duration by endpoint.",
+            "offlineshop_stage_seconds": "Duration of the stages of a request.",
+            "offlineshop_lnurl_errors_total": "LNURL error responses by reason.",
+            "offlineshop_invoice_pool_total": "Invoice pool lookups by result.",
+        }
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def clear(self) -> None:
+        self.counters.clear()
+        self.histograms.clear()
+
+    def render(
+        self, gauges: dict[str, float], totals: Optional[dict[str, float]] = None
+    ) -> str:
+        """
+        The recorded metrics plus `gauges` and `totals`, current values and
+        running counts kept elsewhere, e.g. by the caches.
+        """
+        lines: list[str] = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines += self._header(name, "counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines += self._header(name, "histogram")
+            for (n, labels), histogram in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                    [*buckets, "+Inf"], histogram.counts, strict=True
+                ):
+                    cumulative += count
+                    le = (*labels, ("le", str(bound)))
+                    lines.append(f"{name}_bucket{_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name, value in sorted((totals or {}).items()):
+            lines += self._header(name, "counter")
+            lines.append(f"{name} {value}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str, kind: str) -> list[str]:
+        header = [f"# TYPE {name} {kind}"]
+        if name in self.help:
+            header.insert(0, f"# HELP {name} {self.help[name]}")
+        return header
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+metrics = Metrics()
+
+_disabled = nullcontext()
+
+
+@contextmanager
+def _span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(
+            "offlineshop_stage_seconds",
+            (("stage", stage),),
+            time.perf_counter() - start,
+        )
+
+
+def span(stage: str):
+    """
+    Times a stage of a request, e.g. `with span("create_invoice"): ...`.
+    """
+    return _span(stage) if metrics_enabled else _disabled
+
+
+def count_lnurl_error(reason: str) -> None:
+    if metrics_enabled:
+        metrics.inc("offlineshop_lnurl_errors_total", (("reason", reason),))
+
+
+def count_pool_lookup(hit: bool) -> None:
+    if metrics_enabled:
+        metrics.inc(
+            "offlineshop_invoice_pool_total", (("result", "hit" if hit else "miss"),)
+        )
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Records duration and status of every request to the route, if enabled.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        if not metrics_enabled:
+            return handler
+        endpoint = self.name
+
+        async def instrumented(request: Request) -> Response:
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except Exception as exc:
+                status = getattr(exc, "status_code", 500)
+                raise
+            finally:
+                labels = (("endpoint", endpoint),)
+                metrics.observe(
+                    "offlineshop_request_seconds", labels, time.perf_counter() - start
+                )
+                metrics.inc(
+                    "offlineshop_requests_total", (*labels, ("status", str(status)))
+                )
+
+        return instrumented
@@ -1,3 +1,12 @@
+import base64
+import secrets
+
+from lnbits.db import SQLITE
+
+from .helpers import image_hash, image_mimes, make_thumbnail, parse_data_uri
+from .wordlists import default_wordlist_text
+
+
 async def m001_initial(db):
     """
     Initial offlineshop tables.
@@ -94,3 +103,459 @@ async def m003_id_as_text(db):
     )
     await db.execute("DROP TABLE offlineshop.old_item;")
     await db.execute("DROP TABLE offlineshop.old_shop;")
+
+
+async def m004_confirmation_counters(db):
+    """
+    Persistent wordlist counters and issued confirmation codes, so codes stay
+    unique across workers and survive restarts.
+    """
+    await db.execute(
+        """
+        CREATE TABLE offlineshop.counters (
+            shop TEXT PRIMARY KEY,
+            counter INTEGER NOT NULL DEFAULT -1
+        );
+    """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.codes (
+            payment_hash TEXT PRIMARY KEY,
+            shop TEXT NOT NULL,
+            code TEXT NOT NULL,
+            time TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+
+
+async def m005_default_wordlist_by_reference(db):
+    """
+    Shops using the default wordlist no longer store a copy of it.
+    """
+    await db.execute(
+        "UPDATE offlineshop.shops SET wordlist = NULL WHERE wordlist = :wordlist",
+        {"wordlist": default_wordlist_text},
+    )
+
+
+async def m006_item_version(db):
+    """
+    Version counter bumped on every item update, used to key cached values.
+    """
+    await db.execute(
+        "ALTER TABLE offlineshop.items ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+    )
+
+
+async def m007_image_blobs(db):
+    """
+    Move uploaded images out of the items table into content-addressed blobs.
+    Items keep a reference in `image_hash`, `image` is only used for urls.
+    """
+    await db.execute(
+        """
+        CREATE TABLE offlineshop.images (
+            hash TEXT PRIMARY KEY,
+            mime TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+    """
+    )
+    await db.execute("ALTER TABLE offlineshop.items ADD COLUMN image_hash TEXT")
+
+    rows = await db.fetchall(
+        "SELECT id, image FROM offlineshop.items WHERE image LIKE :prefix",
+        {"prefix": "data:%"},
+    )
+    for row in rows:
+        parsed = parse_data_uri(row["image"])
+        if not parsed:
+            continue
+        mime, content = parsed
+        if mime not in image_mimes:
+            # not an image type the extension serves, drop it
+            await db.execute(
+                "UPDATE offlineshop.items SET image = NULL WHERE id = :id",
+                {"id": row["id"]},
+            )
+            continue
+        await db.execute(
+            """
+            INSERT INTO offlineshop.images (hash, mime, data)
+            VALUES (:hash, :mime, :data)
+            ON CONFLICT (hash) DO NOTHING
+            """,
+            {
+                "hash": image_hash(content),
+                "mime": mime,
+                "data": base64.b64encode(content).decode(),
+            },
+        )
+        await db.execute(
+            """
+            UPDATE offlineshop.items SET image = NULL, image_hash = :hash
+            WHERE id = :id
+            """,
+            {"hash": image_hash(content), "id": row["id"]},
+        )
+
+
+async def m008_shop_version(db):
+    """
+    Version counter bumped whenever a shop or any of its items changes.
+    """
+    await db.execute(
+        "ALTER TABLE offlineshop.shops ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+    )
+
+
+def create_index(db, name: str, table: str, columns: str, unique: bool = False):
+    """
+    On sqlite the schema goes on the index name, elsewhere on the table.
+    """
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if db.type == SQLITE:
+        return f"CREATE {kind} offlineshop.{name} ON {table} ({columns})"
+    return f"CREATE {kind} {name} ON offlineshop.{table} ({columns})"
+
+
+async def m009_lookup_indexes(db):
+    """
+    Index the columns shops and items are looked up by. A wallet can only have
+    one shop, so duplicates created by concurrent requests are merged first
+    into the one with the most items, or else the latest confirmation code.
+    Items and codes move over, the counters of the others are dropped.
+    """
+    duplicates = await db.fetchall(
+        "SELECT wallet FROM offlineshop.shops GROUP BY wallet HAVING COUNT(*) > 1"
+    )
+    for duplicate in duplicates:
+        shops = await db.fetchall(
+            """
+            SELECT id, (
+                SELECT COUNT(*) FROM offlineshop.items WHERE shop = shops.id
+            ) AS items, (
+                SELECT MAX(time) FROM offlineshop.codes WHERE shop = shops.id
+            ) AS active
+            FROM offlineshop.shops WHERE wallet = :wallet
+            ORDER BY items DESC, active IS NULL, active DESC, id
+            """,
+            {"wallet": duplicate["wallet"]},
+        )
+        keep, *others = [shop["id"] for shop in shops]
+        for other in others:
+            for table in ("items", "codes"):
+                await db.execute(
+                    f"UPDATE offlineshop.{table} SET shop = :keep WHERE shop = :other",
+                    {"keep": keep, "other": other},
+                )
+            await db.execute(
+                "DELETE FROM offlineshop.counters WHERE shop = :other", {"other": other}
+            )
+            await db.execute(
+                "DELETE FROM offlineshop.shops WHERE id = :other", {"other": other}
+            )
+
+    await db.execute(create_index(db, "shops_wallet", "shops", "wallet", unique=True))
+    await db.execute(create_index(db, "items_shop_id", "items", "shop, id"))
+    await db.execute(create_index(db, "codes_shop_time", "codes", "shop, time"))
+
+
+async def m010_sales_ledger(db):
+    """
+    Every settled sale, and per item daily totals kept up to date as sales come
+    in so reports never have to scan the ledger.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.sales (
+            payment_hash TEXT PRIMARY KEY,
+            shop TEXT NOT NULL,
+            item TEXT NOT NULL,
+            amount_msat {db.big_int} NOT NULL,
+            price REAL NOT NULL,
+            unit TEXT NOT NULL,
+            code TEXT NOT NULL DEFAULT '',
+            time TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(create_index(db, "sales_shop_time", "sales", "shop, time"))
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.sales_daily (
+            shop TEXT NOT NULL,
+            item TEXT NOT NULL,
+            day TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0,
+            amount_msat {db.big_int} NOT NULL DEFAULT 0,
+            price_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (shop, day, item, unit)
+        );
+    """
+    )
+
+
+async def m011_orders(db):
+    """
+    Orders of several items paid with one invoice. The items of a paid order
+    go into the sales ledger one row each, so the ledger is keyed by payment
+    and item now and counts quantities.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.orders (
+            id TEXT PRIMARY KEY,
+            shop TEXT NOT NULL,
+            items TEXT NOT NULL,
+            time TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(create_index(db, "orders_time", "orders", "time"))
+
+    await db.execute("ALTER TABLE offlineshop.sales RENAME TO sales_m010")
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.sales (
+            payment_hash TEXT NOT NULL,
+            shop TEXT NOT NULL,
+            item TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            amount_msat {db.big_int} NOT NULL,
+            price REAL NOT NULL,
+            unit TEXT NOT NULL,
+            code TEXT NOT NULL DEFAULT '',
+            time TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            PRIMARY KEY (payment_hash, item)
+        );
+    """
+    )
+    await db.execute(
+        """
+        INSERT INTO offlineshop.sales
+        (payment_hash, shop, item, amount_msat, price, unit, code, time)
+        SELECT payment_hash, shop, item, amount_msat, price, unit, code, time
+        FROM offlineshop.sales_m010
+        """
+    )
+    await db.execute("DROP TABLE offlineshop.sales_m010")
+    await db.execute(create_index(db, "sales_shop_time", "sales", "shop, time"))
+
+
+async def m012_invoice_pool(db):
+    """
+    Invoices created ahead of time for sats priced items, handed out by the
+    LNURL callback instead of creating one while the payer waits.
+    """
+    await db.execute(
+        "ALTER TABLE offlineshop.items ADD COLUMN pool_size INTEGER NOT NULL DEFAULT 0"
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE offlineshop.invoices (
+            payment_hash TEXT PRIMARY KEY,
+            item TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            bolt11 TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            time TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(
+        create_index(
+            db, "invoices_item_expiry", "invoices", "item, version, expires_at"
+        )
+    )
+
+
+async def m013_rate_limits(db):
+    """
+    Request counts per fixed window, for the shared rate limit backend.
+    """
+    await db.execute(
+        """
+        CREATE TABLE offlineshop.rate_limits (
+            bucket TEXT NOT NULL,
+            period INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, period)
+        );
+    """
+    )
+
+
+async def m014_item_search(db):
+    """
+    Indexes for searching, filtering and sorting the items of a shop. Text
+    search uses an fts5 table kept in sync by triggers on sqlite and a gin
+    index over the same words elsewhere.
+    """
+    await db.execute(create_index(db, "items_shop_name", "items", "shop, name"))
+    await db.execute(create_index(db, "items_shop_price", "items", "shop, price"))
+    if db.type != SQLITE:
+        await db.execute(
+            """
+            CREATE INDEX items_search ON offlineshop.items
+            USING GIN (to_tsvector('simple', name || ' ' || description))
+            """
+        )
+        return
+
+    await db.execute(
+        """
+        CREATE VIRTUAL TABLE offlineshop.items_fts USING fts5(
+            name, description, content='items', content_rowid='rowid'
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name, description)
+            VALUES (new.rowid, new.name, new.description);
+        END;
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name, description)
+            VALUES ('delete', old.rowid, old.name, old.description);
+        END;
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_update AFTER UPDATE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, name, description)
+            VALUES ('delete', old.rowid, old.name, old.description);
+            INSERT INTO items_fts (rowid, name, description)
+            VALUES (new.rowid, new.name, new.description);
+        END;
+        """
+    )
+    await db.execute("INSERT INTO offlineshop.items_fts (items_fts) VALUES ('rebuild')")
+
+
+async def m015_image_thumbnails(db):
+    """
+    Downsized copies of uploaded images for the lnurlpay metadata, the
+    originals stay for the dashboard.
+    """
+    await db.execute("ALTER TABLE offlineshop.images ADD COLUMN thumbnail TEXT")
+    rows = await db.fetchall("SELECT hash, data FROM offlineshop.images")
+    for row in rows:
+        try:
+            thumbnail = make_thumbnail(base64.b64decode(row["data"]))
+        except ValueError:
+            continue
+        await db.execute(
+            "UPDATE offlineshop.images SET thumbnail = :thumbnail WHERE hash = :hash",
+            {"hash": row["hash"], "thumbnail": base64.b64encode(thumbnail).decode()},
+        )
+
+
+async def m016_image_mime_allowlist(db):
+    """
+    Drop stored blobs whose type isn't one of `image_mimes`. They came from
+    data uris of any type, which the image route would have served as is.
+    """
+    values = {f"mime_{i}": mime for i, mime in enumerate(image_mimes)}
+    allowed = ", ".join(f":{key}" for key in values)
+    await db.execute(
+        f"""
+        UPDATE offlineshop.items SET image_hash = NULL WHERE image_hash IN (
+            SELECT hash FROM offlineshop.images WHERE mime NOT IN ({allowed})
+        )
+        """,
+        values,
+    )
+    await db.execute(
+        f"DELETE FROM offlineshop.images WHERE mime NOT IN ({allowed})", values
+    )
+
+
+async def m017_invoice_pool_fills(db):
+    """
+    Leases on refilling the invoice pool of an item, so only one worker at a
+    time creates its missing invoices.
+    """
+    await db.execute(
+        """
+        CREATE TABLE offlineshop.invoice_fills (
+            item TEXT PRIMARY KEY,
+            until INTEGER NOT NULL
+        );
+    """
+    )
+
+
+async def m018_item_search_by_id(db):
+    """
+    Key the sqlite text index by item id. The fts5 table of m014 mirrored the
+    implicit rowid of items, which VACUUM may renumber, pointing the index at
+    other items. Its triggers only fire when the indexed text changes.
+    """
+    if db.type != SQLITE:
+        return
+
+    for trigger in ("insert", "delete", "update"):
+        await db.execute(f"DROP TRIGGER offlineshop.items_fts_{trigger}")
+    await db.execute("DROP TABLE offlineshop.items_fts")
+    await db.execute(
+        """
+        CREATE VIRTUAL TABLE offlineshop.items_fts USING fts5(
+            id UNINDEXED, name, description
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (id, name, description)
+            VALUES (new.id, new.name, new.description);
+        END;
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_delete AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE id = old.id;
+        END;
+        """
+    )
+    await db.execute(
+        """
+        CREATE TRIGGER offlineshop.items_fts_update
+        AFTER UPDATE OF id, name, description ON items BEGIN
+            DELETE FROM items_fts WHERE id = old.id;
+            INSERT INTO items_fts (id, name, description)
+            VALUES (new.id, new.name, new.description);
+        END;
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO offlineshop.items_fts (id, name, description)
+        SELECT id, name, description FROM offlineshop.items
+        """
+    )
+
+
+async def m019_shop_code_keys(db):
+    """
+    A random secret per shop for the hmac confirmation codes, instead of a key
+    derived from the shop and wallet ids anyone with the ids could recompute.
+    """
+    await db.execute("ALTER TABLE offlineshop.shops ADD COLUMN code_key TEXT")
+    shops = await db.fetchall("SELECT id FROM offlineshop.shops")
+    for shop in shops:
+        await db.execute(
+            "UPDATE offlineshop.shops SET code_key = :code_key WHERE id = :id",
+            {"id": shop["id"], "code_key": secrets.token_hex(32)},
+        )
@@ -1,21 +1,57 @@
 import base64
 import hashlib
+import hmac
 import json
+import os
+import re
+import secrets
+import time
 from collections import OrderedDict
-from typing import Optional
+from datetime import datetime
+from typing import ClassVar, Optional
 
+from lnbits.settings import settings
 from lnurl import encode as lnurl_encode
 from lnurl.types import LnurlPayMetadata
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, validator
 from starlette.requests import Request
 
-from .helpers import totp
+from .helpers import (
+    TOTP,
+    TTLCache,
+    hmac_code,
+    sign_token,
+    thumbnail_mime,
+    verify_token,
+)
+from .wordlists import get_wordlist
 
 shop_counters: dict = {}
 
+# derived values only change when the item is edited (which bumps its
+# version) or when it is served from another base url
+lnurl_cache = TTLCache(maxsize=8192, ttl=60 * 60)
+metadata_cache = TTLCache(maxsize=4096, ttl=60 * 60)
+qr_cache = TTLCache(maxsize=4096, ttl=60 * 60)
+# keyed hmac state for the totp and hmac methods, derived once per shop
+otp_cache = TTLCache(maxsize=1024, ttl=60 * 60)
+code_cache = TTLCache(maxsize=1024, ttl=60 * 60)
+
+# confirmation methods whose codes are derived from the payment hash
+hmac_methods = ("hmac", "hmac_digits")
+
+# printed lnurls carry a signed snapshot of the item, see `ItemSnapshot`
+signed_lnurls = os.getenv("OFFLINESHOP_SIGNED_LNURLS", "").lower() in ("1", "true")
+lnurl_key = hashlib.sha256(
+    (
+        "offlineshop-lnurl"
+        + (os.getenv("OFFLINESHOP_LNURL_SECRET") or settings.auth_secret_key)
+    ).encode()
+).digest()
+
 
 class ShopCounter:
-    wordlist: list[str]
+    wordlist: tuple[str, ...]
     fulfilled_payments: OrderedDict
     counter: int
 
@@ -23,7 +59,7 @@ class ShopCounter:
     def invoke(cls, shop: "Shop"):
         shop_counter = shop_counters.get(shop.id)
         if not shop_counter:
-            shop_counter = cls(wordlist=shop.wordlist.split("\n"))
+            shop_counter = cls(wordlist=shop.words)
             shop_counters[shop.id] = shop_counter
         return shop_counter
 
@@ -31,9 +67,9 @@ class ShopCounter:
     def reset(cls, shop: "Shop"):
         shop_counter = cls.invoke(shop)
         shop_counter.counter = -1
-        shop_counter.wordlist = shop.wordlist.split("\n")
+        shop_counter.wordlist = shop.words
 
-    def __init__(self, wordlist: list[str]):
+    def __init__(self, wordlist: tuple[str, ...]):
         self.wordlist = wordlist
         self.fulfilled_payments = OrderedDict()
         self.counter = -1
@@ -62,58 +98,131 @@ class CreateShop(BaseModel):
     wordlist: Optional[str] = None
 
 
+class VerifyCode(BaseModel):
+    code: str
+    # how many time steps before or after now the code may be from
+    window: int = Field(default=2, ge=0, le=10)
+
+
 class Shop(BaseModel):
     id: str
     wallet: str
     method: str
-    wordlist: str
+    # `None` means the default wordlist
+    wordlist: Optional[str] = None
+    # bumped whenever the shop or any of its items change
+    version: int = 0
+    # hex secret the hmac confirmation codes are derived from
+    code_key: str = Field(default_factory=lambda: secrets.token_hex(32))
+
+    @property
+    def words(self) -> tuple[str, ...]:
+        return get_wordlist(self.wordlist)
+
+    @property
+    def otp(self) -> TOTP:
+        key = (self.id, self.wallet)
+        otp = otp_cache.get(key)
+        if otp is None:
+            otp = TOTP(
+                hashlib.sha256(
+                    ("otpkey" + str(self.id) + self.wallet).encode("ascii")
+                ).digest()
+            )
+            otp_cache.set(key, otp)
+        return otp
 
     @property
     def otp_key(self) -> str:
-        return base64.b32encode(
-            hashlib.sha256(
-                ("otpkey" + str(self.id) + self.wallet).encode("ascii")
-            ).digest()
-        ).decode("ascii")
+        return base64.b32encode(self.otp.key).decode("ascii")
 
-    def get_code(self, payment_hash: str) -> str:
+    @property
+    def code_hmac(self) -> "hmac.HMAC":
+        key = (self.id, self.code_key)
+        mac = code_cache.get(key)
+        if mac is None:
+            mac = hmac.new(bytes.fromhex(self.code_key), digestmod="sha256")
+            code_cache.set(key, mac)
+        return mac
+
+    def get_code(self, payment_hash: str, paid_at: Optional[float] = None) -> str:
+        """
+        `paid_at` is the time the payment settled, the totp code is the one
+        that was current then.
+        """
         if self.method == "wordlist":
             sc = ShopCounter.invoke(self)
             return sc.get_word(payment_hash)
         elif self.method == "totp":
-            return totp(self.otp_key)
+            return self.otp.at(paid_at if paid_at is not None else time.time())
+        elif self.method in hmac_methods:
+            # the same on every worker and on the merchant's own devices
+            words = self.words if self.method == "hmac" else None
+            return hmac_code(self.code_hmac, payment_hash, words)
         return ""
 
 
+def encode_lnurls(req: Request, items: list["Item"]) -> list[str]:
+    """
+    LNURLs for many items, resolving the route only once.
+    """
+    # item ids and tokens are url-safe, so they can just be appended to the
+    # route prefix
+    if signed_lnurls:
+        route = req.url_for("offlineshop.signed_lnurl_response", token="_")
+    else:
+        route = req.url_for("offlineshop.lnurl_response", item_id="_")
+    prefix = str(route)[:-1]
+    lnurls = []
+    for item in items:
+        key = (item.id, item.version, prefix)
+        lnurl = lnurl_cache.get(key)
+        if lnurl is None:
+            path = ItemSnapshot.of(item).token() if signed_lnurls else item.id
+            lnurl = lnurl_encode(prefix + path)
+            lnurl_cache.set(key, lnurl)
+        lnurls.append(lnurl)
+    return lnurls
+
+
 class Item(BaseModel):
     shop: str
     id: str
     name: str
     description: str
+    # an image url, uploaded images are stored separately under `image_hash`
     image: Optional[str]
+    image_hash: Optional[str] = None
     enabled: Optional[bool] = True
     price: float
     unit: str
+    # invoices to keep ready for sats priced items, see `pool.py`
+    pool_size: int = 0
+    # bumped on every update, used to key cached derived values
+    version: int = 0
 
     def lnurl(self, req: Request) -> str:
-        return lnurl_encode(
-            str(req.url_for("offlineshop.lnurl_response", item_id=self.id))
-        )
+        return encode_lnurls(req, [self])[0]
 
-    def values(self, req: Request):
+    def values(self, req: Request, lnurl: Optional[str] = None):
         values = self.dict()
-        values["lnurl"] = lnurl_encode(
-            str(req.url_for("offlineshop.lnurl_response", item_id=self.id))
-        )
+        values["lnurl"] = lnurl if lnurl is not None else self.lnurl(req)
+        if self.image_hash:
+            values["image"] = str(
+                req.url_for("offlineshop.image", image_hash=self.image_hash)
+            )
         return values
 
-    @property
-    def lnurlpay_metadata(self) -> LnurlPayMetadata:
+    def build_lnurlpay_metadata(self, image: Optional[str] = None) -> LnurlPayMetadata:
+        """
+        `image` is the data uri of the stored image, if the item has one.
+        """
         metadata = [("text/plain", self.description)]
 
-        if self.image:
+        image = image or self.image
+        if image:
             try:
-                image_tuple = tuple(self.image.split(":")[1].split(",")[:2])
+                image_tuple = tuple(image.split(":")[1].split(",")[:2])
                 if len(image_tuple) == 2:
                     metadata.append(image_tuple)
             except IndexError:
@@ -122,9 +231,178 @@ class Item(BaseModel):
         return LnurlPayMetadata(json.dumps(metadata))
 
 
+class ItemSnapshot(BaseModel):
+    """
+    What a wallet needs to know about an item when it is scanned, signed into
+    the printed lnurl so the scan can be answered without loading the item.
+    The description is left out if the metadata needs the image, or if it
+    would make the QR code too dense.
+    """
+
+    id: str
+    version: int
+    price: float
+    unit: str
+    description: Optional[str] = None
+
+    max_description: ClassVar[int] = 120
+
+    @classmethod
+    def of(cls, item: Item) -> "ItemSnapshot":
+        with_description = (
+            not item.image
+            and not item.image_hash
+            and len(item.description) <= cls.max_description
+        )
+        return cls(
+            id=item.id,
+            version=item.version,
+            price=item.price,
+            unit=item.unit,
+            description=item.description if with_description else None,
+        )
+
+    @classmethod
+    def from_token(cls, token: str) -> Optional["ItemSnapshot"]:
+        fields = ("id", "version", "price", "unit", "description")
+        try:
+            payload = verify_token(lnurl_key, token)
+            if not isinstance(payload, list) or len(payload) != len(fields):
+                return None
+            return cls(**dict(zip(fields, payload, strict=True)))
+        except ValueError:
+            return None
+
+    def token(self) -> str:
+        return sign_token(
+            lnurl_key, [self.id, self.version, self.price, self.unit, self.description]
+        )
+
+    @property
+    def metadata(self) -> Optional[LnurlPayMetadata]:
+        if self.description is None:
+            return None
+        return LnurlPayMetadata(json.dumps([("text/plain", self.description)]))
+
+
 class CreateItem(BaseModel):
     name: str
     description: str
     price: float
     unit: str
     image: Optional[str] = None
+    pool_size: int = Field(default=0, ge=0, le=100)
+
+
+class ImportItem(CreateItem):
+    # only set on import, edits keep the item's state
+    enabled: bool = True
+
+
+class ItemSearch(BaseModel):
+    # every word has to start a word of the name or description
+    text: Optional[str] = None
+    enabled: Optional[bool] = None
+    unit: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    # a column, it goes into the query as is
+    sort: str = Field(default="name", regex="^(name|price|id)$")
+    descending: bool = False
+    limit: int = Field(default=50, ge=1, le=500)
+    offset: int = Field(default=0, ge=0)
+
+    @property
+    def words(self) -> list[str]:
+        return re.findall(r"\w+", self.text or "")
+
+
+class PooledInvoice(BaseModel):
+    payment_hash: str
+    bolt11: str
+
+
+class Image(BaseModel):
+    hash: str
+    mime: str
+    # base64 of the original, served to the dashboard
+    data: str
+    # base64 of the downsized jpeg that goes into the lnurlpay metadata,
+    # missing for images that couldn't be decoded before uploads were checked
+    thumbnail: Optional[str] = None
+
+    @property
+    def data_uri(self) -> str:
+        return f"data:{self.mime};base64,{self.data}"
+
+    @property
+    def metadata_uri(self) -> str:
+        if self.thumbnail is None:
+            return self.data_uri
+        return f"data:{thumbnail_mime};base64,{self.thumbnail}"
+
+
+class OrderLine(BaseModel):
+    item: str
+    quantity: int = Field(default=1, ge=1, le=1000)
+
+
+class CreateOrder(BaseModel):
+    items: list[OrderLine] = Field(..., min_items=1, max_items=100)
+
+    @validator("items")
+    @classmethod
+    def items_are_unique(cls, items: list[OrderLine]) -> list[OrderLine]:
+        if len({line.item for line in items}) < len(items):
+            raise ValueError("Each item can only be listed once.")
+        return items
+
+
+class Order(BaseModel):
+    id: str
+    shop: str
+    items: list[OrderLine]
+
+    def lnurl(self, req: Request) -> str:
+        return lnurl_encode(
+            str(req.url_for("offlineshop.order_lnurl_response", order_id=self.id))
+        )
+
+
+def order_summary(lines: list[tuple[Item, int]]) -> str:
+    return ", ".join(
+        f"{quantity}x {item.name}" if quantity > 1 else item.name
+        for item, quantity in lines
+    )
+
+
+class Sale(BaseModel):
+    payment_hash: str
+    shop: str
+    item: str
+    quantity: int = 1
+    amount_msat: int
+    # the item price at the time of the sale, in `unit`
+    price: float
+    unit: str
+    code: str = ""
+    time: datetime
+
+
+class DailySales(BaseModel):
+    item: str
+    # utc date, YYYY-MM-DD
+    day: str
+    unit: str
+    # units sold
+    sales: int
+    amount_msat: int
+    price_total: float
+
+
+class ItemSales(BaseModel):
+    item: str
+    unit: str
+    sales: int
+    amount_msat: int
+    price_total: float
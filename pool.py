@@ -0,0 +1,125 @@
+import asyncio
+import time
+from typing import Optional
+
+from lnbits.core.services import create_invoice
+from loguru import logger
+
+from .crud import (
+    claim_pool_fill,
+    count_pooled_invoices,
+    create_pooled_invoice,
+    delete_expired_pooled_invoices,
+    get_item,
+    get_item_metadata,
+    get_pooled_items,
+    get_shop,
+    pop_pooled_invoice,
+    release_pool_fill,
+)
+from .metrics import count_pool_lookup
+from .models import Item, PooledInvoice
+
+
+class InvoicePool:
+    """
+    Keeps up to `pool_size` invoices ready for every sats priced item, so the
+    LNURL callback can hand one out without waiting for the Lightning node.
+    `pop` takes one and asks for a refill, which `run` does in the background.
+    Invoices are only handed out while they have `min_validity` seconds left,
+    the ones past that are dropped and replaced.
+
+    Every worker runs a pool, an item is only filled by the one holding its
+    lease, for at most `fill_lease` seconds.
+    """
+
+    def __init__(
+        self,
+        expiry: int = 60 * 60 * 6,
+        min_validity: int = 60 * 10,
+        interval: float = 60,
+        fill_lease: int = 60 * 5,
+    ) -> None:
+        self.expiry = expiry
+        self.min_validity = min_validity
+        self.interval = interval
+        self.fill_lease = fill_lease
+        self._wanted: set[str] = set()
+        self._wakeup = asyncio.Event()
+
+    async def pop(self, item: Item) -> Optional[PooledInvoice]:
+        if not item.pool_size or item.unit != "sats":
+            return None
+        invoice = await pop_pooled_invoice(item, int(time.time()) + self.min_validity)
+        count_pool_lookup(invoice is not None)
+        self.refill(item.id)
+        return invoice
+
+    def refill(self, item_id: str) -> None:
+        self._wanted.add(item_id)
+        self._wakeup.set()
+
+    async def fill(self, item: Item) -> int:
+        """
+        Creates the invoices missing from the item's pool, returns how many.
+        Nothing is created while another worker is filling the pool.
+        """
+        shop = await get_shop(item.shop)
+        if not shop:
+            return 0
+        now = int(time.time())
+        if not await claim_pool_fill(item.id, now, now + self.fill_lease):
+            return 0
+        try:
+            return await self._fill(item, shop.wallet)
+        finally:
+            await release_pool_fill(item.id)
+
+    async def _fill(self, item: Item, wallet: str) -> int:
+        metadata = await get_item_metadata(item)
+        missing = item.pool_size - await count_pooled_invoices(
+            item, int(time.time()) + self.min_validity
+        )
+        for _ in range(missing):
+            payment = await create_invoice(
+                wallet_id=wallet,
+                amount=int(item.price),
+                memo=item.name,
+                unhashed_description=metadata.encode(),
+                expiry=self.expiry,
+                extra={"tag": "offlineshop", "item": item.id},
+            )
+            await create_pooled_invoice(
+                item,
+                PooledInvoice(payment_hash=payment.payment_hash, bolt11=payment.bolt11),
+                int(time.time()) + self.expiry,
+            )
+        return max(missing, 0)
+
+    async def sweep(self) -> None:
+        """
+        Drops invoices too close to expiring and refills all pools.
+        """
+        await delete_expired_pooled_invoices(int(time.time()) + self.min_validity)
+        self._wanted.update(item.id for item in await get_pooled_items())
+
+    async def run(self) -> None:
+        await self.sweep()
+        while True:
+            wanted, self._wanted = self._wanted, set()
+            self._wakeup.clear()
+            for item_id in wanted:
+                item = await get_item(item_id)
+                if not item or not item.enabled or item.unit != "sats":
+                    continue
+                try:
+                    await self.fill(item)
+                except Exception as exc:
+                    logger.warning(f"could not refill invoice pool of {item_id}: {exc}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await self.sweep()
+
+
+invoice_pool = InvoicePool()
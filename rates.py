@@ -0,0 +1,79 @@
+import asyncio
+import time
+from typing import Optional
+
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
+
+from .helpers import TTLCache
+
+
+class RateSnapshot:
+    """
+    An exchange rate as fetched at one point in time. Prices quoted to a
+    wallet in `lnurl_response` are checked against the same snapshot in
+    `lnurl_callback`.
+    """
+
+    def __init__(self, currency: str, rate: float):
+        self.id = urlsafe_short_hash()
+        self.currency = currency
+        # satoshis per unit of `currency`
+        self.rate = rate
+        self.fetched_at = time.monotonic()
+
+    def as_satoshis(self, amount: float) -> int:
+        return int(amount * self.rate)
+
+
+class RateSnapshots:
+    """
+    Keeps one snapshot per currency for `ttl` seconds. Concurrent lookups for
+    the same currency wait for a single upstream fetch, and past snapshots
+    stay retrievable by id for `quote_ttl` seconds, long enough for a wallet
+    to call back but not for payers to collect the lowest rates.
+    """
+
+    def __init__(self, ttl: float = 60, quote_ttl: float = 60 * 2):
+        self.ttl = ttl
+        self.fetches = 0
+        self._current: dict[str, RateSnapshot] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._quotes = TTLCache(maxsize=1024, ttl=quote_ttl)
+
+    def _fresh(self, currency: str) -> Optional[RateSnapshot]:
+        snapshot = self._current.get(currency)
+        if snapshot and time.monotonic() - snapshot.fetched_at < self.ttl:
+            return snapshot
+        return None
+
+    async def get(self, currency: str) -> RateSnapshot:
+        snapshot = self._fresh(currency)
+        if snapshot:
+            return snapshot
+        lock = self._locks.setdefault(currency, asyncio.Lock())
+        async with lock:
+            # someone else may have fetched it while we were waiting
+            snapshot = self._fresh(currency)
+            if snapshot:
+                return snapshot
+            self.fetches += 1
+            rate = await get_fiat_rate_satoshis(currency)
+            if not rate > 0:
+                raise ValueError(f"Could not get exchange rate for {currency}.")
+            snapshot = RateSnapshot(currency, rate)
+            self._current[currency] = snapshot
+            self._quotes.set(snapshot.id, snapshot)
+            return snapshot
+
+    def quote(self, snapshot_id: Optional[str]) -> Optional[RateSnapshot]:
+        if not snapshot_id:
+            return None
+        return self._quotes.get(snapshot_id)
+
+    def clear(self) -> None:
+        self._current.clear()
+        self._quotes.clear()
+
+
+rate_snapshots = RateSnapshots()
@@ -17,6 +17,8 @@ window.app = Vue.createApp({
     return {
       selectedWallet: null,
       confirmationMethod: 'wordlist',
+      salesFeed: null,
+      sales: [],
       offlineshop: {
         method: null,
         wordlist: [],
@@ -38,6 +40,7 @@ window.app = Vue.createApp({
   watch: {
     selectedWallet() {
       this.loadShop()
+      this.connectSalesFeed()
     }
   },
   methods: {
@@ -58,12 +61,14 @@ window.app = Vue.createApp({
       let image = new Image()
       image.src = blobURL
       image.onload = async () => {
-        let fit = imgSizeFit(image, 100, 100)
+        // the server makes the small copy for wallets, this one is for the
+        // dashboard
+        let fit = imgSizeFit(image)
         let canvas = document.createElement('canvas')
         canvas.setAttribute('width', fit.width)
         canvas.setAttribute('height', fit.height)
         output = await pica.resize(image, canvas)
-        this.itemDialog.data.image = output.toDataURL('image/jpeg', 0.4)
+        this.itemDialog.data.image = output.toDataURL('image/jpeg', 0.8)
         this.itemDialog = {...this.itemDialog}
       }
     },
@@ -90,13 +95,46 @@ window.app = Vue.createApp({
         )
         .then(response => {
           this.offlineshop = response.data
-          this.confirmationMethod = response.data.method
+          // both variants of the hmac method share a tab
+          this.confirmationMethod =
+            response.data.method === 'hmac_digits'
+              ? 'hmac'
+              : response.data.method
         })
         .catch(err => {
           LNbits.utils.notifyApiError(err)
         })
     },
-    async setMethod() {
+    connectSalesFeed() {
+      if (this.salesFeed) {
+        this.salesFeed.onclose = null
+        this.salesFeed.close()
+      }
+      this.sales = []
+      const url = new URL(
+        '/offlineshop/api/v1/offlineshop/sales',
+        window.location
+      )
+      url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
+      url.searchParams.set('api-key', this.selectedWallet.inkey)
+      this.salesFeed = new WebSocket(url)
+      this.salesFeed.onmessage = ({data}) => {
+        const sale = JSON.parse(data)
+        this.sales.unshift(sale)
+        this.sales.splice(20)
+        this.$q.notify({
+          type: 'positive',
+          message: `Sold ${sale.name}` + (sale.code ? ` (${sale.code})` : ''),
+          timeout: 2000
+        })
+      }
+      this.salesFeed.onclose = () => {
+        setTimeout(() => this.connectSalesFeed(), 5000)
+      }
+    },
+    async setMethod(method) {
+      // the wordlist form passes its submit event
+      if (typeof method !== 'string') method = this.confirmationMethod
       try {
         await LNbits.api.request(
           'PUT',
@@ -104,7 +142,7 @@ window.app = Vue.createApp({
           this.selectedWallet.adminkey,
           {
             wallet: this.selectedWallet.id,
-            method: this.confirmationMethod,
+            method,
             wordlist: this.offlineshop.wordlist
           }
         )
@@ -115,20 +153,22 @@ window.app = Vue.createApp({
 
       this.$q.notify({
         message:
-          `Method set to ${this.confirmationMethod}.` +
-          (this.confirmationMethod === 'wordlist' ? ' Counter reset.' : ''),
+          `Method set to ${method}.` +
+          (method === 'wordlist' ? ' Counter reset.' : ''),
         timeout: 700
       })
       this.loadShop()
     },
     async sendItem() {
-      let {id, name, image, description, price, unit} = this.itemDialog.data
+      let {id, name, image, description, price, unit, pool_size} =
+        this.itemDialog.data
       const data = {
         name,
         description,
         image,
         price,
-        unit
+        unit,
+        pool_size: pool_size || 0
       }
 
       try {
@@ -0,0 +1,184 @@
+import asyncio
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from lnbits.core.models import Payment
+from lnbits.tasks import register_invoice_listener
+from loguru import logger
+
+from .counters import get_shop_code
+from .crud import (
+    cache_ttl,
+    create_sale,
+    get_purchase,
+    load_catalog,
+    sync_catalog,
+)
+from .helpers import split_amount
+from .models import Sale, order_summary
+
+
+class PaymentWaiters:
+    """
+    Lets requests wait for a payment to settle instead of polling for it.
+    """
+
+    def __init__(self) -> None:
+        self._events: dict[str, asyncio.Event] = {}
+        self._waiting: Counter = Counter()
+
+    async def wait(self, payment_hash: str, timeout: float) -> bool:
+        """
+        Returns whether the payment was reported paid within `timeout`.
+        """
+        event = self._events.setdefault(payment_hash, asyncio.Event())
+        self._waiting[payment_hash] += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting[payment_hash] -= 1
+            if not self._waiting[payment_hash]:
+                del self._waiting[payment_hash]
+                del self._events[payment_hash]
+
+    def notify(self, payment_hash: str) -> None:
+        event = self._events.get(payment_hash)
+        if event:
+            event.set()
+
+
+payment_waiters = PaymentWaiters()
+
+
+class SalesFeed:
+    """
+    Fans sales out to the dashboards connected for a shop. Every client gets
+    its own bounded queue and publishing never waits on one: when a client
+    falls behind its oldest sale is dropped, so the others aren't held up.
+    """
+
+    def __init__(self, maxsize: int = 100) -> None:
+        self.maxsize = maxsize
+        self._clients: dict[str, set[asyncio.Queue]] = {}
+
+    @contextmanager
+    def subscribe(self, shop_id: str) -> Iterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue(self.maxsize)
+        self._clients.setdefault(shop_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            clients = self._clients[shop_id]
+            clients.discard(queue)
+            if not clients:
+                del self._clients[shop_id]
+
+    def publish(self, shop_id: str, sale: dict) -> None:
+        for queue in self._clients.get(shop_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(sale)
+
+
+sales_feed = SalesFeed()
+
+
+async def wait_for_paid_invoices():
+    invoice_queue: asyncio.Queue = asyncio.Queue()
+    register_invoice_listener(invoice_queue, "ext_offlineshop")
+
+    while True:
+        payment = await invoice_queue.get()
+        await on_invoice_paid(payment)
+
+
+async def keep_catalog_warm(interval: float = cache_ttl) -> None:
+    """
+    Loads the catalog, then picks up changes made by other workers every
+    `interval` seconds.
+    """
+    seconds = await load_catalog()
+    logger.info(f"offlineshop catalog warmed up in {seconds:.3f}s")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_catalog()
+        except Exception as exc:
+            logger.warning(f"could not sync offlineshop catalog: {exc}")
+
+
+async def on_invoice_paid(payment: Payment) -> None:
+    if not payment.extra or payment.extra.get("tag") != "offlineshop":
+        return
+    payment_waiters.notify(payment.payment_hash)
+
+    purchase = await get_purchase(payment.extra)
+    if not purchase:
+        return
+    shop, lines = purchase
+    # resolved once here, not by every connected dashboard
+    code = await get_shop_code(
+        shop, payment.payment_hash, payment.updated_at.timestamp()
+    )
+
+    # orders carry the share of the payment of each item
+    amounts = payment.extra.get("amounts")
+    if not amounts or len(amounts) != len(lines):
+        amounts = [1] * len(lines)
+    sales = [
+        Sale(
+            payment_hash=payment.payment_hash,
+            shop=shop.id,
+            item=item.id,
+            quantity=quantity,
+            amount_msat=amount_msat,
+            price=item.price,
+            unit=item.unit,
+            code=code,
+            # when it was paid, not when the invoice was created
+            time=payment.updated_at,
+        )
+        for (item, quantity), amount_msat in zip(
+            lines, split_amount(payment.amount, amounts), strict=True
+        )
+    ]
+    recorded = [sale for sale in sales if await create_sale(sale)]
+    if not recorded:
+        # already seen, e.g. redelivered after a restart
+        return
+
+    units = {item.unit for item, _ in lines}
+    if len(units) == 1:
+        [unit] = units
+        price = sum(item.price * quantity for item, quantity in lines)
+    else:
+        unit = "sats"
+        price = payment.amount // 1000
+    sales_feed.publish(
+        shop.id,
+        {
+            "payment_hash": payment.payment_hash,
+            "order": payment.extra.get("order"),
+            "item": lines[0][0].id if len(lines) == 1 else None,
+            "name": order_summary(lines),
+            "price": price,
+            "unit": unit,
+            "amount_msat": payment.amount,
+            "code": code,
+            "time": payment.updated_at.isoformat(),
+            "items": [
+                {
+                    "item": item.id,
+                    "name": item.name,
+                    "quantity": quantity,
+                    "price": item.price,
+                    "unit": item.unit,
+                }
+                for item, quantity in lines
+            ],
+        },
+    )
@@ -0,0 +1,245 @@
+"""
+Load test of the purchase flow: concurrent simulated scans go through
+`lnurl_response`, `lnurl_callback` and `confirmation_code` of an app serving
+the extension, with the LNbits services they call stubbed out.
+
+Run it with `OFFLINESHOP_BENCHMARK=1 pytest tests/test_benchmark.py -s`, see
+`test_benchmark.py` for the other settings.
+"""
+
+import asyncio
+import contextvars
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional
+from unittest.mock import patch
+from urllib.parse import urlparse
+
+import httpx
+from fastapi import FastAPI
+from lnbits.db import Connection
+from lnurl import decode as lnurl_decode
+from lnurl import encode as lnurl_encode
+
+from .. import limits, offlineshop_ext, rates, views, views_lnurl
+from ..crud import create_item, get_or_create_shop_by_wallet
+from ..models import CreateItem
+
+# the example invoice from BOLT 11, only its format matters here
+invoice = (
+    "lnbc1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2"
+    "ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq8rkx3yf5tcsyz3d7"
+    "3gafnh3cax9rn449d9p5uxz9ezhhypd0elx87sjle52x86fux2ypatgddc6k63n7erqz25le42"
+    "c4u4ecky03ylcqca784w"
+)
+endpoints = ["lnurl_response", "lnurl_callback", "confirmation_code"]
+current_endpoint: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_endpoint", default=None
+)
+
+
+@contextmanager
+def stubbed_services(invoice_latency: float = 0, rate: float = 2500):
+    """
+    Replaces invoice creation, payment lookup and exchange rates. Every
+    invoice counts as paid as soon as it is created. All scans come from the
+    same client, so rate limits are off.
+    """
+    payments: dict[str, SimpleNamespace] = {}
+
+    async def create_invoice(*, wallet_id, amount, memo, extra, **_):
+        await asyncio.sleep(invoice_latency)
+        payment_hash = f"{len(payments):064x}"
+        payments[payment_hash] = SimpleNamespace(
+            payment_hash=payment_hash,
+            pending=False,
+            # created ahead of time like pooled invoices, paid now
+            time=datetime.now(timezone.utc) - timedelta(hours=1),
+            updated_at=datetime.now(timezone.utc),
+            extra=extra,
+            amount=amount * 1000,
+        )
+        return SimpleNamespace(payment_hash=payment_hash, bolt11=invoice)
+
+    async def get_standalone_payment(payment_hash, **_):
+        return payments.get(payment_hash)
+
+    async def get_fiat_rate_satoshis(_currency):
+        return rate
+
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(views_lnurl, "create_invoice", create_invoice))
+        stack.enter_context(
+            patch.object(views, "get_standalone_payment", get_standalone_payment)
+        )
+        stack.enter_context(
+            patch.object(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+        )
+        stack.enter_context(
+            patch.object(limits, "rate_limit_backend", limits.NoRateLimitBackend())
+        )
+        yield payments
+
+
+@contextmanager
+def counted_queries():
+    """
+    Counts database statements per endpoint being requested.
+    """
+    counts: Counter = Counter()
+
+    def counting(method):
+        async def wrapper(self, query, *args, **kwargs):
+            # the schema is attached on every connect, that's not a query
+            if not query.lstrip().startswith(("ATTACH", "CREATE SCHEMA")):
+                counts[current_endpoint.get()] += 1
+            return await method(self, query, *args, **kwargs)
+
+        return wrapper
+
+    with ExitStack() as stack:
+        for name in ("fetchall", "fetchone", "execute", "insert", "update"):
+            method = getattr(Connection, name)
+            stack.enter_context(patch.object(Connection, name, counting(method)))
+        yield counts
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def scan(client: httpx.AsyncClient, lnurl: str, timings: dict) -> None:
+    async def get(endpoint: str, url: str) -> httpx.Response:
+        token = current_endpoint.set(endpoint)
+        start = time.perf_counter()
+        try:
+            response = await client.get(url)
+        finally:
+            timings[endpoint].append(time.perf_counter() - start)
+            current_endpoint.reset(token)
+        response.raise_for_status()
+        return response
+
+    pay = (await get("lnurl_response", str(lnurl_decode(lnurl)))).json()
+    assert "callback" in pay, pay
+    url = httpx.URL(pay["callback"]).copy_add_param("amount", pay["minSendable"])
+    action = (await get("lnurl_callback", str(url))).json()
+    assert "pr" in action, action
+    await get("confirmation_code", urlparse(action["successAction"]["url"]).path)
+
+
+async def run_benchmark(
+    scans: int = 200,
+    concurrency: int = 20,
+    items: int = 10,
+    unit: str = "sats",
+    invoice_latency: float = 0,
+) -> dict:
+    """
+    Expects `crud.db` to point to a migrated database.
+    """
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    )
+    shop = await get_or_create_shop_by_wallet("benchmark")
+    assert shop
+    data = CreateItem(name="item", description="an item", price=100, unit=unit)
+    lnurls = []
+    for _ in range(items):
+        item = await create_item(shop.id, data)
+        url = f"https://shop.example.com/offlineshop/lnurl/{item.id}"
+        lnurls.append(lnurl_encode(url))
+
+    timings: dict[str, list[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_scan(i: int):
+        async with semaphore:
+            await scan(client, lnurls[i % len(lnurls)], timings)
+
+    with stubbed_services(invoice_latency):
+        # warm up, so the numbers show the steady state
+        for lnurl in lnurls:
+            await scan(client, lnurl, defaultdict(list))
+        with counted_queries() as queries:
+            start = time.perf_counter()
+            await asyncio.gather(*[limited_scan(i) for i in range(scans)])
+            duration = time.perf_counter() - start
+    await client.aclose()
+
+    return {
+        "scans": scans,
+        "concurrency": concurrency,
+        "unit": unit,
+        "duration": duration,
+        "throughput": scans / duration,
+        "endpoints": {
+            endpoint: {
+                "p50": percentile(timings[endpoint], 50) * 1000,
+                "p95": percentile(timings[endpoint], 95) * 1000,
+                "p99": percentile(timings[endpoint], 99) * 1000,
+                "queries": queries[endpoint] / len(timings[endpoint]),
+            }
+            for endpoint in endpoints
+        },
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """
+    Lists what got slower than `baseline` by more than `tolerance`, or now
+    needs more queries.
+    """
+    regressions = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {report['throughput']:.0f}/s, "
+            f"was {baseline['throughput']:.0f}/s"
+        )
+    for endpoint, stats in report["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if not before:
+            continue
+        for key in ("p50", "p95", "p99"):
+            if stats[key] > before[key] * (1 + tolerance):
+                regressions.append(
+                    f"{endpoint} {key} {stats[key]:.2f}ms, was {before[key]:.2f}ms"
+                )
+        if stats["queries"] > before["queries"]:
+            regressions.append(
+                f"{endpoint} {stats['queries']:.2f} queries, "
+                f"was {before['queries']:.2f}"
+            )
+    return regressions
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['scans']} scans ({report['unit']}), concurrency "
+        f"{report['concurrency']}: {report['throughput']:.0f} scans/s",
+        f"{'endpoint':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}",
+    ]
+    for endpoint, stats in report["endpoints"].items():
+        lines.append(
+            f"{endpoint:<20}{stats['p50']:>10.2f}{stats['p95']:>10.2f}"
+            f"{stats['p99']:>10.2f}{stats['queries']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def save_report(report: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,50 @@
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI
+from starlette.requests import Request
+
+from .. import crud, limits, offlineshop_ext
+from ..catalog import catalog
+from .helpers import migrated_database
+
+
+@pytest_asyncio.fixture
+async def db(tmp_path, monkeypatch):
+    """
+    A fresh, fully migrated sqlite database swapped in for `crud.db`.
+    """
+    database = await migrated_database(str(tmp_path / "ext_offlineshop.sqlite3"))
+    monkeypatch.setattr(crud, "db", database)
+    crud.item_cache.clear()
+    crud.shop_cache.clear()
+    catalog.clear()
+    yield database
+    await database.engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def rate_limits():
+    """
+    Every test starts with full rate limit buckets.
+    """
+    limits.rate_limit_backend.clear()
+
+
+@pytest.fixture
+def request_():
+    """
+    A request against an app serving the extension, for `url_for`.
+    """
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    return Request(
+        {
+            "type": "http",
+            "app": app,
+            "router": app.router,
+            "scheme": "https",
+            "server": ("shop.example.com", 443),
+            "path": "/",
+            "headers": [],
+        }
+    )
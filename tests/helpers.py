@@ -0,0 +1,21 @@
+import inspect
+
+from lnbits.db import Database
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .. import migrations
+
+
+async def migrated_database(path: str) -> Database:
+    """
+    A fresh sqlite database at `path` with all extension migrations applied.
+    """
+    database = Database("ext_offlineshop")
+    database.path = path
+    database.engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    for name, migration in sorted(
+        inspect.getmembers(migrations, inspect.iscoroutinefunction)
+    ):
+        if name.startswith("m"):
+            await migration(database)
+    return database
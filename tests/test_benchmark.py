@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from .benchmark import compare, format_report, load_report, run_benchmark, save_report
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("unit", ["sats", "USD"])
+async def test_purchase_flow_smoke(db, unit):
+    report = await run_benchmark(scans=20, concurrency=5, items=3, unit=unit)
+
+    assert report["throughput"] > 0
+    # items and shops are cached after the first scan
+    assert report["endpoints"]["lnurl_response"]["queries"] == 0
+    assert report["endpoints"]["lnurl_callback"]["queries"] == 0
+    assert compare(report, report) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not os.getenv("OFFLINESHOP_BENCHMARK"), reason="set OFFLINESHOP_BENCHMARK=1"
+)
+async def test_purchase_flow_benchmark(db):
+    """
+    OFFLINESHOP_BENCHMARK_SCANS, _CONCURRENCY, _UNIT and _INVOICE_LATENCY
+    (seconds) configure the run. The report is saved to
+    OFFLINESHOP_BENCHMARK_SAVE and compared to OFFLINESHOP_BENCHMARK_BASELINE
+    if those paths are set.
+    """
+    report = await run_benchmark(
+        scans=int(os.getenv("OFFLINESHOP_BENCHMARK_SCANS", "1000")),
+        concurrency=int(os.getenv("OFFLINESHOP_BENCHMARK_CONCURRENCY", "50")),
+        unit=os.getenv("OFFLINESHOP_BENCHMARK_UNIT", "sats"),
+        invoice_latency=float(os.getenv("OFFLINESHOP_BENCHMARK_INVOICE_LATENCY", "0")),
+    )
+    print()
+    print(format_report(report))
+
+    save_path = os.getenv("OFFLINESHOP_BENCHMARK_SAVE")
+    if save_path:
+        save_report(report, save_path)
+    baseline_path = os.getenv("OFFLINESHOP_BENCHMARK_BASELINE")
+    if baseline_path:
+        regressions = compare(report, load_report(baseline_path))
+        assert not regressions, "\n".join(regressions)
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+from .. import crud
+from ..catalog import Catalog, catalog
+from ..crud import (
+    create_item,
+    create_items,
+    delete_item_from_shop,
+    get_item,
+    get_or_create_shop_by_wallet,
+    get_shop,
+    load_catalog,
+    sync_catalog,
+    update_item,
+)
+from ..models import CreateItem, Item, Shop
+
+
+def make_item(item_id: str, **kwargs) -> Item:
+    values: dict = {
+        "shop": "shop",
+        "id": item_id,
+        "name": "coffee",
+        "description": "x",
+        "image": None,
+        "price": 1000,
+        "unit": "sats",
+    }
+    values.update(kwargs)
+    return Item(**values)
+
+
+def test_freed_slots_are_reused():
+    items = Catalog()
+    items.put_item(make_item("a"))
+    assert items.get_item("a") is None
+
+    items.load([Shop(id="shop", wallet="w", method="wordlist")], [], 0.1)
+    items.put_item(make_item("a"))
+    items.put_item(make_item("b"))
+    items.remove_item("a")
+    items.put_item(make_item("c"))
+    assert len(items._slots) == 2
+    assert items.get_item("a") is None
+    assert items.get_item("c") == make_item("c")
+
+    items.put_item(make_item("b", enabled=False))
+    assert items.get_item("b") is None
+    assert items.stats()["items"] == 1
+
+    items.drop_shop("shop")
+    assert items.stats()["items"] == items.stats()["shops"] == 0
+
+
+def no_queries(*args, **kwargs):
+    raise AssertionError("the catalog should have answered")
+
+
+@pytest.mark.asyncio
+async def test_warm_catalog_answers_reads_and_follows_writes(db, monkeypatch):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1000, unit="sats")
+    item = await create_item(shop.id, data)
+    shop = await get_shop(shop.id)
+    assert await load_catalog() > 0
+    version = catalog.version
+
+    crud.item_cache.clear()
+    crud.shop_cache.clear()
+    with monkeypatch.context() as patched:
+        patched.setattr(db, "fetchone", no_queries)
+        assert await get_item(item.id) == item
+        assert await get_shop(shop.id) == shop
+
+    tea = await create_item(shop.id, data.copy(update={"name": "tea"}))
+    item = await update_item(item.copy(update={"price": 2000}))
+    await delete_item_from_shop(shop.id, tea.id)
+    assert catalog.get_item(item.id) == item
+    assert catalog.get_item(tea.id) is None
+    assert catalog.version > version
+    # writes bump the shop version, the next read brings it back
+    assert catalog.get_shop(shop.id) is None
+    assert (await get_shop(shop.id)) == catalog.get_shop(shop.id)
+
+
+@pytest.mark.asyncio
+async def test_sync_picks_up_writes_of_other_workers(db):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1000, unit="sats")
+    item = await create_item(shop.id, data)
+    await load_catalog()
+    assert await sync_catalog() == 0
+
+    await db.execute(
+        "UPDATE offlineshop.items SET price = 3000, version = version + 1 "
+        "WHERE id = :id",
+        {"id": item.id},
+    )
+    await db.execute(
+        "UPDATE offlineshop.shops SET version = version + 1 WHERE id = :id",
+        {"id": shop.id},
+    )
+    assert await sync_catalog() == 1
+    cached = catalog.get_item(item.id)
+    assert cached and cached.price == 3000
+
+    await db.execute("DELETE FROM offlineshop.shops WHERE id = :id", {"id": shop.id})
+    await sync_catalog()
+    assert catalog.get_item(item.id) is None
+
+
+async def add_items(count: int) -> None:
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x" * 100, price=1000, unit="sats")
+    for _ in range(count // 500):
+        await create_items(shop.id, [(data, None)] * 500)
+
+
+@pytest.mark.asyncio
+async def test_catalog_loads_all_items(db):
+    await add_items(2000)
+
+    seconds = await load_catalog()
+    assert catalog.stats()["items"] == 2000
+    assert catalog.warmup_seconds == seconds
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not os.getenv("OFFLINESHOP_BENCHMARK"), reason="set OFFLINESHOP_BENCHMARK=1"
+)
+async def test_catalog_warmup_benchmark(db):
+    """
+    Time to load a catalog of 2000 items at startup. Run with `-s` to see it.
+    """
+    await add_items(2000)
+
+    seconds = await load_catalog()
+    print(f"catalog of 2000 items warmed up in {seconds * 1000:.1f}ms")
@@ -0,0 +1,40 @@
+import pytest
+
+from ..counters import DatabaseCounterBackend
+from ..crud import create_shop
+from ..models import CreateShop
+
+
+@pytest.mark.asyncio
+async def test_database_counter_issues_words_in_order(db):
+    shop = await create_shop(CreateShop(wallet="w", wordlist="a\nb\nc"))
+    backend = DatabaseCounterBackend()
+
+    words = [await backend.get_word(shop, f"hash{i}") for i in range(4)]
+
+    assert words == ["a", "b", "c", "a"]
+
+
+@pytest.mark.asyncio
+async def test_database_counter_is_stable_per_payment(db):
+    shop = await create_shop(CreateShop(wallet="w", wordlist="a\nb\nc"))
+
+    # separate backend instances stand in for separate workers
+    first = await DatabaseCounterBackend().get_word(shop, "hash")
+    again = await DatabaseCounterBackend().get_word(shop, "hash")
+    other = await DatabaseCounterBackend().get_word(shop, "other")
+
+    assert first == again == "a"
+    assert other == "b"
+
+
+@pytest.mark.asyncio
+async def test_database_counter_reset(db):
+    shop = await create_shop(CreateShop(wallet="w", wordlist="a\nb\nc"))
+    backend = DatabaseCounterBackend()
+    await backend.get_word(shop, "hash0")
+    await backend.get_word(shop, "hash1")
+
+    await backend.reset(shop)
+
+    assert await backend.get_word(shop, "hash2") == "a"
@@ -0,0 +1,198 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from ..crud import (
+    Transaction,
+    create_image,
+    create_item,
+    create_sale,
+    delete_item_from_shop,
+    get_daily_sales,
+    get_image,
+    get_item,
+    get_item_metadata,
+    get_item_sales,
+    get_items_by_ids,
+    item_cache,
+    search_items,
+    update_item,
+)
+from ..models import CreateItem, ItemSearch, Sale
+
+
+@pytest.mark.asyncio
+async def test_get_items_by_ids_keeps_order_and_skips_missing(db):
+    data = CreateItem(name="x", description="x", price=1, unit="sats")
+    one = await create_item("shop", data)
+    two = await create_item("shop", data)
+
+    items = await get_items_by_ids([two.id, "missing", one.id, two.id])
+
+    assert [item.id for item in items] == [two.id, one.id, two.id]
+    assert await get_items_by_ids([]) == []
+
+
+@pytest.mark.asyncio
+async def test_images_are_stored_once_and_cleaned_up(db):
+    data = CreateItem(name="x", description="x", price=1, unit="sats")
+    image_hash = await create_image("image/png", b"png")
+    assert await create_image("image/png", b"png") == image_hash
+    item = await create_item("shop", data, image_hash)
+
+    image = await get_image(image_hash)
+    assert image
+    assert image.data_uri == "data:image/png;base64,cG5n"
+
+    await delete_item_from_shop("shop", item.id)
+    assert await get_image(image_hash) is None
+
+
+@pytest.mark.asyncio
+async def test_edits_only_delete_the_image_they_replace(db):
+    data = CreateItem(name="x", description="x", price=1, unit="sats")
+    shared = await create_image("image/png", b"shared")
+    one = await create_item("shop", data, shared)
+    two = await create_item("shop", data, shared)
+    # stored for an item that is still being created
+    pending = await create_image("image/png", b"pending")
+
+    await update_item(one.copy(update={"image_hash": None}))
+    await delete_item_from_shop("shop", "missing")
+    assert await get_image(shared)
+    assert await get_image(pending)
+
+    await update_item(two.copy(update={"image_hash": None}))
+    assert await get_image(shared) is None
+    assert await get_image(pending)
+
+
+@pytest.mark.asyncio
+async def test_edits_from_outdated_copies_get_new_versions(db):
+    data = CreateItem(name="x", description="first", price=1, unit="sats")
+    item = await create_item("shop", data)
+    # two workers editing the same cached copy
+    first = await update_item(item.copy(update={"description": "one"}))
+    second = await update_item(item.copy(update={"description": "two"}))
+
+    assert (first.version, second.version) == (1, 2)
+    item_cache.clear()
+    stored = await get_item(item.id)
+    assert stored and stored.version == 2
+    metadata = await get_item_metadata(stored)
+    assert "two" in metadata
+
+
+@pytest.mark.asyncio
+async def test_sales_roll_up_per_item_and_day(db):
+    def sale(payment_hash, item, day, price=2.5, unit="EUR"):
+        return Sale(
+            payment_hash=payment_hash,
+            shop="shop",
+            item=item,
+            amount_msat=1000,
+            price=price,
+            unit=unit,
+            code="apple",
+            time=datetime(2024, 5, day, 23, 30, tzinfo=timezone.utc),
+        )
+
+    assert await create_sale(sale("a", "coffee", 1))
+    assert await create_sale(sale("b", "coffee", 1))
+    assert await create_sale(sale("c", "coffee", 2))
+    assert await create_sale(sale("d", "tea", 2, price=100, unit="sats"))
+    assert await create_sale(sale("e", "coffee", 3))
+    # recorded once, however often the payment is reported
+    assert not await create_sale(sale("a", "coffee", 1))
+
+    days = await get_daily_sales("shop", "2024-05-01", "2024-05-02")
+    assert [(d.day, d.item, d.sales, d.amount_msat, d.price_total) for d in days] == [
+        ("2024-05-01", "coffee", 2, 2000, 5.0),
+        ("2024-05-02", "coffee", 1, 1000, 2.5),
+        ("2024-05-02", "tea", 1, 1000, 100),
+    ]
+    assert await get_daily_sales("other", "2024-05-01", "2024-05-31") == []
+
+    items = await get_item_sales("shop", "2024-05-01", "2024-05-31", item="coffee")
+    assert [(i.item, i.unit, i.sales, i.price_total) for i in items] == [
+        ("coffee", "EUR", 4, 10.0)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sale_is_not_recorded_without_its_totals(db, monkeypatch):
+    execute = Transaction.execute
+
+    async def failing_rollup(self, query, values=None):
+        if "sales_daily" in query:
+            raise RuntimeError("rollup failed")
+        return await execute(self, query, values)
+
+    monkeypatch.setattr(Transaction, "execute", failing_rollup)
+    sale = Sale(
+        payment_hash="a",
+        shop="shop",
+        item="coffee",
+        amount_msat=1000,
+        price=1,
+        unit="sats",
+        code="apple",
+        time=datetime(2024, 5, 1, tzinfo=timezone.utc),
+    )
+    with pytest.raises(RuntimeError):
+        await create_sale(sale)
+
+    monkeypatch.setattr(Transaction, "execute", execute)
+    # the ledger insert was rolled back, so the retry counts the sale
+    assert await create_sale(sale)
+    [day] = await get_daily_sales("shop", "2024-05-01", "2024-05-01")
+    assert day.sales == 1
+
+
+@pytest.mark.asyncio
+async def test_search_items_matches_filters_and_sorts_stably(db):
+    async def add(name: str, description: str, price: float, unit: str = "sats"):
+        data = CreateItem(name=name, description=description, price=price, unit=unit)
+        return await create_item("shop", data)
+
+    espresso = await add("Espresso", "strong coffee", 300)
+    latte = await add("Latte", "coffee with milk", 450)
+    tea = await add("Green tea", "loose leaves", 2.5, unit="EUR")
+    cake = await add("Cake", "goes well with coffee", 450)
+    await create_item(
+        "other", CreateItem(name="Coffee", description="x", price=1, unit="sats")
+    )
+
+    async def search(**kwargs) -> list[str]:
+        return [item.name for item in await search_items("shop", ItemSearch(**kwargs))]
+
+    assert await search(text="coff") == ["Cake", "Espresso", "Latte"]
+    assert await search(text="coffee mil") == ["Latte"]
+    assert await search(text="LEAF") == []
+    assert await search(text="leav") == ["Green tea"]
+    assert await search(unit="EUR") == ["Green tea"]
+    assert await search(min_price=400, max_price=500) == ["Cake", "Latte"]
+
+    # equal prices are ordered by id, in both directions
+    by_price = await search(sort="price", descending=True, unit="sats")
+    tied = sorted([latte, cake], key=lambda item: item.id, reverse=True)
+    assert by_price == [*[item.name for item in tied], "Espresso"]
+    pages = [await search(sort="price", limit=2, offset=offset) for offset in (0, 2)]
+    assert sorted(name for page in pages for name in page) == [
+        "Cake",
+        "Espresso",
+        "Green tea",
+        "Latte",
+    ]
+
+    # the text index follows updates and deletes
+    await update_item(espresso.copy(update={"enabled": False, "name": "Ristretto"}))
+    await delete_item_from_shop("shop", tea.id)
+    assert await search(text="espresso") == []
+    assert await search(text="ristr", enabled=False) == ["Ristretto"]
+    assert await search(enabled=True, text="leaves") == []
+
+    # VACUUM may renumber rowids, without firing any trigger
+    await db.execute("DROP TRIGGER offlineshop.items_fts_update")
+    await db.execute("UPDATE offlineshop.items SET rowid = rowid + 100")
+    assert await search(text="coff") == ["Cake", "Latte", "Ristretto"]
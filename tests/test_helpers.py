@@ -0,0 +1,202 @@
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import random
+import time
+from collections import Counter
+from itertools import pairwise
+
+import pytest
+from PIL import Image
+
+from ..helpers import (
+    TOTP,
+    TTLCache,
+    hmac_code,
+    hotp,
+    iter_csv_rows,
+    make_thumbnail,
+    split_amount,
+    thumbnail_size,
+)
+from ..wordlists import animals, get_wordlist, normalize_wordlist
+
+
+def test_ttl_cache_counts_hits_and_misses():
+    cache = TTLCache(maxsize=2, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_invalidate():
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None
+
+
+def test_default_wordlist_is_not_stored():
+    assert normalize_wordlist(None) is None
+    assert normalize_wordlist("\n".join(animals) + "\n") is None
+    assert normalize_wordlist("a\nb") == "a\nb"
+
+
+def test_wordlists_are_parsed_once_and_shared():
+    assert get_wordlist(None) is get_wordlist("\n".join(animals))
+    text = "apple\nbanana\ncoconut"
+    assert get_wordlist(text) == ("apple", "banana", "coconut")
+    # an equal but distinct string hits the cache
+    other = "\n".join(["apple", "banana", "coconut"])
+    assert other == text and other is not text
+    assert get_wordlist(other) is get_wordlist(text)
+    # words are shared between different wordlists too
+    assert get_wordlist("apple\nkiwi")[0] is get_wordlist(text)[0]
+
+
+def test_totp_matches_rfc_6238_and_hotp():
+    key = b"12345678901234567890"
+    otp = TOTP(key, digits=8)
+    assert otp.at(59) == "94287082"
+    assert otp.at(1111111109) == "07081804"
+
+    b32key = base64.b32encode(key).decode()
+    assert TOTP(key).code(42) == hotp(b32key, 42)
+
+
+def test_totp_verify_window():
+    otp = TOTP(b"key")
+    now = 1_700_000_000
+    assert otp.verify(otp.at(now), now) == 0
+    assert otp.verify(otp.at(now - 60), now, window=2) == -2
+    assert otp.verify(otp.at(now + 30), now, window=2) == 1
+    assert otp.verify(otp.at(now - 90), now, window=2) is None
+    assert otp.verify("nope", now) is None
+
+
+def test_split_amount_adds_up():
+    assert split_amount(5000, [2000, 3000]) == [2000, 3000]
+    assert split_amount(4999, [2000, 3000]) == [1999, 3000]
+    assert split_amount(1000, [1, 1, 1]) == [333, 333, 334]
+    assert split_amount(1000, [0, 0]) == [500, 500]
+
+
+def encode_image(image: Image.Image, image_format: str, **options) -> bytes:
+    content = io.BytesIO()
+    image.save(content, image_format, **options)
+    return content.getvalue()
+
+
+def test_thumbnails_are_small_opaque_jpegs():
+    png = encode_image(Image.new("RGBA", (1200, 600), (255, 0, 0, 0)), "PNG")
+    thumbnail = Image.open(io.BytesIO(make_thumbnail(png)))
+    assert thumbnail.format == "JPEG"
+    assert thumbnail.size == (thumbnail_size, thumbnail_size // 2)
+    # transparent pixels are white
+    assert thumbnail.getpixel((0, 0)) == (255, 255, 255)
+
+    small = encode_image(Image.new("RGB", (32, 32), "blue"), "JPEG", quality=20)
+    assert make_thumbnail(small) == small
+
+    with pytest.raises(ValueError):
+        make_thumbnail(b"png")
+
+
+def random_hashes(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [f"{rng.getrandbits(256):064x}" for _ in range(count)]
+
+
+def chi_square(counts: Counter, buckets: int) -> float:
+    expected = sum(counts.values()) / buckets
+    return sum((counts[b] - expected) ** 2 / expected for b in range(buckets))
+
+
+def test_hmac_codes_are_uniform_over_words_and_digits():
+    mac = hmac.new(b"key", digestmod="sha256")
+    words = get_wordlist(None)
+    hashes = random_hashes(20_000)
+
+    picked = Counter(words.index(hmac_code(mac, h, words)) for h in hashes)
+    # 99.9th percentile of the chi-square distribution with 25 degrees of
+    # freedom, a fair mapping fails this one time in a thousand
+    assert len(words) == 26
+    assert chi_square(picked, len(words)) < 52.6
+
+    codes = [hmac_code(mac, h) for h in hashes]
+    assert all(len(code) == 6 and code.isdigit() for code in codes)
+    first_digits = Counter(int(code[0]) for code in codes)
+    last_digits = Counter(int(code[-1]) for code in codes)
+    # 99.9th percentile with 9 degrees of freedom
+    assert chi_square(first_digits, 10) < 27.9
+    assert chi_square(last_digits, 10) < 27.9
+
+
+def test_hmac_code_collisions_match_the_code_space():
+    mac = hmac.new(b"key", digestmod="sha256")
+    other = hmac.new(b"other key", digestmod="sha256")
+    words = get_wordlist(None)
+    hashes = random_hashes(20_000, seed=1)
+
+    # consecutive payments share a word about one time in 26
+    pairs = list(pairwise(hashes))
+    same = sum(hmac_code(mac, a, words) == hmac_code(mac, b, words) for a, b in pairs)
+    assert abs(same / len(pairs) - 1 / 26) < 0.01
+
+    # six digit codes of 20k payments collide about C(20k, 2) / 10^6 times
+    codes = Counter(hmac_code(mac, h) for h in hashes)
+    collisions = sum(n * (n - 1) // 2 for n in codes.values())
+    assert 100 < collisions < 300
+
+    # another key gives unrelated codes for the same payment
+    agree = sum(hmac_code(mac, h, words) == hmac_code(other, h, words) for h in hashes)
+    assert abs(agree / len(hashes) - 1 / 26) < 0.01
+
+    # deterministic, and the mac state isn't consumed
+    assert hmac_code(mac, hashes[0]) == hmac_code(mac, hashes[0])
+    expected = hmac.new(b"key", hashes[0].encode(), hashlib.sha256).digest()
+    value = int.from_bytes(expected[:8], "big")
+    assert hmac_code(mac, hashes[0]) == str(value % 10**6).zfill(6)
+
+
+@pytest.mark.asyncio
+async def test_csv_rows_match_the_csv_module():
+    text = (
+        'a,b"c,d\n'
+        '"multi\nline ""quoted""",x\n'
+        "\n"
+        '"closed"",still open\n",y\n'
+        'z,"unterminated\n'
+    )
+
+    async def lines():
+        for line in text.split("\n"):
+            yield line
+
+    rows = [row async for row in iter_csv_rows(lines())]
+    assert rows == [row for row in csv.reader(io.StringIO(text)) if row]
+    assert rows[0] == ["a", 'b"c', "d"]
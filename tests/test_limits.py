@@ -0,0 +1,156 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import limits, offlineshop_ext, views
+from ..crud import create_item, get_or_create_shop_by_wallet
+from ..limits import (
+    DatabaseRateLimitBackend,
+    Limit,
+    MemoryRateLimitBackend,
+)
+from ..models import CreateItem
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_refills_over_time(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(limits.time, "monotonic", lambda: now)
+    backend = MemoryRateLimitBackend()
+    limit = Limit(rate=0.5, burst=3)
+
+    assert [await backend.allow("a", limit) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    assert await backend.allow("b", limit)
+
+    now += 2
+    assert await backend.allow("a", limit)
+    assert not await backend.allow("a", limit)
+
+
+@pytest.mark.asyncio
+async def test_token_buckets_are_bounded():
+    backend = MemoryRateLimitBackend(maxsize=2)
+    limit = Limit(rate=0, burst=1)
+
+    assert await backend.allow("scan:a", limit)
+    assert await backend.allow("scan:b", limit)
+    assert not await backend.allow("scan:a", limit)
+    assert await backend.allow("scan:c", limit)
+    # "b" was the least recently used, so it starts over
+    assert list(backend._buckets["scan"]) == ["scan:a", "scan:c"]
+    assert await backend.allow("scan:b", limit)
+
+
+@pytest.mark.asyncio
+async def test_scans_dont_evict_invoice_buckets():
+    backend = MemoryRateLimitBackend(maxsize=2)
+    limit = Limit(rate=0, burst=1)
+
+    assert await backend.allow("invoices:client", limit)
+    for n in range(10):
+        await backend.allow(f"scan:client:{n}", limit)
+    assert not await backend.allow("invoices:client", limit)
+
+
+@pytest.mark.asyncio
+async def test_scans_of_random_ids_are_limited_per_client(db, monkeypatch):
+    monkeypatch.setattr(limits, "client_scan_limit", Limit(rate=0, burst=5))
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+
+    async def scan(client: str, item_id: str) -> str:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=(client, 1234)),
+            base_url="https://shop.example.com",
+        ) as http:
+            response = await http.get(f"/offlineshop/lnurl/{item_id}")
+            return response.json()["reason"]
+
+    reasons = [await scan("10.0.0.1", f"random{n}") for n in range(6)]
+    assert reasons[:5] == ["Item not found."] * 5
+    assert reasons[5].startswith("Too many requests")
+    assert await scan("10.0.0.2", "random") == "Item not found."
+
+
+@pytest.mark.asyncio
+async def test_database_backend_counts_fixed_windows(db):
+    backend = DatabaseRateLimitBackend()
+    limit = Limit(rate=1 / 3600, burst=2)
+
+    assert [await backend.allow("a", limit) for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+    assert await backend.allow("b", limit)
+
+
+@pytest.mark.asyncio
+async def test_flooding_client_gets_lnurl_error(db, monkeypatch):
+    monkeypatch.setattr(limits, "invoice_limit", Limit(rate=0, burst=2))
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    item = await create_item(
+        shop.id, CreateItem(name="coffee", description="x", price=1, unit="sats")
+    )
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+
+    async def callback(client: str) -> dict:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=(client, 1234)),
+            base_url="https://shop.example.com",
+        ) as http:
+            url = f"/offlineshop/lnurl/cb/{item.id}"
+            response = await http.get(url, params={"amount": 1})
+            return response.json()
+
+    for _ in range(2):
+        assert "smaller than minimum" in (await callback("10.0.0.1"))["reason"]
+    assert (await callback("10.0.0.1"))["reason"].startswith("Too many requests")
+    # other clients are not affected
+    assert "smaller than minimum" in (await callback("10.0.0.2"))["reason"]
+
+
+@pytest.mark.asyncio
+async def test_confirmation_pages_are_limited_per_client(db, monkeypatch):
+    monkeypatch.setattr(limits, "confirmation_limit", Limit(rate=0, burst=2))
+
+    async def missing_payment(*_, **__):
+        return None
+
+    monkeypatch.setattr(views, "get_standalone_payment", missing_payment)
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+
+    async def confirmation(client: str, payment_hash: str) -> int:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, client=(client, 1234)),
+            base_url="https://shop.example.com",
+        ) as http:
+            response = await http.get(f"/offlineshop/confirmation/{payment_hash}")
+            return response.status_code
+
+    assert await confirmation("10.0.0.1", "a") == 404
+    assert await confirmation("10.0.0.1", "b") == 404
+    assert await confirmation("10.0.0.1", "c") == 429
+    assert await confirmation("10.0.0.2", "c") == 404
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    ) as http:
+        response = await http.get("/offlineshop/confirmation/a", params={"wait": 60})
+    assert response.status_code == 422
+
+
+def test_rate_limit_backends_implement_allow():
+    class Incomplete(limits.RateLimitBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()  # type: ignore[abstract]
@@ -0,0 +1,64 @@
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+
+from .. import metrics as metrics_module
+from ..metrics import InstrumentedRoute, metrics, span
+from ..views_lnurl import lnurl_error
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics_module, "metrics_enabled", True)
+    metrics.clear()
+    yield
+    metrics.clear()
+
+
+def test_disabled_span_records_nothing():
+    metrics.clear()
+    with span("stage"):
+        pass
+    assert span("stage") is span("other")
+    assert metrics.histograms == {}
+
+
+def test_span_and_error_counters(enabled):
+    with span("create_invoice"):
+        pass
+    lnurl_error("item_not_found", "Item not found.")
+    lnurl_error("item_not_found", "Item not found.")
+
+    text = metrics.render(
+        {"offlineshop_items_cache_size": 3}, {"offlineshop_items_cache_hits_total": 5}
+    )
+
+    assert 'offlineshop_stage_seconds_count{stage="create_invoice"} 1' in text
+    assert 'offlineshop_stage_seconds_bucket{stage="create_invoice",le="+Inf"} 1' in (
+        text
+    )
+    assert 'offlineshop_lnurl_errors_total{reason="item_not_found"} 2' in text
+    assert "# TYPE offlineshop_items_cache_size gauge" in text
+    assert "# TYPE offlineshop_items_cache_hits_total counter" in text
+    assert "offlineshop_items_cache_hits_total 5" in text
+
+
+@pytest.mark.asyncio
+async def test_instrumented_route(enabled):
+    router = APIRouter(route_class=InstrumentedRoute)
+
+    @router.get("/ok", name="ok")
+    async def ok():
+        return {}
+
+    app = FastAPI()
+    app.include_router(router)
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        await client.get("/ok")
+        await client.get("/ok")
+
+    text = metrics.render({})
+    assert 'offlineshop_requests_total{endpoint="ok",status="200"} 2' in text
+    assert 'offlineshop_request_seconds_count{endpoint="ok"} 2' in text
@@ -0,0 +1,165 @@
+import pytest
+
+from .. import migrations
+from ..crud import create_shop, get_or_create_shop_by_wallet
+from ..models import CreateShop
+
+
+async def query_plan(db, query: str, values: dict) -> str:
+    rows = await db.fetchall(f"EXPLAIN QUERY PLAN {query}", values)
+    return "\n".join(row["detail"] for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_shop_lookup_by_wallet_uses_index(db):
+    plan = await query_plan(
+        db, "SELECT * FROM offlineshop.shops WHERE wallet = :wallet", {"wallet": "w"}
+    )
+    assert "USING INDEX shops_wallet" in plan
+
+
+@pytest.mark.asyncio
+async def test_item_queries_use_index(db):
+    plan = await query_plan(
+        db,
+        """
+        SELECT * FROM offlineshop.items
+        WHERE shop = :shop AND id > :cursor ORDER BY id LIMIT 10
+        """,
+        {"shop": "s", "cursor": ""},
+    )
+    assert "items_shop_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+    plan = await query_plan(
+        db,
+        "DELETE FROM offlineshop.items WHERE shop = :shop AND id = :id",
+        {"shop": "s", "id": "i"},
+    )
+    assert "SCAN" not in plan
+
+
+@pytest.mark.asyncio
+async def test_one_shop_per_wallet(db):
+    first = await get_or_create_shop_by_wallet("wallet")
+    second = await create_shop(CreateShop(wallet="wallet"))
+
+    assert first
+    assert second.id == first.id
+    assert second.code_key == first.code_key
+
+
+@pytest.mark.asyncio
+async def test_item_search_uses_indexes(db):
+    plan = await query_plan(
+        db,
+        """
+        SELECT * FROM offlineshop.items WHERE shop = :shop AND id IN (
+            SELECT id FROM offlineshop.items_fts WHERE items_fts MATCH :match
+        )
+        """,
+        {"shop": "s", "match": '"coff"*'},
+    )
+    assert "VIRTUAL TABLE INDEX" in plan
+
+    plan = await query_plan(
+        db,
+        """
+        SELECT * FROM offlineshop.items WHERE shop = :shop AND price >= :price
+        ORDER BY price, id LIMIT 10
+        """,
+        {"shop": "s", "price": 100},
+    )
+    assert "items_shop_price" in plan
+
+
+@pytest.mark.asyncio
+async def test_duplicate_shops_are_merged(db):
+    await db.execute("DROP INDEX offlineshop.shops_wallet")
+    await db.execute("DROP INDEX offlineshop.items_shop_id")
+    await db.execute("DROP INDEX offlineshop.codes_shop_time")
+    for shop_id, items in (("a", 1), ("b", 2), ("c", 0), ("d", 0)):
+        await db.execute(
+            """
+            INSERT INTO offlineshop.shops (id, wallet, method)
+            VALUES (:id, :wallet, 'wordlist')
+            """,
+            {"id": shop_id, "wallet": "w1" if shop_id < "c" else "w2"},
+        )
+        for n in range(items):
+            await db.execute(
+                """
+                INSERT INTO offlineshop.items (shop, id, name, description, price, unit)
+                VALUES (:shop, :id, 'x', 'x', 1, 'sats')
+                """,
+                {"shop": shop_id, "id": f"item-{shop_id}{n}"},
+            )
+        await db.execute(
+            """
+            INSERT INTO offlineshop.codes (payment_hash, shop, code, time)
+            VALUES (:hash, :shop, 'code', :time)
+            """,
+            {"hash": f"hash-{shop_id}", "shop": shop_id, "time": f"2024-05-0{items}"},
+        )
+    await db.execute(
+        "UPDATE offlineshop.codes SET time = '2024-06-01' WHERE shop = 'd'"
+    )
+
+    await migrations.m009_lookup_indexes(db)
+
+    shops = await db.fetchall("SELECT id FROM offlineshop.shops ORDER BY id")
+    items = await db.fetchall("SELECT DISTINCT shop FROM offlineshop.items")
+    codes = await db.fetchall(
+        "SELECT shop FROM offlineshop.codes ORDER BY payment_hash"
+    )
+    # the shop with more items wins, then the one used last
+    assert [shop["id"] for shop in shops] == ["b", "d"]
+    assert [item["shop"] for item in items] == ["b"]
+    assert [code["shop"] for code in codes] == ["b", "b", "d", "d"]
+
+
+@pytest.mark.asyncio
+async def test_images_of_other_types_are_dropped(db):
+    for content_hash, mime in (("a", "image/png"), ("b", "text/html")):
+        await db.execute(
+            """
+            INSERT INTO offlineshop.images (hash, mime, data)
+            VALUES (:hash, :mime, 'eA==')
+            """,
+            {"hash": content_hash, "mime": mime},
+        )
+        await db.execute(
+            """
+            INSERT INTO offlineshop.items
+            (shop, id, name, description, price, unit, image_hash)
+            VALUES ('s', :hash, 'x', 'x', 1, 'sats', :hash)
+            """,
+            {"hash": content_hash},
+        )
+
+    await migrations.m016_image_mime_allowlist(db)
+
+    images = await db.fetchall("SELECT hash FROM offlineshop.images")
+    items = await db.fetchall("SELECT id, image_hash FROM offlineshop.items")
+    assert [image["hash"] for image in images] == ["a"]
+    assert {item["id"]: item["image_hash"] for item in items} == {"a": "a", "b": None}
+
+
+@pytest.mark.asyncio
+async def test_shops_get_random_code_keys(db):
+    await db.execute("ALTER TABLE offlineshop.shops DROP COLUMN code_key")
+    for shop_id in ("a", "b"):
+        await db.execute(
+            """
+            INSERT INTO offlineshop.shops (id, wallet, method)
+            VALUES (:id, :id, 'hmac')
+            """,
+            {"id": shop_id},
+        )
+
+    await migrations.m019_shop_code_keys(db)
+
+    shops = await db.fetchall("SELECT code_key FROM offlineshop.shops")
+    keys = {shop["code_key"] for shop in shops}
+    assert len(keys) == 2
+    assert all(len(bytes.fromhex(key)) == 32 for key in keys)
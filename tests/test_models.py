@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import io
+import os
+import time
+
+import pytest
+from lnurl import decode as lnurl_decode
+from lnurl import encode as lnurl_encode
+from PIL import Image
+
+from ..crud import create_image, get_image, get_item_metadata
+from ..helpers import hotp, make_thumbnail
+from ..models import (
+    Item,
+    ItemSnapshot,
+    Shop,
+    code_cache,
+    encode_lnurls,
+    otp_cache,
+)
+
+
+def make_item(**kwargs) -> Item:
+    values: dict = {
+        "shop": "shop",
+        "id": "item1",
+        "name": "coffee",
+        "description": "a cup of coffee",
+        "image": None,
+        "price": 1000,
+        "unit": "sats",
+    }
+    values.update(kwargs)
+    return Item(**values)
+
+
+def test_encode_lnurls_matches_single_item_lnurl(request_):
+    items = [make_item(id="item1"), make_item(id="item2")]
+
+    lnurls = encode_lnurls(request_, items)
+
+    assert lnurls == [item.lnurl(request_) for item in items]
+    assert str(lnurl_decode(lnurls[1])) == (
+        "https://shop.example.com/offlineshop/lnurl/item2"
+    )
+
+
+@pytest.mark.asyncio
+async def test_lnurlpay_metadata_is_cached_per_version(db):
+    content = b"\x89PNG"
+    image_hash = await create_image("image/png", content)
+    item = make_item(image_hash=image_hash)
+
+    metadata = await get_item_metadata(item)
+
+    assert await get_item_metadata(item) is metadata
+    image = ("image/png;base64", base64.b64encode(content).decode())
+    assert image in metadata.list()
+    changed = await get_item_metadata(make_item(image_hash=None, version=1))
+    assert changed != metadata
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not os.getenv("OFFLINESHOP_BENCHMARK"), reason="set OFFLINESHOP_BENCHMARK=1"
+)
+async def test_lnurlpay_metadata_benchmark(db, request_):
+    """
+    Per-item cost of the derived LNURL values with and without memoization,
+    for an item carrying a ~100kb image. Run with `-s` to see the numbers.
+    """
+    image_hash = await create_image("image/jpeg", b"\xff" * 75_000)
+    image = (await get_image(image_hash)).data_uri  # type: ignore
+    items = [make_item(id=f"bench{i}", image_hash=image_hash) for i in range(200)]
+
+    start = time.perf_counter()
+    for item in items:
+        url = request_.url_for("offlineshop.lnurl_response", item_id=item.id)
+        lnurl_encode(str(url))
+        item.build_lnurlpay_metadata(image)
+    uncached = (time.perf_counter() - start) / len(items)
+
+    encode_lnurls(request_, items)
+    for item in items:
+        await get_item_metadata(item)
+    start = time.perf_counter()
+    encode_lnurls(request_, items)
+    for item in items:
+        await get_item_metadata(item)
+    cached = (time.perf_counter() - start) / len(items)
+
+    print(f"per item: uncached {uncached * 1e6:.1f}us, cached {cached * 1e6:.1f}us")
+    assert cached < uncached
+
+
+def test_totp_code_is_taken_at_payment_time():
+    otp_cache.clear()
+    shop = Shop(id="shop", wallet="wallet", method="totp")
+    legacy_key = base64.b32encode(hashlib.sha256(b"otpkeyshopwallet").digest()).decode(
+        "ascii"
+    )
+
+    assert shop.otp_key == legacy_key
+    assert shop.otp is Shop(id="shop", wallet="wallet", method="totp").otp
+
+    paid_at = time.time() - 120
+    code = shop.get_code("hash", paid_at)
+    assert code == hotp(legacy_key, int(paid_at / 30))
+    assert shop.otp.verify(code, time.time(), window=4) == -4
+
+
+def test_item_snapshot_round_trips_through_signed_token():
+    item = make_item(version=3, price=1.5, unit="USD")
+    snapshot = ItemSnapshot.of(item)
+    token = snapshot.token()
+
+    assert ItemSnapshot.from_token(token) == snapshot
+    assert snapshot.metadata == item.build_lnurlpay_metadata()
+    tampered = token.replace(token[5], "A" if token[5] != "A" else "B", 1)
+    assert ItemSnapshot.from_token(tampered) is None
+    assert ItemSnapshot.from_token("garbage") is None
+
+    # the image has to come from the database, and long texts make dense codes
+    assert ItemSnapshot.of(make_item(image_hash="abc")).metadata is None
+    assert ItemSnapshot.of(make_item(description="x" * 500)).metadata is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not os.getenv("OFFLINESHOP_BENCHMARK"), reason="set OFFLINESHOP_BENCHMARK=1"
+)
+async def test_thumbnail_metadata_benchmark(db):
+    """
+    Size of the lnurlpay metadata for an item with a photo and the time to
+    encode and hash it for an invoice, with the original and the thumbnail.
+    Run with `-s` to see the numbers.
+    """
+    photo = Image.effect_mandelbrot((1024, 768), (-2, -1.2, 1, 1.2), 100)
+    content = io.BytesIO()
+    photo.convert("RGB").save(content, "JPEG", quality=90)
+    image_hash = await create_image(
+        "image/jpeg",
+        content.getvalue(),
+        make_thumbnail(content.getvalue()),
+    )
+    image = await get_image(image_hash)
+    assert image
+
+    results = {}
+    for name, uri in (("original", image.data_uri), ("thumbnail", image.metadata_uri)):
+        start = time.perf_counter()
+        for _ in range(100):
+            metadata = make_item(image_hash=image_hash).build_lnurlpay_metadata(uri)
+            hashlib.sha256(metadata.encode()).digest()
+        results[name] = (len(metadata.encode()), (time.perf_counter() - start) / 100)
+    for name, (size, seconds) in results.items():
+        print(f"{name}: metadata {size / 1024:.1f}kb, encoded in {seconds * 1e6:.0f}us")
+    assert results["thumbnail"][0] < results["original"][0] / 2
+    assert results["thumbnail"][1] < results["original"][1]
+
+
+def test_hmac_codes_need_no_shared_state():
+    key = "ab" * 32
+    shop = Shop(id="shop", wallet="wallet", method="hmac", code_key=key)
+    words = shop.get_code("hash1")
+    assert words in shop.words
+
+    # another worker, or a restart, derives the same codes from the stored key
+    code_cache.clear()
+    again = Shop(id="shop", wallet="wallet", method="hmac", code_key=key)
+    assert again.get_code("hash1") == words
+    digits = Shop(
+        id="shop", wallet="wallet", method="hmac_digits", code_key=key
+    ).get_code("hash1")
+    assert len(digits) == 6 and digits.isdigit()
+
+    # the key is random, not derived from the ids
+    other = Shop(id="shop", wallet="wallet", method="hmac_digits")
+    assert other.code_key != key
+    assert other.get_code("hash1") != digits
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from lnbits.decorators import require_invoice_key
+from lnurl import decode as lnurl_decode
+
+from .. import offlineshop_ext
+from ..crud import create_item, get_daily_sales, get_or_create_shop_by_wallet
+from ..models import CreateItem
+from ..rates import rate_snapshots
+from ..tasks import on_invoice_paid
+from .benchmark import stubbed_services
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="wallet"))
+    app.dependency_overrides[require_invoice_key] = lambda: key_info
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    )
+
+
+@pytest.mark.asyncio
+async def test_order_is_paid_with_one_invoice(db, client):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    coffee = await create_item(
+        shop.id, CreateItem(name="coffee", description="x", price=1000, unit="sats")
+    )
+    cake = await create_item(
+        shop.id, CreateItem(name="cake", description="x", price=1.5, unit="USD")
+    )
+    tea = await create_item(
+        shop.id, CreateItem(name="tea", description="x", price=2, unit="USD")
+    )
+    rate_snapshots.clear()
+
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/orders",
+        json={"items": [{"item": coffee.id, "quantity": 2}, {"item": cake.id}]},
+    )
+    assert response.status_code == 201
+    order = response.json()
+    assert order["items"] == [
+        {"item": coffee.id, "quantity": 2},
+        {"item": cake.id, "quantity": 1},
+    ]
+
+    fetches = rate_snapshots.fetches
+    with stubbed_services(rate=2000) as payments:
+        pay = (await client.get(str(lnurl_decode(order["lnurl"])))).json()
+        # 2 x 1000 sats + 1.5 USD at 2000 sats per USD
+        assert pay["minSendable"] == pay["maxSendable"] == 5_000_000
+        assert "2x coffee, cake" in pay["metadata"]
+        assert rate_snapshots.fetches == fetches + 1
+
+        url = httpx.URL(pay["callback"]).copy_add_param("amount", 5_000_000)
+        action = (await client.get(str(url))).json()
+        assert "pr" in action
+        [payment] = payments.values()
+        assert payment.extra == {
+            "tag": "offlineshop",
+            "order": order["id"],
+            "amounts": [2_000_000, 3_000_000],
+        }
+
+        await on_invoice_paid(payment)
+        page = await client.get(httpx.URL(action["successAction"]["url"]).path)
+    assert "2x coffee" in page.text
+    assert "cake" in page.text
+
+    days = await get_daily_sales(shop.id, "2000-01-01", "2999-12-31")
+    assert sorted((d.item, d.sales, d.amount_msat) for d in days) == sorted(
+        [(coffee.id, 2, 2_000_000), (cake.id, 1, 3_000_000)]
+    )
+
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/orders",
+        json={"items": [{"item": tea.id}, {"item": "missing"}]},
+    )
+    assert response.status_code == 400
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/orders",
+        json={"items": [{"item": tea.id}, {"item": tea.id}]},
+    )
+    assert response.status_code == 422
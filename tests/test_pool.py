@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import offlineshop_ext, pool, views, views_lnurl
+from ..crud import (
+    claim_pool_fill,
+    count_pooled_invoices,
+    create_item,
+    get_or_create_shop_by_wallet,
+    update_item,
+)
+from ..metrics import metrics
+from ..models import CreateItem
+from ..pool import InvoicePool
+from .benchmark import invoice
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """
+    Stubs invoice creation for the pool, returns what it was asked for.
+    """
+    calls = []
+
+    async def create_invoice(*, wallet_id, amount, expiry, extra, **_):
+        # give other fills a chance to run in between
+        await asyncio.sleep(0)
+        calls.append({"amount": amount, "expiry": expiry, "extra": extra})
+        return SimpleNamespace(payment_hash=f"{len(calls):064x}", bolt11=invoice)
+
+    monkeypatch.setattr(pool, "create_invoice", create_invoice)
+    return calls
+
+
+async def pooled_item(pool_size: int = 2):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(
+        name="coffee", description="x", price=1000, unit="sats", pool_size=pool_size
+    )
+    return await create_item(shop.id, data)
+
+
+@pytest.mark.asyncio
+async def test_pool_is_filled_and_drained(db, created):
+    item = await pooled_item()
+    invoices = InvoicePool()
+
+    assert await invoices.fill(item) == 2
+    assert await invoices.fill(item) == 0
+    assert created[0]["amount"] == 1000
+    assert created[0]["extra"] == {"tag": "offlineshop", "item": item.id}
+
+    first = await invoices.pop(item)
+    second = await invoices.pop(item)
+    assert first and second
+    assert first.payment_hash != second.payment_hash
+    assert await invoices.pop(item) is None
+    assert invoices._wanted == {item.id}
+
+    fiat = item.copy(update={"unit": "USD"})
+    assert await invoices.pop(fiat) is None
+
+
+@pytest.mark.asyncio
+async def test_pool_drops_stale_invoices(db, created):
+    item = await pooled_item()
+    invoices = InvoicePool()
+    await invoices.fill(item)
+
+    # a new version has a new price or description
+    item = await update_item(item.copy(update={"price": 2000}))
+    assert await invoices.pop(item) is None
+    await invoices.fill(item)
+    assert created[-1]["amount"] == 2000
+
+    # too close to expiring to be handed out
+    item = await update_item(item)
+    expiring = InvoicePool(expiry=60, min_validity=120)
+    await expiring.fill(item)
+    assert await count_pooled_invoices(item, 0) == 2
+    assert await expiring.pop(item) is None
+    await expiring.sweep()
+    assert await count_pooled_invoices(item, 0) == 0
+    assert expiring._wanted == {item.id}
+
+
+@pytest.mark.asyncio
+async def test_workers_fill_a_pool_once(db, created):
+    item = await pooled_item(pool_size=3)
+    # one pool per worker
+    workers = [InvoicePool() for _ in range(4)]
+
+    filled = await asyncio.gather(*(worker.fill(item) for worker in workers))
+    assert sum(filled) == 3
+    assert await count_pooled_invoices(item, 0) == 3
+
+    metrics.clear()
+    for _ in range(3):
+        assert await workers[0].pop(item)
+    # metrics are off
+    assert metrics.counters == {}
+
+    # a lease left behind by a crashed worker runs out
+    assert await claim_pool_fill(item.id, 0, 10)
+    assert await workers[0].fill(item) == 3
+
+
+@pytest.mark.asyncio
+async def test_callback_hands_out_pooled_invoice(db, created, monkeypatch):
+    item = await pooled_item(pool_size=1)
+    await pool.invoice_pool.fill(item)
+
+    async def create_invoice(**_):
+        raise AssertionError("the pool should have been used")
+
+    # pooled invoices are created well before they are paid
+    paid_at = datetime.now(timezone.utc)
+    payment = SimpleNamespace(
+        payment_hash=f"{1:064x}",
+        amount=1_000_000,
+        pending=False,
+        time=paid_at - timedelta(hours=2),
+        updated_at=paid_at,
+        extra={"tag": "offlineshop", "item": item.id},
+    )
+
+    async def get_standalone_payment(payment_hash, **_):
+        return payment if payment_hash == payment.payment_hash else None
+
+    monkeypatch.setattr(views_lnurl, "create_invoice", create_invoice)
+    monkeypatch.setattr(views, "get_standalone_payment", get_standalone_payment)
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    ) as client:
+        response = await client.get(
+            f"/offlineshop/lnurl/cb/{item.id}", params={"amount": 1_000_000}
+        )
+        action = response.json()
+        assert action["pr"] == invoice
+        assert action["successAction"]["url"].endswith(payment.payment_hash)
+
+        confirmation = await client.get(httpx.URL(action["successAction"]["url"]).path)
+    assert confirmation.status_code == 200
+    assert "coffee" in confirmation.text
+    assert paid_at.strftime("%Y-%m-%d %H:%M:%S") in confirmation.text
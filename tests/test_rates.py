@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from .. import rates, views_lnurl
+from ..rates import RateSnapshots
+from ..views_lnurl import get_rates
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    calls = []
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        calls.append(currency)
+        await asyncio.sleep(0.01)
+        return 2500.0
+
+    monkeypatch.setattr(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_fetch(upstream):
+    snapshots = RateSnapshots()
+
+    results = await asyncio.gather(*[snapshots.get("USD") for _ in range(20)])
+
+    assert upstream == ["USD"]
+    assert len({snapshot.id for snapshot in results}) == 1
+    assert results[0].as_satoshis(1.5) == 3750
+
+
+@pytest.mark.asyncio
+async def test_snapshot_is_refetched_after_ttl(upstream):
+    snapshots = RateSnapshots(ttl=0)
+
+    first = await snapshots.get("USD")
+    second = await snapshots.get("USD")
+
+    assert upstream == ["USD", "USD"]
+    # the earlier quote can still be looked up by the callback
+    assert snapshots.quote(first.id) is first
+    assert snapshots.quote(second.id) is second
+    assert snapshots.quote("unknown") is None
+    assert snapshots.quote(None) is None
+
+
+@pytest.mark.asyncio
+async def test_quotes_are_only_honoured_near_the_current_rate(monkeypatch):
+    fetched = iter([2500.0, 2505.0, 2600.0])
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        return next(fetched)
+
+    monkeypatch.setattr(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    snapshots = RateSnapshots(ttl=0)
+    monkeypatch.setattr(views_lnurl, "rate_snapshots", snapshots)
+
+    quote = await snapshots.get("USD")
+    # within the tolerance the wallet pays what it was quoted
+    assert (await get_rates(["USD"], quote.id))["USD"] is quote
+    # too far off, the current rate applies
+    current = (await get_rates(["USD"], quote.id))["USD"]
+    assert current.rate == 2600
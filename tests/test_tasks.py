@@ -0,0 +1,154 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import offlineshop_ext, views, views_api
+from ..crud import create_item, get_or_create_shop_by_wallet
+from ..models import CreateItem
+from ..tasks import (
+    PaymentWaiters,
+    SalesFeed,
+    on_invoice_paid,
+    payment_waiters,
+    sales_feed,
+)
+
+
+@pytest.mark.asyncio
+async def test_payment_waiters():
+    waiters = PaymentWaiters()
+
+    assert not await waiters.wait("hash", 0.01)
+
+    waiter = asyncio.create_task(waiters.wait("hash", 1))
+    await asyncio.sleep(0)
+    waiters.notify("other")
+    waiters.notify("hash")
+    assert await waiter
+    assert waiters._events == {}
+
+
+@pytest.mark.asyncio
+async def test_confirmation_page_waits_for_payment(db, monkeypatch):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1, unit="sats")
+    item = await create_item(shop.id, data)
+    payment = SimpleNamespace(
+        payment_hash="hash",
+        amount=1000,
+        pending=True,
+        time=datetime.now(timezone.utc),
+        updated_at=datetime.now(timezone.utc),
+        extra={"tag": "offlineshop", "item": item.id},
+    )
+    lookups = []
+
+    async def get_standalone_payment(payment_hash, **_):
+        lookups.append(payment_hash)
+        return payment
+
+    monkeypatch.setattr(views, "get_standalone_payment", get_standalone_payment)
+
+    async def settle():
+        await asyncio.sleep(0.05)
+        payment.pending = False
+        await on_invoice_paid(payment)  # type: ignore
+
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    ) as client:
+        start = time.monotonic()
+        response, _ = await asyncio.gather(
+            client.get("/offlineshop/confirmation/hash"), settle()
+        )
+
+    assert response.status_code == 200
+    assert "coffee" in response.text
+    assert time.monotonic() - start < views.confirmation_recheck_seconds
+    assert lookups == ["hash", "hash"]
+    assert payment_waiters._events == {}
+
+
+def test_sales_feed_drops_oldest_sales_for_slow_clients():
+    feed = SalesFeed(maxsize=2)
+
+    with feed.subscribe("shop") as slow, feed.subscribe("shop") as fast:
+        with feed.subscribe("other") as other:
+            for n in range(3):
+                feed.publish("shop", {"n": n})
+                assert fast.get_nowait() == {"n": n}
+            assert [slow.get_nowait(), slow.get_nowait()] == [{"n": 1}, {"n": 2}]
+            assert other.empty()
+    assert feed._clients == {}
+
+
+async def connect_sales_feed(app: FastAPI, api_key: str):
+    """
+    Runs the websocket endpoint in this event loop, returning the queues of
+    messages to and from the server and the task serving the connection.
+    """
+    incoming: asyncio.Queue = asyncio.Queue()
+    outgoing: asyncio.Queue = asyncio.Queue()
+    scope = {
+        "type": "websocket",
+        "scheme": "wss",
+        "server": ("shop.example.com", 443),
+        "path": "/offlineshop/api/v1/offlineshop/sales",
+        "query_string": f"api-key={api_key}".encode(),
+        "headers": [],
+    }
+    await incoming.put({"type": "websocket.connect"})
+    task = asyncio.create_task(app(scope, incoming.get, outgoing.put))
+    return incoming, outgoing, task
+
+
+@pytest.mark.asyncio
+async def test_sales_are_pushed_to_the_dashboard(db, monkeypatch):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1, unit="sats")
+    item = await create_item(shop.id, data)
+
+    async def get_wallet_for_key(key):
+        return SimpleNamespace(id="wallet") if key == "inkey" else None
+
+    monkeypatch.setattr(views_api, "get_wallet_for_key", get_wallet_for_key)
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+
+    _, outgoing, task = await connect_sales_feed(app, "wrong")
+    assert (await outgoing.get())["type"] == "websocket.close"
+    await task
+
+    incoming, outgoing, task = await connect_sales_feed(app, "inkey")
+    assert (await outgoing.get())["type"] == "websocket.accept"
+    paid_at = datetime.now(timezone.utc)
+    payment = SimpleNamespace(
+        payment_hash="hash",
+        amount=1000,
+        # e.g. a pooled invoice, created long before it was paid
+        time=paid_at - timedelta(hours=2),
+        updated_at=paid_at,
+        extra={"tag": "offlineshop", "item": item.id},
+    )
+    await on_invoice_paid(payment)  # type: ignore
+    message = await asyncio.wait_for(outgoing.get(), 1)
+    sale = json.loads(message["text"])
+    assert sale["item"] == item.id
+    assert sale["name"] == "coffee"
+    assert sale["amount_msat"] == 1000
+    assert sale["code"]
+    assert sale["time"] == paid_at.isoformat()
+
+    await incoming.put({"type": "websocket.disconnect", "code": 1000})
+    await asyncio.wait_for(task, 1)
+    assert sales_feed._clients == {}
@@ -0,0 +1,463 @@
+import base64
+import csv
+import io
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+
+import httpx
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.templating import Jinja2Templates
+from lnbits.decorators import require_admin_key, require_invoice_key
+from lnurl import decode as lnurl_decode
+from PIL import Image
+from starlette.requests import Request
+
+from .. import models, offlineshop_ext, views, views_api, views_lnurl
+from ..crud import (
+    create_image,
+    create_item,
+    create_sale,
+    get_or_create_shop_by_wallet,
+    item_cache,
+    load_catalog,
+    update_item,
+    update_shop,
+)
+from ..models import CreateItem, ItemSnapshot, Sale
+from ..views_api import api_shop_from_wallet
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="wallet"))
+    app.dependency_overrides[require_admin_key] = lambda: key_info
+    app.dependency_overrides[require_invoice_key] = lambda: key_info
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="https://shop.example.com"
+    )
+
+
+@pytest.mark.asyncio
+async def test_image_is_served_with_cache_headers(db, client):
+    image_hash = await create_image("image/png", b"png")
+
+    response = await client.get(f"/offlineshop/images/{image_hash}")
+    assert response.status_code == 200
+    assert response.content == b"png"
+    assert response.headers["content-type"] == "image/png"
+    assert "max-age" in response.headers["cache-control"]
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert response.headers["content-security-policy"] == "default-src 'none'"
+
+    etag = response.headers["etag"]
+    response = await client.get(
+        f"/offlineshop/images/{image_hash}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    response = await client.get(f"/offlineshop/images/{'0' * 64}")
+    assert response.status_code == 404
+
+    # blobs stored before types were checked aren't served as what they claim
+    html_hash = await create_image("text/html", b"<script></script>")
+    response = await client.get(f"/offlineshop/images/{html_hash}")
+    assert response.headers["content-type"] == "application/octet-stream"
+
+
+@pytest.mark.asyncio
+async def test_uploaded_image_is_downsized_for_wallets(db, client):
+    photo = io.BytesIO()
+    Image.new("RGB", (1600, 1200), "green").save(photo, "PNG")
+    upload = "data:image/png;base64," + base64.b64encode(photo.getvalue()).decode()
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/items",
+        json={
+            "name": "tea",
+            "description": "green",
+            "price": 10,
+            "unit": "sats",
+            "image": upload,
+        },
+    )
+    assert response.status_code == 201
+    [item] = (await client.get("/offlineshop/api/v1/offlineshop")).json()["items"]
+
+    # the dashboard gets the original back
+    original = await client.get(httpx.URL(item["image"]).path)
+    assert original.content == photo.getvalue()
+
+    # and sends the url back unchanged on edits
+    response = await client.put(
+        f"/offlineshop/api/v1/offlineshop/items/{item['id']}",
+        json={**item, "name": "green tea"},
+    )
+    [edited] = (await client.get("/offlineshop/api/v1/offlineshop")).json()["items"]
+    assert edited["name"] == "green tea"
+    assert edited["image"] == item["image"]
+
+    pay = (await client.get(str(lnurl_decode(item["lnurl"])))).json()
+    [_, (mime, thumbnail)] = json.loads(pay["metadata"])
+    assert mime == "image/jpeg;base64"
+    assert Image.open(io.BytesIO(base64.b64decode(thumbnail))).size == (256, 192)
+
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/items",
+        json={
+            "name": "tea",
+            "description": "green",
+            "price": 10,
+            "unit": "sats",
+            "image": "data:image/png;base64," + base64.b64encode(b"png").decode(),
+        },
+    )
+    assert response.status_code == 400
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/items",
+        json={
+            "name": "tea",
+            "description": "green",
+            "price": 10,
+            "unit": "sats",
+            "image": "data:text/html;base64,"
+            + base64.b64encode(photo.getvalue()).decode(),
+        },
+    )
+    assert response.status_code == 400
+
+
+def api_request(query: str = "", headers: Optional[dict] = None) -> Request:
+    app = FastAPI()
+    app.include_router(offlineshop_ext)
+    return Request(
+        {
+            "type": "http",
+            "app": app,
+            "router": app.router,
+            "scheme": "https",
+            "server": ("shop.example.com", 443),
+            "path": "/offlineshop/api/v1/offlineshop",
+            "query_string": query.encode(),
+            "headers": [
+                (k.lower().encode(), v.encode()) for k, v in (headers or {}).items()
+            ],
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_shop_items_are_paginated_and_projected(db):
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="wallet"))
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="x", description="x", price=1, unit="sats")
+    ids = sorted([(await create_item(shop.id, data)).id for _ in range(3)])
+
+    page = await api_shop_from_wallet(
+        api_request(), Response(), key_info, 2, None, "id,name"
+    )
+    assert [item["id"] for item in page["items"]] == ids[:2]
+    assert set(page["items"][0]) == {"id", "name"}
+
+    page = await api_shop_from_wallet(
+        api_request(), Response(), key_info, 2, page["next_cursor"], None
+    )
+    assert [item["id"] for item in page["items"]] == ids[2:]
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_unchanged_shop_returns_not_modified(db):
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="wallet"))
+    response = Response()
+    await api_shop_from_wallet(api_request(), response, key_info, None, None, None)
+    etag = response.headers["etag"]
+
+    cached = await api_shop_from_wallet(
+        api_request(headers={"If-None-Match": etag}),
+        Response(),
+        key_info,
+        None,
+        None,
+        None,
+    )
+    assert cached.status_code == 304
+
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="x", description="x", price=1, unit="sats")
+    await create_item(shop.id, data)
+    response = Response()
+    changed = await api_shop_from_wallet(
+        api_request(headers={"If-None-Match": etag}),
+        response,
+        key_info,
+        None,
+        None,
+        None,
+    )
+    assert len(changed["items"]) == 1
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_items_import_and_export_round_trip(db, client, monkeypatch):
+    monkeypatch.setattr(views_api, "max_import_errors", 1)
+    foreign_image = f"https://example.com/offlineshop/images/{'a' * 64}"
+    body = (
+        "name,description,price,unit,image,enabled\n"
+        'coffee,"hot,\nblack",1000,sats,,false\n'
+        f"tea,green,2.5,USD,{foreign_image},\n"
+        "broken,no price,,sats,,\n"
+        "short,row\n"
+    )
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/items/import", content=body
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["created"] == 2
+    assert [error["row"] for error in result["errors"]] == [3]
+    assert result["error_count"] == 2
+
+    response = await client.get(
+        "/offlineshop/api/v1/offlineshop/items/export", params={"format": "jsonl"}
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = sorted(
+        (json.loads(line) for line in response.text.splitlines()),
+        key=lambda item: item["name"],
+    )
+    assert [item["name"] for item in exported] == ["coffee", "tea"]
+    assert exported[0]["description"] == "hot,\nblack"
+    assert exported[0]["price"] == 1000
+    assert exported[0]["enabled"] is False
+    assert exported[1]["enabled"] is True
+    # urls of other hosts aren't taken for stored images
+    assert exported[1]["image"] == foreign_image
+
+    response = await client.post(
+        "/offlineshop/api/v1/offlineshop/items/import",
+        params={"format": "jsonl"},
+        content="\n".join(json.dumps(item) for item in exported) + "\n{",
+    )
+    result = response.json()
+    assert result["created"] == 2
+    assert [error["row"] for error in result["errors"]] == [3]
+    assert result["error_count"] == 1
+
+    response = await client.get("/offlineshop/api/v1/offlineshop/items/export")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "name", "description", "image", "enabled", "price", "unit"]
+    assert len(rows) == 5
+
+
+@pytest.mark.asyncio
+async def test_sales_stats_cover_the_requested_days(db, client):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    for n, day in enumerate((1, 2, 2)):
+        await create_sale(
+            Sale(
+                payment_hash=f"hash{n}",
+                shop=shop.id,
+                item="coffee",
+                amount_msat=5000,
+                price=5,
+                unit="sats",
+                time=datetime(2024, 5, day, tzinfo=timezone.utc),
+            )
+        )
+
+    response = await client.get(
+        "/offlineshop/api/v1/offlineshop/stats",
+        params={"since": "2024-05-02", "until": "2024-05-31"},
+    )
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["since"] == "2024-05-02"
+    assert [(d["day"], d["sales"]) for d in stats["days"]] == [("2024-05-02", 2)]
+    assert stats["items"][0]["amount_msat"] == 10000
+
+    response = await client.get("/offlineshop/api/v1/offlineshop/stats")
+    assert response.json()["days"] == []
+
+
+@pytest.mark.asyncio
+async def test_qr_codes_are_rendered_once_and_paginated(db, client, monkeypatch):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1, unit="sats")
+    items = [await create_item(shop.id, data) for _ in range(3)]
+    rendered = []
+
+    def lnurl_qr_svg(lnurl):
+        rendered.append(lnurl)
+        return f"<svg>{lnurl}</svg>"
+
+    monkeypatch.setattr(views, "lnurl_qr_svg", lnurl_qr_svg)
+    views.qr_cache.clear()
+    templates = Jinja2Templates(directory=Path(__file__).parents[1] / "templates")
+    monkeypatch.setattr(views, "offlineshop_renderer", lambda: templates)
+
+    response = await client.get(f"/offlineshop/qr/{items[0].id}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/svg+xml"
+    assert response.text.startswith("<svg>LNURL1")
+    response = await client.get(
+        f"/offlineshop/qr/{items[0].id}",
+        headers={"If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+    assert (await client.get("/offlineshop/qr/missing")).status_code == 404
+
+    ids = ",".join(item.id for item in items)
+    response = await client.get(
+        "/offlineshop/print", params={"items": ids, "render": "server", "per_page": 2}
+    )
+    assert response.status_code == 200
+    assert response.text.count('class="page"') == 2
+    assert response.text.count("<svg>") == 3
+    assert len(rendered) == 3
+
+    await update_item(items[1].copy(update={"name": "tea"}))
+    await client.get(
+        "/offlineshop/print", params={"items": ids, "render": "server", "per_page": 2}
+    )
+    assert len(rendered) == 4
+
+
+@pytest.mark.asyncio
+async def test_totp_codes_are_verified_within_a_window(db, client):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    url = "/offlineshop/api/v1/offlineshop/totp/verify"
+
+    response = await client.post(url, json={"code": "123456"})
+    assert response.status_code == 400
+
+    shop.method = "totp"
+    await update_shop(shop)
+    code = shop.otp.at(time.time() - 30)
+    response = await client.post(url, json={"code": code})
+    assert response.json() == {"valid": True, "offset": -1}
+    response = await client.post(url, json={"code": code, "window": 0})
+    assert response.json() == {"valid": False, "offset": None}
+    response = await client.post(url, json={"code": code, "window": 11})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_signed_lnurl_is_answered_from_the_token(
+    db, client, request_, monkeypatch
+):
+    monkeypatch.setattr(models, "signed_lnurls", True)
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    item = await create_item(
+        shop.id, CreateItem(name="coffee", description="x", price=1000, unit="sats")
+    )
+    token = ItemSnapshot.of(item).token()
+    assert str(lnurl_decode(item.lnurl(request_))).endswith(f"/lnurl/s/{token}")
+
+    item_cache.clear()
+
+    async def get_item(item_id):
+        raise AssertionError("the item should not be loaded")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(views_lnurl, "get_item", get_item)
+        pay = (await client.get(f"/offlineshop/lnurl/s/{token}")).json()
+    assert pay["minSendable"] == 1_000_000
+    assert "v=0" in pay["callback"]
+
+    response = await client.get(f"/offlineshop/lnurl/s/{token}x")
+    assert response.json()["status"] == "ERROR"
+
+    # a worker that hasn't seen the update quotes the old price, the callback
+    # turns it down, after which the item is known and quoted at its new price
+    await update_item(item.copy(update={"price": 2000}))
+    pay = (await client.get(f"/offlineshop/lnurl/s/{token}")).json()
+    assert pay["minSendable"] == 1_000_000
+    url = httpx.URL(pay["callback"]).copy_add_param("amount", 1_000_000)
+    action = (await client.get(str(url))).json()
+    assert action["reason"] == "Item changed, scan the code again."
+    pay = (await client.get(f"/offlineshop/lnurl/s/{token}")).json()
+    assert pay["minSendable"] == 2_000_000
+
+
+@pytest.mark.asyncio
+async def test_signed_lnurl_is_answered_from_the_token_with_the_catalog(
+    db, client, monkeypatch
+):
+    monkeypatch.setattr(models, "signed_lnurls", True)
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    data = CreateItem(name="coffee", description="x", price=1000, unit="sats")
+    item = await create_item(shop.id, data)
+    disabled = await create_item(shop.id, data)
+    disabled = await update_item(disabled.copy(update={"enabled": False}))
+    await load_catalog()
+
+    async def get_item(item_id):
+        raise AssertionError("the item should not be loaded")
+
+    token = ItemSnapshot.of(item).token()
+    with monkeypatch.context() as patched:
+        patched.setattr(views_lnurl, "get_item", get_item)
+        pay = (await client.get(f"/offlineshop/lnurl/s/{token}")).json()
+    assert pay["minSendable"] == 1_000_000
+
+    # a snapshot taken before the item was disabled
+    token = ItemSnapshot.of(disabled.copy(update={"enabled": True})).token()
+    pay = (await client.get(f"/offlineshop/lnurl/s/{token}")).json()
+    assert pay["reason"] == "Item disabled."
+
+
+@pytest.mark.asyncio
+async def test_items_are_searched_on_the_server(db, client):
+    shop = await get_or_create_shop_by_wallet("wallet")
+    assert shop
+    for name, price in (("Espresso", 300), ("Latte", 450), ("Cake", 450)):
+        data = CreateItem(name=name, description="coffee", price=price, unit="sats")
+        await create_item(shop.id, data)
+
+    url = "/offlineshop/api/v1/offlineshop/items/search"
+    response = await client.get(url, params={"q": "coff", "sort": "-price", "limit": 2})
+    page = response.json()
+    assert [item["price"] for item in page["items"]] == [450, 450]
+    assert page["items"][0]["lnurl"]
+    assert page["next_offset"] == 2
+    response = await client.get(
+        url, params={"q": "coff", "sort": "-price", "offset": 2}
+    )
+    assert [item["name"] for item in response.json()["items"]] == ["Espresso"]
+
+    response = await client.get(url, params={"sort": "name; DROP TABLE items"})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_metrics_require_the_token(db, client, monkeypatch):
+    monkeypatch.setattr(views, "metrics_enabled", True)
+    monkeypatch.setenv("OFFLINESHOP_METRICS_TOKEN", "secret")
+
+    response = await client.get("/offlineshop/metrics")
+    assert response.status_code == 401
+    response = await client.get(
+        "/offlineshop/metrics", headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 401
+
+    response = await client.get(
+        "/offlineshop/metrics", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    assert "# TYPE offlineshop_items_cache_hits_total counter" in response.text
+    assert "# TYPE offlineshop_items_cache_size gauge" in response.text
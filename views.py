@@ -1,16 +1,36 @@
+import asyncio
+import base64
+import hmac
+import os
 import time
 from http import HTTPStatus
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from lnbits.core.crud import get_standalone_payment
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
 
-from .crud import get_item, get_shop
+from .catalog import catalog
+from .counters import get_shop_code
+from .crud import (
+    cache_stats,
+    get_image,
+    get_item,
+    get_items_by_ids,
+    get_purchase,
+)
+from .helpers import image_mimes, lnurl_qr_svg
+from .limits import allow_confirmation
+from .metrics import InstrumentedRoute, metrics, metrics_enabled, span
+from .models import Item, encode_lnurls, qr_cache
+from .rates import rate_snapshots
+from .tasks import payment_waiters
+
+offlineshop_generic_router = APIRouter(route_class=InstrumentedRoute)
 
-offlineshop_generic_router = APIRouter()
+confirmation_recheck_seconds = 5
 
 
 def offlineshop_renderer():
@@ -24,21 +44,65 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
     )
 
 
+async def render_qr_codes(request: Request, items: list[Item]) -> list[str]:
+    """
+    SVG QR codes for the items' LNURLs. Rendering is slow, so codes are cached
+    per item version and base url and missing ones are rendered off the loop.
+    """
+    # newer lnurl versions give an object that renders as the plain url
+    lnurls = [
+        getattr(lnurl, "bech32", lnurl) for lnurl in encode_lnurls(request, items)
+    ]
+    keys = [
+        (item.id, item.version, lnurl)
+        for item, lnurl in zip(items, lnurls, strict=True)
+    ]
+    codes = [qr_cache.get(key) for key in keys]
+    missing = {key[2] for key, code in zip(keys, codes, strict=True) if code is None}
+    if missing:
+        rendered = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: {lnurl: lnurl_qr_svg(lnurl) for lnurl in missing}
+        )
+        for i, key in enumerate(keys):
+            if codes[i] is None:
+                codes[i] = rendered[key[2]]
+                qr_cache.set(key, codes[i])
+    return [code for code in codes if code is not None]
+
+
 @offlineshop_generic_router.get("/print", response_class=HTMLResponse)
-async def print_qr_codes(request: Request):
+async def print_qr_codes(
+    request: Request,
+    render: str = Query("client", pattern="^(client|server)$"),
+    per_page: int = Query(12, ge=1, le=100),
+):
+    """
+    With `render=server` the QR codes come pre-rendered on a sheet split into
+    pages of `per_page`, so label printers can fetch it in one request.
+    """
+    item_ids = [i for i in request.query_params.get("items", "").split(",") if i]
+    found = await get_items_by_ids(item_ids)
     items = []
-    for item_id in request.query_params.get("items", "").split(","):
-        item = await get_item(item_id)
-        if item:
-            amount = round(item.price, 2) if item.unit != "sats" else int(item.price)
-            price = f"{amount} {item.unit}"
-            items.append(
-                {
-                    "lnurl": item.lnurl(request),
-                    "name": item.name,
-                    "price": price,
-                }
-            )
+    for item, lnurl in zip(found, encode_lnurls(request, found), strict=True):
+        amount = round(item.price, 2) if item.unit != "sats" else int(item.price)
+        price = f"{amount} {item.unit}"
+        items.append(
+            {
+                "lnurl": lnurl,
+                "name": item.name,
+                "price": price,
+            }
+        )
+
+    if render == "server":
+        for values, qr in zip(
+            items, await render_qr_codes(request, found), strict=True
+        ):
+            values["qr"] = qr
+        pages = [items[i : i + per_page] for i in range(0, len(items), per_page)]
+        return offlineshop_renderer().TemplateResponse(
+            "offlineshop/print_sheet.html", {"request": request, "pages": pages}
+        )
 
     return offlineshop_renderer().TemplateResponse(
         "offlineshop/print.html",
@@ -46,16 +110,79 @@ async def print_qr_codes(request: Request):
     )
 
 
+@offlineshop_generic_router.get("/qr/{item_id}", name="offlineshop.qr")
+async def item_qr_code(request: Request, item_id: str):
+    item = await get_item(item_id)
+    if not item:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Item not found.")
+
+    # the code only changes with the item version and the base url, which is
+    # part of the url the client caches it under
+    etag = f'"{item.id}-{item.version}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=300"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    [qr] = await render_qr_codes(request, [item])
+    return Response(content=qr, media_type="image/svg+xml", headers=headers)
+
+
+@offlineshop_generic_router.get("/images/{image_hash}", name="offlineshop.image")
+async def item_image(request: Request, image_hash: str):
+    # images are content-addressed, so they never change under the same url
+    etag = f'"{image_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        # never let a browser treat a stored blob as a page or script
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "default-src 'none'",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    image = await get_image(image_hash)
+    if not image:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image not found.")
+
+    mime = image.mime if image.mime in image_mimes else "application/octet-stream"
+    return Response(
+        content=base64.b64decode(image.data), media_type=mime, headers=headers
+    )
+
+
 @offlineshop_generic_router.get(
     "/confirmation/{p}",
     name="offlineshop.confirmation_code",
     response_class=HTMLResponse,
 )
-async def confirmation_code(p: str):
+async def confirmation_code(
+    request: Request,
+    p: str,
+    wait: int = Query(
+        30, ge=0, le=30, description="Seconds to wait for a pending payment."
+    ),
+):
     style = "<style>* { font-size: 100px}</style>"
+    if not await allow_confirmation(request):
+        raise HTTPException(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS,
+            detail="Too many requests, try again in a minute." + style,
+        )
 
     payment_hash = p
-    payment = await get_standalone_payment(payment_hash, incoming=True)
+    with span("payment_lookup"):
+        payment = await get_standalone_payment(payment_hash, incoming=True)
+
+    # hold the request until the invoice listener reports the payment, but
+    # look again now and then in case it settled on another worker
+    deadline = time.monotonic() + wait
+    while payment and payment.pending and time.monotonic() < deadline:
+        await payment_waiters.wait(
+            payment_hash, min(confirmation_recheck_seconds, deadline - time.monotonic())
+        )
+        with span("payment_lookup"):
+            payment = await get_standalone_payment(payment_hash, incoming=True)
     if not payment:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
@@ -68,29 +195,57 @@ async def confirmation_code(p: str):
             + style,
         )
 
-    if payment.time.timestamp() + 60 * 15 < time.time():
+    if payment.updated_at.timestamp() + 60 * 15 < time.time():
         raise HTTPException(
             status_code=HTTPStatus.REQUEST_TIMEOUT,
             detail="Too much time has passed." + style,
         )
 
-    if not payment.extra or not payment.extra.get("item"):
+    with span("item_lookup"):
+        purchase = await get_purchase(payment.extra or {})
+    if not purchase:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="Payment is missing extra data."
         )
-
-    assert payment.extra
-    item_id = payment.extra.get("item")
-    assert item_id
-    item = await get_item(item_id)
-    assert item
-    shop = await get_shop(item.shop)
-    assert shop
-
+    shop, lines = purchase
+    with span("confirmation_code"):
+        code = await get_shop_code(shop, payment_hash, payment.updated_at.timestamp())
+
+    items = "".join(
+        f"{quantity}x " * (quantity > 1) + f"{item.name}<br>"
+        f"{round(item.price * quantity, 2)} {item.unit}<br>"
+        for item, quantity in lines
+    )
     return f"""
-        [{shop.get_code(payment_hash)}]<br>
-        {item.name}<br>
-        {item.price} {item.unit}<br>
-        {payment.time.strftime('%Y-%m-%d %H:%M:%S')}
+        [{code}]<br>
+        {items}
+        {payment.updated_at.strftime('%Y-%m-%d %H:%M:%S')}
         {style}
         """
+
+
+@offlineshop_generic_router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(request: Request):
+    """
+    Prometheus metrics, only served if OFFLINESHOP_METRICS is set. If
+    OFFLINESHOP_METRICS_TOKEN is set it has to be sent as a bearer token.
+    """
+    if not metrics_enabled:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND)
+    token = os.getenv("OFFLINESHOP_METRICS_TOKEN")
+    if token and not hmac.compare_digest(
+        request.headers.get("authorization", "").encode(), f"Bearer {token}".encode()
+    ):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED)
+
+    gauges = {}
+    totals = {}
+    for cache, stats in cache_stats().items():
+        gauges[f"offlineshop_{cache}_cache_size"] = stats["size"]
+        totals[f"offlineshop_{cache}_cache_hits_total"] = stats["hits"]
+        totals[f"offlineshop_{cache}_cache_misses_total"] = stats["misses"]
+    gauges.update(
+        {f"offlineshop_catalog_{key}": value for key, value in catalog.stats().items()}
+    )
+    totals["offlineshop_rate_fetches_total"] = rate_snapshots.fetches
+    return metrics.render(gauges, totals)
@@ -1,38 +1,161 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import re
+import time
+from datetime import date, datetime, timedelta, timezone
 from http import HTTPStatus
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from lnbits.core.crud import get_wallet_for_key
 from lnbits.core.models import WalletTypeInfo
 from lnbits.decorators import require_admin_key, require_invoice_key
 from lnurl.exceptions import InvalidUrl as LnurlInvalidUrl
 
+from .counters import reset_shop_code
 from .crud import (
+    create_image,
     create_item,
+    create_items,
+    create_order,
     delete_item_from_shop,
+    get_daily_sales,
     get_item,
+    get_item_sales,
     get_items,
+    get_items_by_ids,
     get_or_create_shop_by_wallet,
+    image_exists,
+    search_items,
     update_item,
     update_shop,
 )
-from .models import CreateItem, CreateShop, ShopCounter
+from .helpers import (
+    image_mimes,
+    iter_csv_rows,
+    iter_lines,
+    make_thumbnail,
+    parse_data_uri,
+)
+from .metrics import InstrumentedRoute
+from .models import (
+    CreateItem,
+    CreateOrder,
+    CreateShop,
+    ImportItem,
+    Item,
+    ItemSearch,
+    VerifyCode,
+    encode_lnurls,
+)
+from .tasks import sales_feed
 
-offlineshop_api_router = APIRouter()
+offlineshop_api_router = APIRouter(route_class=InstrumentedRoute)
 
+# the url `Item.values` gives out for stored images, sent back on updates
+stored_image_hash = re.compile(r"[0-9a-f]{64}")
 
-@offlineshop_api_router.get("/api/v1/offlineshop")
-async def api_shop_from_wallet(
-    r: Request, key_info: WalletTypeInfo = Depends(require_invoice_key)
-):
-    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
-    assert shop
-    items = await get_items(shop.id)
+# rows written per insert statement when importing
+import_batch_size = 200
+# items read per query when exporting
+export_page_size = 500
+export_fields = ["id", "name", "description", "image", "enabled", "price", "unit"]
+# errors listed in the import response, the rest are only counted
+max_import_errors = 100
+export_media_types = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+# uploads are downsized for the lnurlpay metadata, the original is only
+# served to the dashboard
+max_image_size = 2048
+# period the sales stats cover when no dates are given
+stats_default_days = 30
+
+
+async def get_stored_image_hash(r: Request, image: str) -> Optional[str]:
+    """
+    The hash of an image url this instance gave out, if the image is still
+    stored. Urls of other hosts are kept as plain urls.
+    """
+    prefix = str(r.url_for("offlineshop.image", image_hash="_"))[:-1]
+    if not image.startswith(prefix):
+        return None
+    content_hash = image[len(prefix) :]
+    if not stored_image_hash.fullmatch(content_hash):
+        return None
+    if not await image_exists(content_hash):
+        return None
+    return content_hash
+
+
+async def prepare_item(r: Request, data: CreateItem) -> Optional[str]:
+    """
+    Normalizes the price and moves an uploaded image into blob storage.
+    Returns the hash of the stored image, if any.
+    """
+    if data.unit == "sats":
+        data.price = int(data.price)
+    image_hash = None
+    stored_image = data.image and await get_stored_image_hash(r, data.image)
+    if stored_image:
+        image_hash = stored_image
+        data.image = None
+    elif data.image:
+        image_is_url = data.image.startswith("http")
+        if not image_is_url:
+
+            def size(b64string):
+                return int((len(b64string) * 3) / 4 - b64string.count("=", -2))
 
+            image_size = size(data.image) / 1024
+            if image_size > max_image_size:
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    detail=f"""
+                    Image size is too big, {int(image_size)}Kb.
+                    Max: {max_image_size}kb, or use an URL.
+                    """,
+                )
+            parsed = parse_data_uri(data.image)
+            if not parsed:
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_REQUEST, detail="Invalid image."
+                )
+            mime, content = parsed
+            if mime not in image_mimes:
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    detail="Images have to be png, jpeg, gif or webp.",
+                )
+            try:
+                # decoding and resizing takes a while, keep it off the loop
+                thumbnail = await asyncio.get_running_loop().run_in_executor(
+                    None, make_thumbnail, content
+                )
+            except ValueError as exc:
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_REQUEST, detail="Invalid image."
+                ) from exc
+            image_hash = await create_image(mime, content, thumbnail)
+            data.image = None
+    return image_hash
+
+
+def encode_item_lnurls(r: Request, items: list[Item]) -> list[str]:
     try:
-        return {
-            **shop.dict(),
-            **{"otp_key": shop.otp_key, "items": [item.values(r) for item in items]},
-        }
+        return encode_lnurls(r, items)
     except LnurlInvalidUrl as exc:
         raise HTTPException(
             status_code=HTTPStatus.UPGRADE_REQUIRED,
@@ -43,35 +166,71 @@ async def api_shop_from_wallet(
         ) from exc
 
 
+@offlineshop_api_router.get("/api/v1/offlineshop")
+async def api_shop_from_wallet(
+    r: Request,
+    response: Response,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(
+        None, description="Comma separated item fields to return, e.g. id,name"
+    ),
+):
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+
+    # the response only changes with the shop version and the request itself
+    request_key = f"{r.base_url}|{r.url.query}".encode()
+    etag = (
+        f'W/"{shop.id}-{shop.version}-'
+        f'{hashlib.sha256(request_key).hexdigest()[:16]}"'
+    )
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if r.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+
+    items = await get_items(shop.id, limit=limit, cursor=cursor)
+    item_fields = set(fields.split(",")) if fields else None
+
+    if item_fields is None or "lnurl" in item_fields:
+        lnurls = encode_item_lnurls(r, items)
+    else:
+        # not requested, skip encoding them
+        lnurls = [""] * len(items)
+    item_values = []
+    for item, lnurl in zip(items, lnurls, strict=True):
+        values = item.values(r, lnurl)
+        if item_fields is not None:
+            values = {k: v for k, v in values.items() if k in item_fields}
+        item_values.append(values)
+
+    next_cursor = items[-1].id if limit and len(items) == limit else None
+    return {
+        **shop.dict(),
+        **{
+            "wordlist": "\n".join(shop.words),
+            "otp_key": shop.otp_key,
+            "items": item_values,
+            "next_cursor": next_cursor,
+        },
+    }
+
+
 @offlineshop_api_router.post("/api/v1/offlineshop/items")
 @offlineshop_api_router.put("/api/v1/offlineshop/items/{item_id}")
 async def api_add_or_update_item(
+    r: Request,
     data: CreateItem,
     key_info: WalletTypeInfo = Depends(require_admin_key),
     item_id: Optional[str] = None,
 ):
     shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
     assert shop
-    if data.unit == "sats":
-        data.price = int(data.price)
-    if data.image:
-        image_is_url = data.image.startswith("http")
-        if not image_is_url:
-
-            def size(b64string):
-                return int((len(b64string) * 3) / 4 - b64string.count("=", -2))
-
-            image_size = size(data.image) / 1024
-            if image_size > 100:
-                raise HTTPException(
-                    status_code=HTTPStatus.BAD_REQUEST,
-                    detail=f"""
-                    Image size is too big, {int(image_size)}Kb. Max: 100kb,
-                    Compress the image at https://tinypng.com, or use an URL.
-                    """,
-                )
+    image_hash = await prepare_item(r, data)
     if item_id is None:
-        await create_item(shop.id, data)
+        await create_item(shop.id, data, image_hash)
         return Response(status_code=HTTPStatus.CREATED)
     else:
         item = await get_item(item_id)
@@ -79,9 +238,247 @@ async def api_add_or_update_item(
             raise HTTPException(
                 status_code=HTTPStatus.NOT_FOUND, detail="Item not found"
             )
-        for k, v in data.dict().items():
-            setattr(item, k, v)
-        await update_item(item)
+        # don't mutate the cached instance in place
+        await update_item(item.copy(update={**data.dict(), "image_hash": image_hash}))
+
+
+@offlineshop_api_router.post("/api/v1/offlineshop/items/import")
+async def api_import_items(
+    r: Request,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+    file_format: str = Query("csv", alias="format", pattern="^(csv|jsonl)$"),
+):
+    """
+    Creates items from a csv (with a header row) or jsonl request body. Valid
+    rows are inserted in batches, invalid ones are reported by row number, the
+    first `max_import_errors` of them with their error.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+
+    async def rows():
+        lines = iter_lines(r.stream())
+        if file_format == "jsonl":
+            async for line in lines:
+                if line.strip():
+                    yield line
+            return
+        header = None
+        async for row in iter_csv_rows(lines):
+            if header is None:
+                header = row
+            elif len(row) != len(header):
+                yield ValueError(f"Expected {len(header)} columns, got {len(row)}.")
+            else:
+                yield {k: v for k, v in zip(header, row, strict=True) if v != ""}
+
+    created = 0
+    errors: list[dict] = []
+    error_count = 0
+    batch: list[tuple[CreateItem, Optional[str]]] = []
+    number = 0
+    async for row in rows():
+        number += 1
+        try:
+            if isinstance(row, Exception):
+                raise row
+            data = ImportItem.parse_obj(
+                json.loads(row) if isinstance(row, str) else row
+            )
+            image_hash = await prepare_item(r, data)
+        except (HTTPException, ValueError) as exc:
+            error_count += 1
+            if len(errors) < max_import_errors:
+                detail = exc.detail if isinstance(exc, HTTPException) else str(exc)
+                errors.append({"row": number, "error": " ".join(detail.split())})
+            continue
+        batch.append((data, image_hash))
+        if len(batch) >= import_batch_size:
+            created += len(await create_items(shop.id, batch))
+            batch = []
+    created += len(await create_items(shop.id, batch))
+
+    return {"created": created, "errors": errors, "error_count": error_count}
+
+
+@offlineshop_api_router.get("/api/v1/offlineshop/items/search")
+async def api_search_items(
+    r: Request,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    q: Optional[str] = Query(None, max_length=200),
+    enabled: Optional[bool] = None,
+    unit: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    sort: str = Query("name", pattern="^-?(name|price|id)$"),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Items of the shop matching all given filters. `q` matches words of the
+    name or description by prefix, `sort` is descending with a leading `-`.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+    search = ItemSearch(
+        text=q,
+        enabled=enabled,
+        unit=unit,
+        min_price=min_price,
+        max_price=max_price,
+        sort=sort.lstrip("-"),
+        descending=sort.startswith("-"),
+        limit=limit,
+        offset=offset,
+    )
+    items = await search_items(shop.id, search)
+    lnurls = encode_item_lnurls(r, items)
+    return {
+        "items": [
+            item.values(r, lnurl) for item, lnurl in zip(items, lnurls, strict=True)
+        ],
+        "next_offset": offset + limit if len(items) == limit else None,
+    }
+
+
+@offlineshop_api_router.get("/api/v1/offlineshop/items/export")
+async def api_export_items(
+    r: Request,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    file_format: str = Query("csv", alias="format", pattern="^(csv|jsonl)$"),
+):
+    """
+    Streams all items of the shop, reading them page by page.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+
+    def serialize(values: list) -> str:
+        if file_format == "jsonl":
+            return json.dumps(dict(zip(export_fields, values, strict=True))) + "\n"
+        line = io.StringIO()
+        csv.writer(line).writerow(values)
+        return line.getvalue()
+
+    async def export():
+        if file_format == "csv":
+            yield serialize(export_fields)
+        cursor = None
+        while True:
+            items = await get_items(shop.id, limit=export_page_size, cursor=cursor)
+            for item in items:
+                # stored images are exported as their url, which imports again
+                values = item.values(r, lnurl="")
+                yield serialize([values[field] for field in export_fields])
+            if len(items) < export_page_size:
+                break
+            cursor = items[-1].id
+
+    return StreamingResponse(
+        export(),
+        media_type=export_media_types[file_format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="offlineshop-items.{file_format}"'
+            )
+        },
+    )
+
+
+@offlineshop_api_router.post(
+    "/api/v1/offlineshop/orders", status_code=HTTPStatus.CREATED
+)
+async def api_create_order(
+    r: Request,
+    data: CreateOrder,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+):
+    """
+    An order of several items, paid through a single LNURL-pay.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+    items = await get_items_by_ids([line.item for line in data.items])
+    available = {item.id for item in items if item.shop == shop.id and item.enabled}
+    unavailable = [line.item for line in data.items if line.item not in available]
+    if unavailable:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Items not available: {', '.join(unavailable)}.",
+        )
+
+    order = await create_order(shop.id, data.items)
+    try:
+        lnurl = order.lnurl(r)
+    except LnurlInvalidUrl as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.UPGRADE_REQUIRED,
+            detail="""
+            LNURLs need to be delivered over a
+            publically accessible `https` domain or Tor.
+            """,
+        ) from exc
+    return {**order.dict(), "lnurl": lnurl}
+
+
+@offlineshop_api_router.get("/api/v1/offlineshop/stats")
+async def api_sales_stats(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    item: Optional[str] = None,
+):
+    """
+    Sales per item and day, and per item over the whole period, read from the
+    daily totals. Defaults to the last 30 days, days are in utc.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+    until = until or datetime.now(timezone.utc).date()
+    since = since or until - timedelta(days=stats_default_days - 1)
+    period = (shop.id, since.isoformat(), until.isoformat(), item)
+    return {
+        "since": since,
+        "until": until,
+        "days": await get_daily_sales(*period),
+        "items": await get_item_sales(*period),
+    }
+
+
+@offlineshop_api_router.websocket("/api/v1/offlineshop/sales")
+async def api_sales_feed(websocket: WebSocket, api_key: str = Query(alias="api-key")):
+    """
+    Sends every sale of the shop as a json message while connected. Browsers
+    can't set headers on websockets, so the key goes in the query string.
+    """
+    wallet = await get_wallet_for_key(api_key)
+    if not wallet:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    shop = await get_or_create_shop_by_wallet(wallet.id)
+    assert shop
+    await websocket.accept()
+
+    async def send(queue: asyncio.Queue):
+        while True:
+            await websocket.send_json(await queue.get())
+
+    async def receive():
+        # only here to notice the client going away while no sales come in
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    with sales_feed.subscribe(shop.id) as queue:
+        tasks = [asyncio.create_task(send(queue)), asyncio.create_task(receive())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            exc = task.exception()
+            if exc and not isinstance(exc, WebSocketDisconnect):
+                raise exc
 
 
 @offlineshop_api_router.delete("/api/v1/offlineshop/items/{item_id}")
@@ -107,4 +504,22 @@ async def api_update_offlineshop(
 
     await update_shop(shop)
 
-    ShopCounter.reset(shop)
+    await reset_shop_code(shop)
+
+
+@offlineshop_api_router.post("/api/v1/offlineshop/totp/verify")
+async def api_verify_totp(
+    data: VerifyCode, key_info: WalletTypeInfo = Depends(require_invoice_key)
+):
+    """
+    Checks a code a customer shows against the shop's TOTP key, allowing for
+    codes from `window` time steps (of 30s) before or after now.
+    """
+    shop = await get_or_create_shop_by_wallet(key_info.wallet.id)
+    assert shop
+    if shop.method != "totp":
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Shop doesn't use TOTP codes."
+        )
+    offset = shop.otp.verify(data.code.strip(), time.time(), data.window)
+    return {"valid": offset is not None, "offset": offset}
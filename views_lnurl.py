@@ -1,6 +1,9 @@
+import json
+from collections.abc import Iterable
+from typing import Optional
+
 from fastapi import APIRouter
 from lnbits.core.services import create_invoice
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
 from lnurl import (
     CallbackUrl,
     LightningInvoice,
@@ -12,41 +15,107 @@ from lnurl import (
     MilliSatoshi,
     UrlAction,
 )
+from lnurl.types import LnurlPayMetadata
 from pydantic import parse_obj_as
+from starlette.datastructures import URL
 from starlette.requests import Request
 
-from .crud import get_item, get_shop
+from .catalog import catalog
+from .crud import (
+    get_cached_item,
+    get_item,
+    get_item_metadata,
+    get_order,
+    get_shop,
+)
+from .limits import allow_invoice, allow_scan
+from .metrics import InstrumentedRoute, count_lnurl_error, span
+from .models import (
+    Item,
+    ItemSnapshot,
+    Order,
+    PooledInvoice,
+    Shop,
+    metadata_cache,
+    order_summary,
+)
+from .pool import invoice_pool
+from .rates import RateSnapshot, rate_snapshots
 
-offlineshop_lnurl_router = APIRouter()
+offlineshop_lnurl_router = APIRouter(route_class=InstrumentedRoute)
 
+# amounts accepted for fiat prices, per mille of the price at the current rate
+quote_tolerance = (995, 1010)
 
-@offlineshop_lnurl_router.get("/lnurl/{item_id}", name="offlineshop.lnurl_response")
-async def lnurl_response(
-    req: Request, item_id: str
-) -> LnurlPayResponse | LnurlErrorResponse:
-    item = await get_item(item_id)
-    if not item:
-        return LnurlErrorResponse(reason="Item not found.")
 
-    if not item.enabled:
-        return LnurlErrorResponse(reason="Item disabled.")
+def lnurl_error(key: str, reason: str) -> LnurlErrorResponse:
+    """
+    `key` identifies the kind of error in metrics, `reason` goes to the wallet.
+    """
+    count_lnurl_error(key)
+    return LnurlErrorResponse(reason=reason)
 
-    price_msat = (
-        await fiat_amount_as_satoshis(item.price, item.unit)
-        if item.unit != "sats"
-        else item.price
-    ) * 1000
 
-    url = parse_obj_as(
-        CallbackUrl,
-        str(req.url_for("offlineshop.lnurl_callback", item_id=item.id)),
-    )
+def rate_limited() -> LnurlErrorResponse:
+    return lnurl_error("rate_limited", "Too many requests, try again in a minute.")
+
+
+async def get_rates(
+    units: Iterable[str], quote: Optional[str] = None
+) -> dict[str, RateSnapshot]:
+    """
+    One rate snapshot per fiat unit, a single lookup each. Snapshots quoted
+    to the wallet before (their ids comma separated in `quote`) are reused
+    while their rate is within `quote_tolerance` of the current one.
+    """
+    quoted = (rate_snapshots.quote(quote_id) for quote_id in (quote or "").split(","))
+    quotes = {snapshot.currency: snapshot for snapshot in quoted if snapshot}
+    snapshots = {}
+    for unit in units:
+        if unit == "sats":
+            continue
+        with span("rate_lookup"):
+            current = await rate_snapshots.get(unit)
+        snapshot = quotes.get(unit)
+        low, high = quote_tolerance
+        if (
+            snapshot
+            and low * current.rate <= 1000 * snapshot.rate <= high * current.rate
+        ):
+            snapshots[unit] = snapshot
+        else:
+            snapshots[unit] = current
+    return snapshots
+
+
+def price_msat(price: float, unit: str, snapshots: dict[str, RateSnapshot]) -> int:
+    if unit == "sats":
+        return round(price * 1000)
+    return snapshots[unit].as_satoshis(price) * 1000
+
+
+def price_totals(lines: list[tuple[Item, int]]) -> dict[str, float]:
+    totals: dict[str, float] = {}
+    for item, quantity in lines:
+        totals[item.unit] = totals.get(item.unit, 0) + item.price * quantity
+    return totals
+
+
+async def pay_response(
+    callback: URL, totals: dict[str, float], metadata: LnurlPayMetadata
+) -> LnurlPayResponse:
+    snapshots = await get_rates(totals)
+    price = sum(price_msat(amount, unit, snapshots) for unit, amount in totals.items())
+    if snapshots:
+        # the callback checks the amount against these exact rates
+        quote = ",".join(snapshot.id for snapshot in snapshots.values())
+        callback = callback.include_query_params(quote=quote)
 
     return LnurlPayResponse(
-        callback=url,
-        minSendable=MilliSatoshi(price_msat),
-        maxSendable=MilliSatoshi(price_msat),
-        metadata=item.lnurlpay_metadata,
+        callback=parse_obj_as(CallbackUrl, str(callback)),
+        minSendable=MilliSatoshi(price),
+        maxSendable=MilliSatoshi(price),
+        metadata=metadata,
         # TODO remove after lnurl lib update
         commentAllowed=None,
         payerData=None,
@@ -55,53 +124,80 @@ async def lnurl_response(
     )
 
 
-@offlineshop_lnurl_router.get("/lnurl/cb/{item_id}", name="offlineshop.lnurl_callback")
-async def lnurl_callback(
-    request: Request, item_id: str
+async def pay_callback(
+    request: Request,
+    shop: Shop,
+    lines: list[tuple[Item, int]],
+    memo: str,
+    metadata: LnurlPayMetadata,
+    extra: dict,
+    pooled: Optional[Item] = None,
 ) -> LnurlPayActionResponse | LnurlErrorResponse:
-
-    item = await get_item(item_id)
-    if not item:
-        return LnurlErrorResponse(reason="Item not found.")
-
-    if item.unit == "sats":
-        min_price = item.price * 1000
-        max_price = item.price * 1000
-    else:
-        price = await fiat_amount_as_satoshis(item.price, item.unit)
-        # allow some fluctuation (the fiat price may have changed between the calls)
-        min_price = price * 995
-        max_price = price * 1010
+    """
+    With `pooled` set, an invoice ready in the pool of that item is used if
+    there is one.
+    """
+    quote = request.query_params.get("quote")
+    quoted = set((quote or "").split(","))
+    totals = price_totals(lines)
+    snapshots = await get_rates(totals, quote)
+    min_price = 0
+    max_price = 0
+    for unit, amount in totals.items():
+        if unit == "sats" or snapshots[unit].id in quoted:
+            min_price += price_msat(amount, unit, snapshots)
+            max_price += price_msat(amount, unit, snapshots)
+        else:
+            # the quote expired or was issued by another worker, so allow some
+            # fluctuation (the fiat price may have changed between the calls)
+            price = snapshots[unit].as_satoshis(amount)
+            min_price += price * quote_tolerance[0]
+            max_price += price * quote_tolerance[1]
 
     amount_received = int(request.query_params.get("amount") or 0)
     if amount_received < min_price:
-        return LnurlErrorResponse(
-            reason=f"Amount {amount_received} is smaller than minimum {min_price}."
+        return lnurl_error(
+            "amount_too_small",
+            f"Amount {amount_received} is smaller than minimum {min_price}.",
         )
     elif amount_received > max_price:
-        return LnurlErrorResponse(
-            reason=f"Amount {amount_received} is greater than maximum {max_price}."
+        return lnurl_error(
+            "amount_too_large",
+            f"Amount {amount_received} is greater than maximum {max_price}.",
         )
 
-    shop = await get_shop(item.shop)
-    assert shop
+    if len(lines) > 1:
+        # lets the sales ledger split the payment between the items
+        extra["amounts"] = [
+            price_msat(item.price * quantity, item.unit, snapshots)
+            for item, quantity in lines
+        ]
 
-    try:
-        payment = await create_invoice(
-            wallet_id=shop.wallet,
-            amount=int(amount_received / 1000),
-            memo=item.name,
-            unhashed_description=item.lnurlpay_metadata.encode(),
-            extra={"tag": "offlineshop", "item": item.id},
+    invoice = None
+    if pooled:
+        with span("invoice_pool"):
+            invoice = await invoice_pool.pop(pooled)
+    if not invoice:
+        try:
+            with span("create_invoice"):
+                payment = await create_invoice(
+                    wallet_id=shop.wallet,
+                    amount=int(amount_received / 1000),
+                    memo=memo,
+                    unhashed_description=metadata.encode(),
+                    extra={"tag": "offlineshop", **extra},
+                )
+        except Exception as exc:
+            return lnurl_error("invoice_failed", str(exc))
+        invoice = PooledInvoice(
+            payment_hash=payment.payment_hash, bolt11=payment.bolt11
         )
-    except Exception as exc:
-        return LnurlErrorResponse(reason=str(exc))
 
-    if shop.method and shop.wordlist:
+    if shop.method and shop.words:
         url = parse_obj_as(
             CallbackUrl,
             str(
-                request.url_for("offlineshop.confirmation_code", p=payment.payment_hash)
+                request.url_for("offlineshop.confirmation_code", p=invoice.payment_hash)
             ),
         )
 
@@ -112,11 +208,182 @@ async def lnurl_callback(
                 "Open to get the confirmation code for your purchase."
             ),
         )
-        invoice = parse_obj_as(LightningInvoice, LightningInvoice(payment.bolt11))
-
         return LnurlPayActionResponse(
-            pr=invoice,
+            pr=parse_obj_as(LightningInvoice, LightningInvoice(invoice.bolt11)),
             successAction=success_action,
         )
 
-    return LnurlErrorResponse(reason="Shop does not support confirmation codes.")
+    return lnurl_error(
+        "no_confirmation_codes", "Shop does not support confirmation codes."
+    )
+
+
+def item_callback_url(req: Request, item_id: str, version: int) -> URL:
+    # the callback turns down invoices for an outdated price or description
+    return req.url_for(
+        "offlineshop.lnurl_callback", item_id=item_id
+    ).include_query_params(v=version)
+
+
+async def item_pay_response(
+    req: Request, item_id: str
+) -> LnurlPayResponse | LnurlErrorResponse:
+    with span("item_lookup"):
+        item = await get_item(item_id)
+    if not item:
+        return lnurl_error("item_not_found", "Item not found.")
+
+    if not item.enabled:
+        return lnurl_error("item_disabled", "Item disabled.")
+
+    with span("metadata"):
+        metadata = await get_item_metadata(item)
+    return await pay_response(
+        item_callback_url(req, item.id, item.version),
+        {item.unit: item.price},
+        metadata,
+    )
+
+
+@offlineshop_lnurl_router.get("/lnurl/{item_id}", name="offlineshop.lnurl_response")
+async def lnurl_response(
+    req: Request, item_id: str
+) -> LnurlPayResponse | LnurlErrorResponse:
+    if not await allow_scan(req, item_id):
+        return rate_limited()
+    return await item_pay_response(req, item_id)
+
+
+@offlineshop_lnurl_router.get(
+    "/lnurl/s/{token}", name="offlineshop.signed_lnurl_response"
+)
+async def signed_lnurl_response(
+    req: Request, token: str
+) -> LnurlPayResponse | LnurlErrorResponse:
+    """
+    Answers from the signed snapshot in the token alone, unless this worker
+    knows the item changed since, was disabled or deleted, or the snapshot
+    lacks metadata that isn't cached either.
+    """
+    snapshot = ItemSnapshot.from_token(token)
+    if not snapshot:
+        return lnurl_error("invalid_token", "Invalid LNURL.")
+    if not await allow_scan(req, snapshot.id):
+        return rate_limited()
+
+    item = get_cached_item(snapshot.id)
+    if item:
+        outdated = item.version != snapshot.version or not item.enabled
+    else:
+        # the catalog holds every enabled item
+        outdated = catalog.loaded
+    metadata = snapshot.metadata or metadata_cache.get((snapshot.id, snapshot.version))
+    if outdated or metadata is None:
+        return await item_pay_response(req, snapshot.id)
+
+    return await pay_response(
+        item_callback_url(req, snapshot.id, snapshot.version),
+        {snapshot.unit: snapshot.price},
+        metadata,
+    )
+
+
+@offlineshop_lnurl_router.get("/lnurl/cb/{item_id}", name="offlineshop.lnurl_callback")
+async def lnurl_callback(
+    request: Request, item_id: str
+) -> LnurlPayActionResponse | LnurlErrorResponse:
+    if not await allow_invoice(request, item_id):
+        return rate_limited()
+    with span("item_lookup"):
+        item = await get_item(item_id)
+    if not item:
+        return lnurl_error("item_not_found", "Item not found.")
+    version = request.query_params.get("v")
+    if version is not None and version != str(item.version):
+        return lnurl_error("item_changed", "Item changed, scan the code again.")
+
+    with span("shop_lookup"):
+        shop = await get_shop(item.shop)
+    assert shop
+    with span("metadata"):
+        metadata = await get_item_metadata(item)
+
+    return await pay_callback(
+        request,
+        shop,
+        [(item, 1)],
+        item.name,
+        metadata,
+        {"item": item.id},
+        pooled=item,
+    )
+
+
+async def get_order_lines(order: Order) -> Optional[list[tuple[Item, int]]]:
+    """
+    The items of the order with their quantities, or None if any of them was
+    removed from the shop or disabled since.
+    """
+    lines = []
+    with span("item_lookup"):
+        for line in order.items:
+            item = await get_item(line.item)
+            if not item or item.shop != order.shop or not item.enabled:
+                return None
+            lines.append((item, line.quantity))
+    return lines
+
+
+def order_metadata(lines: list[tuple[Item, int]]) -> LnurlPayMetadata:
+    return LnurlPayMetadata(json.dumps([["text/plain", order_summary(lines)]]))
+
+
+@offlineshop_lnurl_router.get(
+    "/lnurl/order/{order_id}", name="offlineshop.order_lnurl_response"
+)
+async def order_lnurl_response(
+    req: Request, order_id: str
+) -> LnurlPayResponse | LnurlErrorResponse:
+    if not await allow_scan(req, order_id):
+        return rate_limited()
+    order = await get_order(order_id)
+    if not order:
+        return lnurl_error("order_not_found", "Order not found.")
+    lines = await get_order_lines(order)
+    if not lines:
+        return lnurl_error("order_unavailable", "Order has unavailable items.")
+
+    return await pay_response(
+        req.url_for("offlineshop.order_lnurl_callback", order_id=order.id),
+        price_totals(lines),
+        order_metadata(lines),
+    )
+
+
+@offlineshop_lnurl_router.get(
+    "/lnurl/order/cb/{order_id}", name="offlineshop.order_lnurl_callback"
+)
+async def order_lnurl_callback(
+    request: Request, order_id: str
+) -> LnurlPayActionResponse | LnurlErrorResponse:
+    if not await allow_invoice(request, order_id):
+        return rate_limited()
+    order = await get_order(order_id)
+    if not order:
+        return lnurl_error("order_not_found", "Order not found.")
+    lines = await get_order_lines(order)
+    if not lines:
+        return lnurl_error("order_unavailable", "Order has unavailable items.")
+
+    with span("shop_lookup"):
+        shop = await get_shop(order.shop)
+    assert shop
+
+    return await pay_callback(
+        request,
+        shop,
+        lines,
+        order_summary(lines),
+        order_metadata(lines),
+        {"order": order.id},
+    )
@@ -1,3 +1,8 @@
+import sys
+from typing import Optional
+
+from .helpers import TTLCache
+
 animals = [
     "albatross",
     "bison",
@@ -26,3 +31,31 @@ animals = [
     "yak",
     "zebra",
 ]
+
+default_wordlist: tuple[str, ...] = tuple(animals)
+default_wordlist_text = "\n".join(animals)
+
+# parsed custom wordlists, shared by every shop using the same list
+_interned_wordlists = TTLCache(maxsize=1024, ttl=60 * 60)
+
+
+def normalize_wordlist(text: Optional[str]) -> Optional[str]:
+    """
+    The default wordlist is not stored per shop, `None` refers to it.
+    """
+    if not text or not text.strip() or text.strip() == default_wordlist_text:
+        return None
+    return text
+
+
+def get_wordlist(text: Optional[str]) -> tuple[str, ...]:
+    if not text:
+        return default_wordlist
+    words = _interned_wordlists.get(text)
+    if words is None:
+        if normalize_wordlist(text) is None:
+            words = default_wordlist
+        else:
+            words = tuple(sys.intern(word) for word in text.split("\n"))
+        _interned_wordlists.set(text, words)
+    return words